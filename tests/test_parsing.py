@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the parsing code of `vo-scraper.py`, using small synthetic inputs.
+
+Run from the repository root with:
+
+    python3 -m unittest discover tests
+"""
+
+import importlib.util
+import io
+import json
+import os
+import struct
+import tempfile
+import unittest
+
+SCRAPER_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "vo-scraper.py"
+)
+
+# The scraper can't be imported by name because of the dash
+spec = importlib.util.spec_from_file_location("vo_scraper_functions", SCRAPER_FILE)
+vo = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(vo)
+
+
+def full_box(payload):
+    """Prepends version 0 and no flags, as used by the sample table boxes"""
+    return b"\0\0\0\0" + payload
+
+
+def build_stbl(sizes, stts, chunk_offsets, stsc, large_offsets=False, sync=None):
+    """Builds the boxes of a sample table
+
+    Keyword arguments:
+    sizes         -- Size of each sample
+    stts          -- `[(count, duration), ...]`
+    chunk_offsets -- Offset of each chunk in the file
+    stsc          -- `[(first chunk, samples per chunk, description index), ...]`
+    large_offsets -- Whether to write `co64` instead of `stco`
+    sync          -- Numbers of the key frames counting from 1, no `stss` box if not given
+    """
+    stbl = [
+        [
+            b"stsz",
+            full_box(struct.pack(f">II{len(sizes)}I", 0, len(sizes), *sizes)),
+        ],
+        [
+            b"stts",
+            full_box(
+                struct.pack(">I", len(stts))
+                + b"".join(struct.pack(">II", *run) for run in stts)
+            ),
+        ],
+        [
+            b"stsc",
+            full_box(
+                struct.pack(">I", len(stsc))
+                + b"".join(struct.pack(">III", *entry) for entry in stsc)
+            ),
+        ],
+        [
+            b"co64" if large_offsets else b"stco",
+            full_box(
+                struct.pack(
+                    f">I{len(chunk_offsets)}{'Q' if large_offsets else 'I'}",
+                    len(chunk_offsets),
+                    *chunk_offsets,
+                )
+            ),
+        ],
+    ]
+    if sync is not None:
+        stbl.append(
+            [b"stss", full_box(struct.pack(f">I{len(sync)}I", len(sync), *sync))]
+        )
+    return stbl
+
+
+def quiet_state():
+    """Returns a scraper state that prints into a buffer instead of stdout"""
+    state = vo.ScraperState()
+    state.output = io.StringIO()
+    return state
+
+
+class TestMp4Boxes(unittest.TestCase):
+    def test_round_trip(self):
+        moov = [
+            [b"mvhd", b"\0" * 100],
+            [b"trak", [[b"tkhd", b"\1" * 84], [b"mdia", [[b"mdhd", b"\2" * 24]]]]],
+            [b"udta", b"\3" * 5],
+        ]
+        data = vo.build_mp4_box(b"moov", moov)
+        self.assertEqual(vo.parse_mp4_boxes(data), [[b"moov", moov]])
+        self.assertEqual(vo.find_mp4_box(moov, b"trak", b"mdia", b"mdhd"), b"\2" * 24)
+        self.assertIsNone(vo.find_mp4_box(moov, b"trak", b"edts"))
+
+    def test_64_bit_size(self):
+        data = struct.pack(">I4sQ", 1, b"free", 16 + 3) + b"abc"
+        self.assertEqual(vo.parse_mp4_boxes(data), [[b"free", b"abc"]])
+
+    def test_size_zero_extends_to_end(self):
+        data = struct.pack(">I4s", 8, b"ftyp") + struct.pack(">I4s", 0, b"mdat") + b"xy"
+        self.assertEqual(vo.parse_mp4_boxes(data), [[b"ftyp", b""], [b"mdat", b"xy"]])
+
+    def test_broken_box(self):
+        # Longer than the data
+        with self.assertRaises(vo.MediaError):
+            vo.parse_mp4_boxes(struct.pack(">I4s", 100, b"moov") + b"\0" * 10)
+        # Shorter than its own header
+        with self.assertRaises(vo.MediaError):
+            vo.parse_mp4_boxes(struct.pack(">I4s", 4, b"moov"))
+
+    def test_durations(self):
+        version_0 = bytes(4) + struct.pack(">IIII", 0, 0, 1000, 5000) + bytes(80)
+        self.assertEqual(vo.get_mp4_timescale(version_0), 1000)
+        changed = vo.set_mp4_duration(version_0, b"mvhd", 1234)
+        self.assertEqual(struct.unpack(">I", changed[16:20])[0], 1234)
+        self.assertEqual(len(changed), len(version_0))
+
+        version_1 = b"\1" + bytes(3) + struct.pack(">QQIQ", 0, 0, 90000, 5) + bytes(80)
+        self.assertEqual(vo.get_mp4_timescale(version_1), 90000)
+        changed = vo.set_mp4_duration(version_1, b"mdhd", 2**40)
+        self.assertEqual(struct.unpack(">Q", changed[24:32])[0], 2**40)
+
+        # Version 0 durations are capped instead of overflowing
+        changed = vo.set_mp4_duration(version_0, b"mvhd", 2**40)
+        self.assertEqual(struct.unpack(">I", changed[16:20])[0], 2**32 - 1)
+
+        with self.assertRaises(vo.MediaError):
+            vo.get_mp4_timescale(b"\0" * 8)
+
+
+class TestMp4Samples(unittest.TestCase):
+    def test_offsets_from_chunks(self):
+        # Two chunks of 2 samples, then one chunk of 1 sample
+        stbl = build_stbl(
+            sizes=[10, 20, 30, 40, 50],
+            stts=[(3, 100), (2, 200)],
+            chunk_offsets=[1000, 2000, 3000],
+            stsc=[(1, 2, 1), (3, 1, 1)],
+            sync=[1, 4],
+        )
+        samples = vo.read_mp4_samples(stbl)
+        self.assertEqual(samples["offsets"], [1000, 1010, 2000, 2030, 3000])
+        self.assertEqual(samples["sizes"], [10, 20, 30, 40, 50])
+        self.assertEqual(samples["times"], [0, 100, 200, 300, 500])
+        self.assertEqual(samples["durations"], [100, 100, 100, 200, 200])
+        self.assertEqual(samples["sync"], {0, 3})
+        self.assertEqual(samples["description_index"], 1)
+        self.assertNotIn("composition_offsets", samples)
+
+    def test_co64_offsets(self):
+        stbl = build_stbl(
+            sizes=[10, 20],
+            stts=[(2, 1)],
+            chunk_offsets=[2**33, 2**34],
+            stsc=[(1, 1, 1)],
+            large_offsets=True,
+        )
+        self.assertEqual(vo.read_mp4_samples(stbl)["offsets"], [2**33, 2**34])
+
+    def test_constant_sample_size(self):
+        stbl = build_stbl([], [(3, 1)], [500], [(1, 3, 1)])
+        stbl[0] = [b"stsz", full_box(struct.pack(">II", 8, 3))]
+        self.assertEqual(vo.read_mp4_samples(stbl)["offsets"], [500, 508, 516])
+
+    def test_composition_offsets(self):
+        stbl = build_stbl([1, 1, 1], [(3, 1)], [0], [(1, 3, 1)])
+        stbl.append([b"ctts", b"\1\0\0\0" + struct.pack(">IIIII", 2, 1, 512, 2, 1024)])
+        samples = vo.read_mp4_samples(stbl)
+        self.assertEqual(samples["composition_offsets"], [512, 1024, 1024])
+        self.assertEqual(samples["ctts_version"], 1)
+
+    def test_unsupported_tables(self):
+        # More samples than the decoding times describe
+        with self.assertRaises(vo.MediaError):
+            vo.read_mp4_samples(build_stbl([1, 2, 3], [(2, 1)], [0], [(1, 3, 1)]))
+        # Missing chunk offsets
+        with self.assertRaises(vo.MediaError):
+            vo.read_mp4_samples(build_stbl([1], [(1, 1)], [0], [(1, 1, 1)])[:3])
+        # Truncated sample sizes
+        stbl = build_stbl([1, 2], [(2, 1)], [0], [(1, 2, 1)])
+        stbl[0][1] = stbl[0][1][:14]
+        with self.assertRaises(vo.MediaError):
+            vo.read_mp4_samples(stbl)
+        # Compact sample sizes
+        stbl = build_stbl([1], [(1, 1)], [0], [(1, 1, 1)])
+        stbl.append([b"stz2", b""])
+        with self.assertRaises(vo.MediaError):
+            vo.read_mp4_samples(stbl)
+
+
+class TestMp4SampleTables(unittest.TestCase):
+    def setUp(self):
+        self.samples = vo.read_mp4_samples(
+            build_stbl(
+                sizes=[10, 20, 30, 40, 50, 60],
+                stts=[(6, 100)],
+                chunk_offsets=[1000, 5000],
+                stsc=[(1, 3, 2)],
+                sync=[1, 3, 5],
+            )
+        )
+
+    def test_stco_offsets_are_rewritten(self):
+        # Samples 2 to 4 of the original, written as chunks of 2 and 1 samples
+        tables = vo.build_mp4_sample_tables(
+            self.samples, 2, 5, [(48, 2), (200, 1)], large_offsets=False
+        )
+        self.assertEqual(
+            [box_type for box_type, _ in tables],
+            [b"stts", b"stss", b"stsc", b"stsz", b"stco"],
+        )
+        clip = vo.read_mp4_samples(tables)
+        self.assertEqual(clip["offsets"], [48, 78, 200])
+        self.assertEqual(clip["sizes"], [30, 40, 50])
+        self.assertEqual(clip["durations"], [100, 100, 100])
+        # Key frames 3 and 5 of the original are the first and third of the clip
+        self.assertEqual(clip["sync"], {0, 2})
+        self.assertEqual(clip["description_index"], 2)
+
+    def test_co64_offsets_are_rewritten(self):
+        chunks = [(2**32 + 8, 1), (2**32 + 100, 2)]
+        tables = vo.build_mp4_sample_tables(
+            self.samples, 0, 3, chunks, large_offsets=True
+        )
+        self.assertIsNotNone(vo.find_mp4_box(tables, b"co64"))
+        self.assertIsNone(vo.find_mp4_box(tables, b"stco"))
+        clip = vo.read_mp4_samples(tables)
+        self.assertEqual(clip["offsets"], [2**32 + 8, 2**32 + 100, 2**32 + 120])
+
+    def test_stsc_only_lists_changes(self):
+        tables = vo.build_mp4_sample_tables(
+            self.samples, 0, 6, [(0, 2), (100, 2), (200, 1), (300, 1)], False
+        )
+        stsc = vo.find_mp4_box(tables, b"stsc")
+        self.assertEqual(struct.unpack(">I", stsc[4:8])[0], 2)
+        self.assertEqual(struct.unpack(">6I", stsc[8:32]), (1, 2, 2, 3, 1, 2))
+
+    def test_rebuild_track(self):
+        trak = [
+            [b"tkhd", bytes(84)],
+            [
+                b"mdia",
+                [
+                    [
+                        b"mdhd",
+                        bytes(4) + struct.pack(">IIII", 0, 0, 1000, 600) + bytes(4),
+                    ],
+                    [
+                        b"minf",
+                        [
+                            [
+                                b"stbl",
+                                [[b"stsd", b"desc"]]
+                                + build_stbl([1], [(1, 1)], [0], [(1, 1, 1)]),
+                            ]
+                        ],
+                    ],
+                ],
+            ],
+        ]
+        tables = vo.build_mp4_sample_tables(self.samples, 0, 1, [(64, 1)], False)
+        new_trak = vo.rebuild_mp4_track(trak, tables, 100, 50)
+        stbl = vo.find_mp4_box(new_trak, b"mdia", b"minf", b"stbl")
+        self.assertEqual(stbl[0], [b"stsd", b"desc"])
+        self.assertEqual(vo.read_mp4_samples(stbl)["offsets"], [64])
+        mdhd = vo.find_mp4_box(new_trak, b"mdia", b"mdhd")
+        self.assertEqual(struct.unpack(">I", mdhd[16:20])[0], 100)
+        tkhd = vo.find_mp4_box(new_trak, b"tkhd")
+        self.assertEqual(struct.unpack(">I", tkhd[20:24])[0], 50)
+
+
+class TestParseRange(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(vo.parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(vo.parse_range("bytes=0-0", 1000), (0, 0))
+        self.assertEqual(vo.parse_range("bytes=100-", 1000), (100, 999))
+        self.assertEqual(vo.parse_range(" bytes=999-999 ", 1000), (999, 999))
+
+    def test_end_past_the_file(self):
+        self.assertEqual(vo.parse_range("bytes=900-5000", 1000), (900, 999))
+
+    def test_suffix(self):
+        self.assertEqual(vo.parse_range("bytes=-100", 1000), (900, 999))
+        # A suffix longer than the file is the whole file
+        self.assertEqual(vo.parse_range("bytes=-5000", 1000), (0, 999))
+        self.assertIsNone(vo.parse_range("bytes=-0", 1000))
+
+    def test_unsatisfiable(self):
+        self.assertIsNone(vo.parse_range("bytes=1000-", 1000))
+        self.assertIsNone(vo.parse_range("bytes=500-100", 1000))
+        self.assertIsNone(vo.parse_range("bytes=0-", 0))
+
+    def test_invalid(self):
+        for value in ("bytes=-", "bytes=a-b", "items=0-1", "bytes=0-1,5-6", ""):
+            with self.subTest(value=value):
+                self.assertIsNone(vo.parse_range(value, 1000))
+
+
+class TestParseLectureLine(unittest.TestCase):
+    LINK = "https://video.ethz.ch/lectures/d-infk/2019/spring/252-0028-00L.html"
+
+    def parse(self, line):
+        self.state = quiet_state()
+        return vo.parse_lecture_line(self.state, line)
+
+    def test_link_only(self):
+        self.assertEqual(self.parse(self.LINK), (self.LINK, "", "", 0, 1))
+        self.assertEqual(self.parse(self.LINK + "  "), (self.LINK, "", "", 0, 1))
+
+    def test_credentials(self):
+        self.assertEqual(
+            self.parse(f"{self.LINK} user pass"), (self.LINK, "user", "pass", 0, 1)
+        )
+        # Only a username
+        self.assertEqual(self.parse(f"{self.LINK} user"), (self.LINK, "user", "", 0, 1))
+
+    def test_options(self):
+        self.assertEqual(
+            self.parse(f"{self.LINK} priority=2 weight=0.5"),
+            (self.LINK, "", "", 2, 0.5),
+        )
+        self.assertEqual(
+            self.parse(f"{self.LINK} user pass weight=3 priority=-1"),
+            (self.LINK, "user", "pass", -1, 3),
+        )
+
+    def test_options_in_place_of_credentials(self):
+        # Not all words are options, so the first two are username and password
+        self.assertEqual(
+            self.parse(f"{self.LINK} priority=1 pass"),
+            (self.LINK, "priority=1", "pass", 0, 1),
+        )
+
+    def test_invalid_options(self):
+        for option in ("priority=1x", "priority=", "weight=0", "weight=-2", "weight=x"):
+            with self.subTest(option=option):
+                self.assertEqual(
+                    self.parse(f"{self.LINK} {option}"), (self.LINK, "", "", 0, 1)
+                )
+                self.assertIn(
+                    f"Ignoring invalid `{option}`", self.state.output.getvalue()
+                )
+
+
+class TestRunJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state = quiet_state()
+        self.state.directory_prefix = self.directory.name + os.sep
+        self.collection = [
+            (self.directory.name + "/A/1.mp4", "https://example.com/1.mp4", "One"),
+            (self.directory.name + "/A/2.mp4", "https://example.com/2.mp4", "Two"),
+            (self.directory.name + "/B/3.mp4", "https://example.com/3.mp4", "Three"),
+        ]
+        self.state.lecture_priorities[self.directory.name + "/B"] = (2, 0.5)
+
+    def tearDown(self):
+        vo.close_run_journal(self.state)
+        self.directory.cleanup()
+
+    def read_journal(self):
+        """Reads the journal of the run with a new state, as `--recover` does"""
+        state = quiet_state()
+        return state, vo.read_run_journal(state, self.state.run_journal_file)
+
+    def test_round_trip(self):
+        vo.open_run_journal(self.state, self.collection)
+        vo.write_journal(
+            self.state, "started", file=self.collection[0][0], part="1.part", etag='"e"'
+        )
+        vo.write_journal(
+            self.state, "progress", file=self.collection[0][0], offset=4096
+        )
+        vo.write_journal(self.state, "done", file=self.collection[1][0])
+
+        state, (collection, resume) = self.read_journal()
+        self.assertEqual(collection, [self.collection[0], self.collection[2]])
+        self.assertEqual(
+            resume,
+            {
+                self.collection[0][0]: {
+                    "part": "1.part",
+                    "offset": 4096,
+                    "etag": '"e"',
+                    "last_modified": None,
+                }
+            },
+        )
+        # The priorities of the lectures are restored
+        self.assertEqual(state.lecture_priorities[self.directory.name + "/B"], (2, 0.5))
+        self.assertEqual(state.lecture_priorities[self.directory.name + "/A"], (0, 1))
+
+    def test_restarted_download(self):
+        vo.open_run_journal(self.state, self.collection)
+        file_name = self.collection[0][0]
+        vo.write_journal(self.state, "started", file=file_name, part="1.part")
+        vo.write_journal(self.state, "progress", file=file_name, offset=4096)
+        # Started again from the beginning, the old progress doesn't count
+        vo.write_journal(self.state, "started", file=file_name, part="1.part")
+
+        _, (collection, resume) = self.read_journal()
+        self.assertEqual(len(collection), 3)
+        self.assertEqual(resume, dict())
+
+    def test_incomplete_last_line(self):
+        vo.open_run_journal(self.state, self.collection)
+        vo.write_journal(self.state, "done", file=self.collection[0][0])
+        # The scraper was killed while writing a record
+        self.state.run_journal.write('{"type": "done", "fi')
+        self.state.run_journal.flush()
+
+        _, (collection, _) = self.read_journal()
+        self.assertEqual(collection, self.collection[1:])
+
+    def test_format(self):
+        vo.open_run_journal(self.state, self.collection[:1])
+        with open(self.state.run_journal_file, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]["type"], "run")
+        self.assertEqual(records[0]["directory"], self.state.directory_prefix)
+        self.assertEqual(
+            records[1],
+            {
+                "type": "planned",
+                "file": self.collection[0][0],
+                "link": self.collection[0][1],
+                "episode": "One",
+                "priority": 0,
+                "weight": 1,
+            },
+        )
+
+    def test_deleted_after_the_run(self):
+        vo.open_run_journal(self.state, self.collection)
+        journal_file = self.state.run_journal_file
+        self.assertTrue(os.path.isfile(journal_file))
+        vo.close_run_journal(self.state)
+        self.assertFalse(os.path.exists(journal_file))
+        # Nothing is written without a journal
+        vo.write_journal(self.state, "done", file=self.collection[0][0])
+        self.assertFalse(os.path.exists(journal_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
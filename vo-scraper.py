@@ -19,12 +19,37 @@ Check README.md and LICENSE before using this program.
 import urllib.request
 import os
 import sys
+import threading  # For downloading several streams of a recording at once
+import time  # For waiting between retries
 from urllib.request import Request
+from urllib.parse import (  # For resolving links in streaming manifests
+    parse_qs,
+    urljoin,
+    urlparse,
+)
+import xml.etree.ElementTree as ElementTree  # For parsing DASH manifests
 import json  # For handling json files
+import queue  # For handing finished downloads to the mover thread
+import re  # For parsing file names of downloaded recordings
 import argparse  # For parsing commandline arguments
+import atexit  # For writing out the event log when exiting
+import collections  # For keeping track of segments being downloaded
+import concurrent.futures  # For sending requests in parallel
+import contextlib  # For releasing connections after a request
+import functools  # For passing the scraper state to functions run in other threads
+import datetime  # For downloading the newest recordings first
 import getpass  # For getting the user password
+import hashlib  # For distributing lectures between shards
+import html  # For reading links from catalogue pages
+import http.server  # For serving the library to other scrapers
+import fnmatch  # For matching lecture names of post-processing commands
 import random  # For selecting a random hint
+import sqlite3  # For searching the episode catalogue
+import shlex  # For quoting arguments in exported shell scripts
 import shutil  # For getting terminal size
+import socket  # For identifying the owner of a lock file
+import struct  # For reading and writing MP4 boxes
+import subprocess  # For running post-processing commands
 import webbrowser  # only used to open the user's browser when reporting a bug
 
 # Check whether `requests` is installed
@@ -56,37 +81,308 @@ PROGRAM_VERSION = "4.0.0"
 
 # For web requests
 USER_AGENT = "Mozilla/5.0"
-cookie_jar = requests.cookies.RequestsCookieJar()
-
-# Store video sources in global list
-video_src_collection = list()
-
-# For stats
-link_counter = 0
-download_counter = 0
-skip_counter = 0
 
 #
 SERIES_METADATA_SUFFIX = ".series-metadata.json"
 VIDEO_INFO_PREFIX = "https://video.ethz.ch/.episode-video.json?recordId="
-directory_prefix = "Lecture Recordings" + os.sep
+VIDEO_SRC_PREFIX = "https://oc-vp-dist-downloads.ethz.ch/mh_default_org/oaipmh-mmp/"
+DEFAULT_DIRECTORY_PREFIX = "Lecture Recordings" + os.sep
+
+# Local index of downloaded recordings, stored inside `directory_prefix`
+LIBRARY_INDEX_FILE = ".vo-scraper-index.json"
+LIBRARY_INDEX_VERSION = 1
+# How long to wait for other scraper processes saving the library index
+LIBRARY_INDEX_LOCK_TIMEOUT = 30
+
+# How much of the MP4 file to read at once while looking for the index (`moov` box)
+CLIP_PROBE_SIZE = 64 * 1024
+# Sample data closer together than this is fetched with a single request
+CLIP_MERGE_GAP = 256 * 1024
+# Boxes that contain other boxes we need to look into
+MP4_CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts"}
+# Boxes describing the samples of a track, these are rebuilt for the clip
+MP4_SAMPLE_TABLE_BOXES = {
+    b"stts",
+    b"ctts",
+    b"stss",
+    b"stsc",
+    b"stsz",
+    b"stz2",
+    b"stco",
+    b"co64",
+    b"sdtp",
+    b"sbgp",
+    b"stps",
+    b"subs",
+}
+
+# Seconds to wait for other scrapers, see `--peer`
+PEER_TIMEOUT = 5
+# Recordings are served to other scrapers in chunks of this size, see `--serve-library`
+LIBRARY_SERVER_CHUNK_SIZE = 1024 * 1024
+
+# Number of bytes downloaded to measure the download speed
+SPEED_PROBE_SIZE = 8 * 1024 * 1024
+
+# Number of parallel requests when probing file sizes
+PROBE_WORKERS = 8
+
+# How often a segment of an HLS or DASH stream is requested again
+SEGMENT_RETRIES = 3
+
+# Catalogue of all lectures and episodes seen so far, stored inside `directory_prefix`
+EPISODE_CATALOGUE_FILE = ".vo-scraper-episodes.sqlite"
+
+# Journal of the downloads of each run, stored inside `directory_prefix`, see `--recover`
+JOURNAL_DIR = ".vo-scraper-journal"
+# Offsets of downloads in progress are written to the journal every this many bytes
+JOURNAL_CHECKPOINT_SIZE = 16 * 1024 * 1024
+
+# Lecture catalogues, e.g. `https://video.ethz.ch/lectures/d-infk/2019/spring.html`
+CATALOGUE_PREFIX = "https://video.ethz.ch/lectures/"
+CATALOGUE_CACHE_FILE = ".vo-scraper-catalogue.json"
+# Catalogue pages fetched more recently than this are not requested again
+CATALOGUE_CACHE_SECONDS = 6 * 60 * 60
+# Stop following links to further pages of a catalogue after this many pages
+CATALOGUE_MAX_PAGES = 50
+
+# Events are written to the event log in blocks of this size
+EVENT_LOG_BUFFER_SIZE = 64 * 1024
+
+# Written data is removed from the page cache in steps of this many bytes
+DROP_CACHE_STEP = 8 * 1024 * 1024
+
+# Maximum number of finished downloads waiting to be moved before new downloads have to wait
+STAGING_QUEUE_SIZE = 4
+# How often moving a recording is retried
+MOVE_RETRIES = 3
+
+# Seconds over which the throughput is measured before changing the number of connections
+ADAPTIVE_WINDOW = 3
+# How often a request is repeated if the server is overloaded
+THROTTLE_RETRIES = 5
+# How often a download is continued after it stalled or the connection broke
+STALL_RETRIES = 5
+# Recordings from the last days are downloaded before all others
+NEWEST_DAYS = 7
+
+# Seconds over which the rate of received data is averaged
+RATE_WINDOW = 10
+# Upper limit for the number of download workers when raising the connections on the fly
+MAX_DOWNLOAD_WORKERS = 64
 
-# Default quality
-video_quality = "HD"
+# Seconds between updates of the status line shown without tqdm
+STATUS_LINE_INTERVAL = 0.5
 
-# Boolean flags
-download_all = False
-download_latest = False
-verbose = False
-print_src = False
-HIDE_PROGRESS_BAR = False
+# Lock files older than this are considered abandoned on systems without `flock`
+STALE_LOCK_SECONDS = 6 * 60 * 60
 
-# Location of text files
-file_to_print_src_to = ""
-history_file = ""
 PARAMETER_FILE = "parameters.txt"
 
 
+class ScraperState:
+    """Settings, login cookies, caches and statistics of a scraper
+
+    Every function that needs them takes the state as first argument, so several scrapers with their own
+    settings can run in the same process, see `vo_scraper.py`.
+    """
+
+    def __init__(self):
+        # For web requests
+        self.cookie_jar = requests.cookies.RequestsCookieJar()
+
+        # Whether there is a user to answer prompts, otherwise errors are raised as `ScraperError`
+        self.interactive = True
+        # Function `(lecture_link, protection)` returning `(username, password)` for protected lectures
+        self.credentials_callback = None
+
+        # Video sources collected from all lectures
+        self.video_src_collection = list()
+
+        # For stats
+        self.link_counter = 0
+        self.download_counter = 0
+        self.skip_counter = 0
+        self.duplicate_counter = 0
+        self.stall_counter = 0
+        self.changed_counter = 0
+        self.stats_lock = threading.Lock()
+
+        # Where the recordings are stored
+        self.directory_prefix = DEFAULT_DIRECTORY_PREFIX
+
+        # Local index of downloaded recordings, see `LIBRARY_INDEX_FILE`
+        self.library_index = None
+        # When the library index was loaded, to notice changes made by other scraper processes
+        self.library_index_time = 0
+        self.library_lock = threading.RLock()
+        self.rescan_library = False
+        # Changes are written once at the end of the run instead of for every recording, see `write_library_index()`
+        self.library_index_changed = False
+
+        # Only download part of the recordings: `(start, end)` in seconds, where end is `None` for the rest of the recording
+        self.clip = None
+
+        # Maximum size of all recordings in `directory_prefix`, older recordings are deleted to stay within it
+        self.storage_budget = 0
+        # Which recordings to delete first: `oldest`, `least-accessed` or `lowest-priority`
+        self.eviction_policy = "oldest"
+        # Download recordings again that were deleted to stay within the budget
+        self.include_evicted = False
+        self.evict_counter = 0
+        # The library as `enforce_storage_budget()` will see it at the end of the run, see `would_be_evicted()`
+        self.storage_plan = None
+
+        # Other scrapers in the local network to download recordings from before using the upstream server
+        self.peers = list()
+        self.unreachable_peers = set()
+        self.peer_counter = 0
+        # Server making the library available to other scrapers, see `--serve-library`
+        self.library_server = None
+        # Check downloaded recordings for changes upstream and download changed ones again
+        self.refresh_changed = False
+        self.changed_recordings = set()
+
+        # Default quality
+        self.video_quality = "HD"
+
+        # Which streams of a recording to download, empty means only the first one
+        self.stream_selection = ""
+
+        # Lower the quality of recordings to stay within these budgets, see `apply_quality_budgets()`
+        self.lecture_budget = 0
+        self.time_budget = 0
+        self.expected_speed = 0
+        # Lower qualities each recording could be downloaded in as `(quality, link, file name)`, lowest first
+        self.quality_options = dict()
+        # Sizes of recordings by link, as far as they were asked for, see `get_content_length()`
+        self.recording_sizes = dict()
+
+        # How to store recordings that already exist elsewhere in the library: {hardlink, symlink, reflink}
+        self.link_duplicates = ""
+
+        # When to consider a recording as already downloaded: {exact, any, at-least, upgrade}
+        self.existing_quality = "exact"
+
+        # Format of the exported download plan: {jsonl, aria2c, wget}
+        self.export_format = "jsonl"
+
+        # For recordings that are only available as HLS or DASH stream
+        self.segment_workers = 8
+
+        # Commands to run on downloaded recordings, list of `(lecture pattern, quality, command)` tuples
+        self.post_process_commands = list()
+        self.post_process_workers = 2
+        self.post_process_executor = None
+        self.post_process_futures = list()
+        # Recordings finish in several threads at the same time
+        self.post_process_lock = threading.Lock()
+
+        # Catalogue of all lectures and episodes seen so far, see `EPISODE_CATALOGUE_FILE`
+        self.episode_catalogue = None
+        self.episode_catalogue_lock = threading.Lock()
+        # Set if the catalogue could not be opened, e.g. because SQLite lacks full text search
+        self.episode_catalogue_failed = False
+        # Filters for selecting episodes from the catalogue, see `--match`, `--since` and `--lecturer`
+        self.episode_match = ""
+        self.episode_since = ""
+        self.episode_lecturer = ""
+
+        # Journal of the downloads of this run, see `--recover`
+        self.run_journal = None
+        self.run_journal_file = ""
+        self.run_journal_lock = None
+        self.run_journal_write_lock = threading.Lock()
+        # Journals of interrupted runs that are continued by the current run, with their locks
+        self.recovered_journals = list()
+        # Where downloads of interrupted runs can continue, by file name: `{"part": ..., "offset": ..., ...}`
+        self.resume_points = dict()
+        # Headers stored in a plan executed with `--execute-plan`, by link, see `get_download_headers()`
+        self.plan_headers = dict()
+
+        # Only process a part of the lectures: `(shard number, number of shards)`, counting from 1
+        self.shard = None
+        # Whether to split by `lecture` or by `episode`
+        self.shard_by = "lecture"
+
+        # Machine readable log of what the scraper does, see `emit_event()`
+        self.event_log = None
+        self.event_log_lock = threading.Lock()
+        # Only print errors
+        self.quiet = False
+        # File to print messages to, `None` for stdout
+        self.output = None
+
+        # How recordings are written to disk, see `RecordingFile`
+        self.preallocate = False
+        self.drop_cache = False
+        # `none`, `close` or `interval` to sync every `fsync_interval` bytes
+        self.fsync_policy = "none"
+        self.fsync_interval = 0
+
+        # Local directory to download to before moving the recordings to `directory_prefix`
+        self.staging_dir = ""
+        self.move_queue = None
+        self.mover_thread = None
+
+        # Upper limit of connections per host, the actual number adapts to how the host responds
+        self.max_connections = 8
+        self.concurrency_controllers = dict()
+        self.concurrency_controllers_lock = threading.Lock()
+        # Downloads slower than this (in bytes per second) for `stall_timeout` seconds are restarted, 0 disables it
+        self.min_speed = 16 * 1024
+        self.stall_timeout = 60
+        # `(priority, weight)` of lectures by their directory, see `DownloadScheduler`
+        self.lecture_priorities = dict()
+
+        # Pausing and limiting all downloads, see `--control` and `--limit-rate`
+        self.downloads_paused = False
+        # Set when the run is interrupted, downloads in other threads stop at their next chunk
+        self.downloads_stopped = False
+        self.rate_limit = 0
+        self.transfer_condition = threading.Condition()
+        # Counts how often downloads were resumed, so the time they were paused doesn't count as stalled
+        self.resume_counter = 0
+        # Bytes that may still be received within the rate limit, and when this was last updated
+        self.rate_allowance = 0
+        self.rate_allowance_time = 0
+        # Bytes received per second during the last `RATE_WINDOW` seconds as `[second, bytes]`, by `second % RATE_WINDOW`
+        self.received_buckets = [[0, 0] for _ in range(RATE_WINDOW)]
+        self.received_lock = threading.Lock()
+        # When the first data was received, as the rate can't be averaged over a longer time
+        self.first_received_time = None
+        # Downloads in progress by file name: `{"episode": ..., "file": RecordingFile, "started": ...}`
+        self.active_transfers = dict()
+        self.finished_transfers = 0
+        self.finished_transfer_bytes = 0
+        # The last errors, shown by the control endpoint
+        self.recent_errors = collections.deque(maxlen=20)
+        # Scheduler of the downloads currently running
+        self.download_scheduler = None
+        # Server answering requests to the control endpoint, see `--control`
+        self.control_server = None
+
+        # Lines of the progress bars currently shown
+        self.progress_positions = set()
+        # Without tqdm, parallel downloads share one status line instead of a progress bar each
+        self.status_line_time = 0
+
+        # Source links to be written to `file_to_print_src_to` at the end of the run
+        self.printed_src_links = list()
+
+        # Boolean flags
+        self.download_all = False
+        self.download_latest = False
+        self.verbose = False
+        self.print_src = False
+        self.hide_progress_bar = False
+
+        # Location of text files
+        self.file_to_print_src_to = ""
+        self.export_plan_file = ""
+        self.history_file = ""
+
+
 class bcolors:
     INFO = "\033[94m"
     ERROR = "\033[91m"
@@ -115,7 +411,7 @@ Usage example:
     """Found a bug?
 Run `python3 vo-scraper.py --bug` or report it directly at https://github.com/gteufelberger/vo-scraper/issues""",
     # --destination DESTINATION
-    f"""Did you know? By default the vo-scraper saves the dowloaded recordings in \"{directory_prefix}<name of lecture>\"
+    f"""Did you know? By default the vo-scraper saves the dowloaded recordings in \"{DEFAULT_DIRECTORY_PREFIX}<name of lecture>\"
 If you want the recordings saved in a different place you can use the parameter `--destination <your folder>`
 For example:
 
@@ -180,7 +476,7 @@ If you don't like this, you can pass the parameter `--skip-update-check` to prev
 # ===============================================================
 
 
-def print_information(str, type="info", verbose_only=False):
+def print_information(state, str, type="info", verbose_only=False):
     """Print provided string.
 
     Keyword arguments:
@@ -190,25 +486,95 @@ def print_information(str, type="info", verbose_only=False):
     """
     global print_type_dict
 
+    # Remember errors for the control endpoint
+    if type == "error":
+        state.recent_errors.append({"time": time.time(), "message": str})
+
+    if state.quiet and type != "error":
+        return
+
     if not verbose_only:
-        if type == "info" and not verbose:
+        if type == "info" and not state.verbose:
             # Print without tag
-            print(str)
+            print(str, file=state.output)
         else:
             # Print with tag
-            print(print_type_dict[type], str)
-    elif verbose:
+            print(print_type_dict[type], str, file=state.output)
+    elif state.verbose:
         # Always print with tag
-        print(print_type_dict[type], str)
+        print(print_type_dict[type], str, file=state.output)
+
+
+def open_event_log(state, target):
+    """Opens the event log
+
+    Keyword arguments:
+    target -- A file name, `-` for stdout or `fd:N` for an already open file descriptor
+    """
+
+    if target == "-":
+        state.event_log = os.fdopen(
+            sys.stdout.fileno(), "w", buffering=EVENT_LOG_BUFFER_SIZE, closefd=False
+        )
+    elif target.startswith("fd:"):
+        state.event_log = os.fdopen(
+            int(target[3:]), "w", buffering=EVENT_LOG_BUFFER_SIZE, closefd=False
+        )
+    else:
+        state.event_log = open(target, "a", buffering=EVENT_LOG_BUFFER_SIZE)
 
 
-def get_credentials(user, passw):
+def close_event_log(state):
+    """Writes out all buffered events and closes the event log"""
+
+    with state.event_log_lock:
+        if state.event_log is not None:
+            state.event_log.close()
+            state.event_log = None
+
+
+def emit_event(state, event, **fields):
+    """Writes an event as a line of JSON to the event log, if one was opened with `--event-log`
+
+    Keyword arguments:
+    event  -- Type of the event, e.g. `download_finished`
+    fields -- Details of the event
+    """
+    if state.event_log is None:
+        return
+    line = json.dumps(
+        {"time": round(time.time(), 3), "event": event, **fields}, ensure_ascii=False
+    )
+    with state.event_log_lock:
+        if state.event_log is not None:
+            state.event_log.write(line + "\n")
+
+
+class ScraperError(Exception):
+    """Raised instead of prompting or exiting when the scraper is used without a user, see `ScraperState.interactive`"""
+
+
+class LoginError(ScraperError):
+    """Raised when the credentials of a protected lecture are missing or wrong"""
+
+
+def get_credentials(state, user, passw, vo_link="", protection=""):
     """Gets user credentials and returns them
 
     Keyword arguments:
-    user  -- The username passed from a text file
-    passw -- The password passed from a text file
+    user       -- The username passed from a text file
+    passw      -- The password passed from a text file
+    vo_link    -- The link to the lecture, passed to `credentials_callback`
+    protection -- The type of login the lecture requires, passed to `credentials_callback`
     """
+    if (not user or not passw) and state.credentials_callback:
+        callback_user, callback_passw = state.credentials_callback(vo_link, protection)
+        user = user or callback_user
+        passw = passw or callback_passw
+    if not state.interactive:
+        if not user or not passw:
+            raise LoginError(f"No username or password given for {vo_link}")
+        return (user, passw)
     if not user:
         user = input("Enter your username: ")
     if not passw:
@@ -217,7 +583,7 @@ def get_credentials(user, passw):
     return (user, passw)
 
 
-def acquire_login_cookie(protection, vo_link, user, passw):
+def acquire_login_cookie(state, protection, vo_link, user, passw):
     """Gets login-cookie by sending user credentials to login server
 
     Keyword arguments:
@@ -235,9 +601,9 @@ def acquire_login_cookie(protection, vo_link, user, passw):
     cookie_jar = requests.cookies.RequestsCookieJar()
 
     if protection == "ETH":
-        print_information("This lecture requires a NETHZ login")
+        print_information(state, "This lecture requires a NETHZ login")
         while True:
-            (user, passw) = get_credentials(user, passw)
+            (user, passw) = get_credentials(state, user, passw, vo_link, protection)
 
             # Setup headers and content to send
             headers = {"User-Agent": USER_AGENT, "Referer": vo_link + ".html"}
@@ -252,15 +618,21 @@ def acquire_login_cookie(protection, vo_link, user, passw):
             r = requests.post(
                 "https://video.ethz.ch/j_security_check", headers=headers, data=data
             )
-            print_information(f"Received response: {r.status_code}", verbose_only=True)
+            print_information(
+                state, f"Received response: {r.status_code}", verbose_only=True
+            )
 
             # Put login cookie in cookie_jar
             cookie_jar = r.cookies
             if cookie_jar:
                 break
             else:
+                if not state.interactive:
+                    raise LoginError(f"Wrong username or password for {vo_link}")
                 print_information(
-                    "Wrong username or password, please try again", type="warning"
+                    state,
+                    "Wrong username or password, please try again",
+                    type="warning",
                 )
                 (user, passw) = (
                     "",
@@ -269,11 +641,12 @@ def acquire_login_cookie(protection, vo_link, user, passw):
 
     elif protection == "PWD":
         print_information(
-            "This lecture requires a CUSTOM login. Check the lecture's website or your emails for the credentials."
+            state,
+            "This lecture requires a CUSTOM login. Check the lecture's website or your emails for the credentials.",
         )
 
         while True:
-            (user, passw) = get_credentials(user, passw)
+            (user, passw) = get_credentials(state, user, passw, vo_link, protection)
 
             # Setup headers and content to send
             headers = {"Referer": vo_link + ".html", "User-Agent": USER_AGENT}
@@ -289,8 +662,12 @@ def acquire_login_cookie(protection, vo_link, user, passw):
             if cookie_jar:
                 break
             else:
+                if not state.interactive:
+                    raise LoginError(f"Wrong username or password for {vo_link}")
                 print_information(
-                    "Wrong username or password, please try again", type="warning"
+                    state,
+                    "Wrong username or password, please try again",
+                    type="warning",
                 )
                 (user, passw) = (
                     "",
@@ -298,19 +675,23 @@ def acquire_login_cookie(protection, vo_link, user, passw):
                 )  # Reset passed credentials to not end up in loop if wrong credentials were passed
 
     else:
-        print_information(f"Unknown protection type: {protection}", type="error")
+        if not state.interactive:
+            raise ScraperError(f"Unknown protection type {protection} of {vo_link}")
+        print_information(state, f"Unknown protection type: {protection}", type="error")
         print_information(
-            "Please report this to the project's GitHub issue page!", type="error"
+            state,
+            "Please report this to the project's GitHub issue page!",
+            type="error",
         )
-        report_bug()
+        report_bug(state)
 
-    print_information("Acquired cookie:", verbose_only=True)
-    print_information(cookie_jar, verbose_only=True)
+    print_information(state, "Acquired cookie:", verbose_only=True)
+    print_information(state, cookie_jar, verbose_only=True)
 
     return cookie_jar
 
 
-def pretty_print_episodes(vo_json_data, selected):
+def pretty_print_episodes(state, vo_json_data, selected):
     """Prints the episode numbers that match `selected`"""
     # Get length of longest strings for nice formatting when printing
     nr_length = len(" Nr.")
@@ -326,26 +707,28 @@ def pretty_print_episodes(vo_json_data, selected):
 
     # Print header
     print_information(
+        state,
         " Nr."
         + " | "
         + "Date".ljust(max_date_length)
         + " | "
         + "Name".ljust(max_title_length)
         + " | "
-        + "Lecturer".ljust(max_lecturer_length)
+        + "Lecturer".ljust(max_lecturer_length),
     )
 
     # Print the selected episodes
     for episode_nr in selected:
         episode = vo_json_data["episodes"][episode_nr]
         print_information(
+            state,
             f"{episode_nr:3d}".ljust(nr_length)
             + " | "
             + episode["createdAt"][:10].ljust(max_date_length)
             + " | "
             + episode["title"].ljust(max_title_length)
             + " | "
-            + str(episode["createdBy"]).ljust(max_lecturer_length)
+            + str(episode["createdBy"]).ljust(max_lecturer_length),
         )
 
 
@@ -427,13 +810,23 @@ def resolution_from_input(resolution):
     return int(str(resolution).replace("p", ""))
 
 
-def get_video_src_link_for_resolution(video_json_data, video_quality):
+def quality_height(quality):
+    """Returns the vertical resolution of a quality as used in file names, 0 for audio only recordings"""
+    if quality == "audio":
+        return 0
+    return resolution_from_input(quality)
+
+
+def get_video_src_link_for_resolution(
+    state, video_json_data, video_quality, stream_nr=0
+):
     """
     Takes the JSON data and requested quality and returns the direct link to that video stream.
 
     Keyword arguments:
     video_json_data -- JSON structure containing information about the requested recording
     video_quality   -- The desired video quality
+    stream_nr       -- Index of the stream to use if the recording has several (e.g. presenter and slides)
 
     Returns:
     Direct link to the corresponding video stream based on desired resolution as well as the
@@ -442,10 +835,11 @@ def get_video_src_link_for_resolution(video_json_data, video_quality):
     # Put available resolutions in list for sorting by video quality
     counter = 0
     resolutions = list()
-    print_information("Available resolutions:", verbose_only=True)
-    for vid_version in video_json_data["streams"][0]["sources"]["mp4"]:
+    print_information(state, "Available resolutions:", verbose_only=True)
+    for vid_version in video_json_data["streams"][stream_nr]["sources"]["mp4"]:
         resolutions.append((counter, vid_version["res"]["w"], vid_version["res"]["h"]))
         print_information(
+            state,
             f"{str(counter)}: {vid_version['res']['w']:4}x{vid_version['res']['h']:4}",
             verbose_only=True,
         )
@@ -473,373 +867,5584 @@ def get_video_src_link_for_resolution(video_json_data, video_quality):
         # Show a warning if the we cannot return the requested resolution
         if min_value[1] != 0:
             print_information(
-                f"Requested quality {video_quality} not available, downloading {video_json_data['streams'][0]['sources']['mp4'][quality_index]['res']['h']}p instead",
+                state,
+                f"Requested quality {video_quality} not available, downloading {video_json_data['streams'][stream_nr]['sources']['mp4'][quality_index]['res']['h']}p instead",
                 type="warning",
             )
 
     # Save actual quality of video for filename
     video_quality = (
         str(
-            video_json_data["streams"][0]["sources"]["mp4"][
+            video_json_data["streams"][stream_nr]["sources"]["mp4"][
                 resolutions[quality_index][0]
             ]["res"]["h"]
         )
         + "p"
     )
 
-    video_src_link = video_json_data["streams"][0]["sources"]["mp4"][
+    video_src_link = video_json_data["streams"][stream_nr]["sources"]["mp4"][
         resolutions[quality_index][0]
     ]["src"]
     return video_src_link, video_quality
 
 
-def vo_scrapper(vo_link, video_quality, user, passw):
+def get_mp4_variants(video_json_data, stream_nr=0):
+    """Returns all MP4 versions of a stream as `(quality, link)` tuples, lowest quality first
+
+    Keyword arguments:
+    video_json_data -- JSON structure containing information about the requested recording
+    stream_nr       -- Index of the stream
     """
-    Gets the list of all available videos for a lecture.
-    Allows user to select multiple videos.
-    Returns the selected episodes
+    variants = dict()
+    for vid_version in video_json_data["streams"][stream_nr]["sources"]["mp4"]:
+        variants.setdefault(f"{vid_version['res']['h']}p", vid_version["src"])
+    return sorted(variants.items(), key=lambda variant: quality_height(variant[0]))
+
+
+def fit_into_budget(options, budget):
+    """Picks a quality for each recording so that they fit into a budget
+
+    First picks the highest quality that all recordings can be downloaded in, then uses what is left of
+    the budget to improve single recordings, cheapest improvement first.
 
     Keyword arguments:
-    vo_link -- The link to the lecture
-    user    -- The username passed from a text file
-    passw   -- The password passed from a text file
+    options -- For each recording, a list of `(height, size)` tuples, lowest quality first
+    budget  -- The budget in bytes
 
     Returns:
-    A tuple consisting out of the filename and the video_src_link
+    The index of the chosen option for each recording
     """
-    global USER_AGENT
-    global download_all
-    global download_latest
-
-    global quality_dict
-    global cookie_jar
 
-    global SERIES_METADATA_SUFFIX
-    global VIDEO_INFO_PREFIX
-    global directory_prefix
+    def pick(max_height):
+        return [
+            max(
+                (i for i, (height, _) in enumerate(recording) if height <= max_height),
+                default=0,
+            )
+            for recording in options
+        ]
 
-    global link_counter
+    def total(choice):
+        return sum(options[nr][i][1] for nr, i in enumerate(choice))
+
+    heights = sorted({height for recording in options for height, _ in recording})
+    choice = pick(0)
+    for height in heights:
+        candidate = pick(height)
+        if total(candidate) > budget:
+            break
+        choice = candidate
+
+    # Spend the rest of the budget on single recordings
+    left = budget - total(choice)
+    while True:
+        upgrades = [
+            (options[nr][i + 1][1] - options[nr][i][1], nr)
+            for nr, i in enumerate(choice)
+            if i + 1 < len(options[nr])
+        ]
+        upgrades = [upgrade for upgrade in upgrades if upgrade[0] <= left]
+        if not upgrades:
+            return choice
+        cost, nr = min(upgrades)
+        choice[nr] += 1
+        left -= cost
 
-    # Remove `.html` file extension
-    vo_link = vo_link.replace(".html", "")
 
-    # Remove `www.` prefix from domain name
-    # If in link used as a referer during the authentication it causes a failure
-    vo_link = vo_link.replace("www.", "")
+def measure_download_speed(state, video_src_link):
+    """Downloads the beginning of a recording to estimate the download speed
 
-    # Get lecture metadata for episode list
-    r = requests.get(
-        vo_link + SERIES_METADATA_SUFFIX, headers={"User-Agent": USER_AGENT}
-    )
-    # Try reading the received data as JSON.
-    # If it fails, e.g. due to no lectures having been uploaded yet, we skip this lecture
+    Returns:
+    The speed in bytes per second or `None` if it couldn't be measured
+    """
+    headers = get_download_headers(state, video_src_link)
+    headers["Range"] = f"bytes=0-{SPEED_PROBE_SIZE - 1}"
     try:
-        vo_json_data = json.loads(r.text)
-    except json.decoder.JSONDecodeError:
+        start = time.monotonic()
+        with adaptive_request(
+            state, "download", video_src_link, headers=headers, stream=True, timeout=30
+        ) as r:
+            r.raise_for_status()
+            received = 0
+            for data in r.iter_content(chunk_size=64 * 1024):
+                received += len(data)
+                if received >= SPEED_PROBE_SIZE:
+                    break
+        duration = time.monotonic() - start
+    except requests.exceptions.RequestException as e:
         print_information(
-            f"Could not get metadata for {vo_link}.html, skipping", type="warning"
+            state, f"Could not measure download speed: {e}", type="warning"
         )
-        return list()  # Return an empty list
+        return None
+    return received / duration if received and duration > 0 else None
 
-    # Increase counter for stats
-    link_counter += len(vo_json_data["episodes"])
 
-    # Print available lectures
-    pretty_print_episodes(vo_json_data, range(len(vo_json_data["episodes"])))
+def apply_quality_budgets(state, collection):
+    """Lowers the quality of recordings so that they fit into `--lecture-budget` and `--time-budget`
 
-    # Get video selections
-    choice = list()
-    if download_all:
-        # Add all available videos to the selected
-        choice = list(range(len(vo_json_data["episodes"])))
-    elif download_latest:
-        # Only add newest video to the selected
-        choice = [0]
-    else:
-        # Let user pick videos
-        try:
-            choice = get_user_choice(max(range(len(vo_json_data["episodes"]))))
-        except KeyboardInterrupt:
-            print()
-            print_information("Exiting...")
-            sys.exit()
+    The sizes of all qualities are requested from the server. Recordings that are already downloaded in
+    one of the qualities keep it.
 
-    # Print the user's choice
-    if not choice:
-        print_information("No videos selected")
-        return list()  # Nothing to do anymore
-    else:
-        print_information("You selected:")
-        pretty_print_episodes(vo_json_data, choice)
-    print()
+    Keyword arguments:
+    collection -- List of `(file_name, video_src_link, episode_name)` tuples, as returned by `vo_scrapper()`
 
-    # Check whether lecture requires login and get credentials if necessary
-    print_information("Protection: " + vo_json_data["protection"], verbose_only=True)
-    if vo_json_data["protection"] != "NONE":
-        try:
-            cookie_jar.update(
-                acquire_login_cookie(vo_json_data["protection"], vo_link, user, passw)
+    Returns:
+    The collection with the links and file names of the chosen qualities
+    """
+    if not (state.lecture_budget or state.time_budget) or not state.quality_options:
+        return collection
+
+    # Get the size of every quality
+    sizes = get_content_lengths(
+        state,
+        sorted(
+            {
+                link
+                for file_name, _, _ in collection
+                for _, link, _ in state.quality_options.get(file_name, list())
+            }
+        ),
+    )
+
+    # `(height, size, link, file name)` of the qualities to choose from for each recording
+    recordings = list()
+    for file_name, video_src_link, episode_name in collection:
+        options = [
+            (quality_height(quality), sizes.get(link), link, option_file)
+            for quality, link, option_file in state.quality_options.get(
+                file_name, list()
             )
-        except KeyboardInterrupt:
-            print()
+        ]
+        existing = [
+            option
+            for option in options
+            if os.path.isfile(remove_illegal_characters(option[3]))
+        ]
+        if existing:
+            # Already downloaded recordings don't need to be downloaded again, but take up space
+            height, _, link, option_file = existing[-1]
+            size = os.path.getsize(remove_illegal_characters(option_file))
+            options = [(height, size, link, option_file)]
+        elif not options or None in (option[1] for option in options):
+            # We don't know the size, so we can't do anything about it
+            options = [(0, 0, video_src_link, file_name)]
+        recordings.append((options, bool(existing), episode_name))
+
+    choice = [len(options) - 1 for options, _, _ in recordings]
+
+    # Each lecture has its own budget
+    if state.lecture_budget:
+        lectures = dict()
+        for nr, (file_name, _, _) in enumerate(collection):
+            lectures.setdefault(os.path.dirname(file_name), list()).append(nr)
+        for lecture, numbers in lectures.items():
+            lecture_choice = fit_into_budget(
+                [[option[:2] for option in recordings[nr][0]] for nr in numbers],
+                state.lecture_budget,
+            )
+            for nr, i in zip(numbers, lecture_choice):
+                choice[nr] = i
+            if (
+                sum(recordings[nr][0][choice[nr]][1] for nr in numbers)
+                > state.lecture_budget
+            ):
+                print_information(
+                    state,
+                    f"{os.path.basename(lecture)} doesn't fit into the budget even in the lowest quality",
+                    type="warning",
+                )
+
+    # All downloads together need to finish in time
+    if state.time_budget:
+        to_download = [
+            nr for nr, recording in enumerate(recordings) if not recording[1]
+        ]
+        speed = state.expected_speed
+        if not speed and to_download:
+            speed = measure_download_speed(state, recordings[to_download[0]][0][-1][2])
+            if speed:
+                print_information(
+                    state, f"Measured download speed: {speed / 1024 / 1024:.2f} MiB/s"
+                )
+        if speed:
+            # The lecture budgets are upper limits
+            download_choice = fit_into_budget(
+                [
+                    [option[:2] for option in recordings[nr][0][: choice[nr] + 1]]
+                    for nr in to_download
+                ],
+                speed * state.time_budget,
+            )
+            for nr, i in zip(to_download, download_choice):
+                choice[nr] = i
+
+    # Use the chosen qualities
+    budget_collection = list()
+    for (file_name, video_src_link, episode_name), (options, _, _), i in zip(
+        collection, recordings, choice
+    ):
+        _, _, link, option_file = options[i]
+        if option_file != file_name:
             print_information(
-                "Keyboard interrupt detected, skipping lecture", type="warning"
+                state,
+                f"Lowered quality to stay within the budget: {option_file}",
+                verbose_only=True,
             )
-            return
+        budget_collection.append((option_file, link, episode_name))
 
-    local_video_src_collection = list()
+    total_size = sum(options[i][1] for (options, _, _), i in zip(recordings, choice))
+    print_information(
+        state,
+        f"Selected {total_size / 1024 / 1024 / 1024:.2f} GiB of recordings to stay within the budget",
+    )
+    return budget_collection
 
-    # Collect links for download
-    for item_nr in choice:
-        # Get link to video metadata json file
-        item = vo_json_data["episodes"][item_nr]
-        video_info_link = VIDEO_INFO_PREFIX + item["id"]
 
-        # Print it for debbuging
-        print_information(video_info_link, verbose_only=True)
+def select_closest_variant(variants, video_quality):
+    """Picks the variant of a streaming manifest closest to the requested quality
 
-        # Download the video metadata file
-        # Use login-cookie if provided otherwise make request without cookie
-        if cookie_jar:
-            r = requests.get(
-                video_info_link, cookies=cookie_jar, headers={"User-Agent": USER_AGENT}
-            )
-        else:
-            r = requests.get(video_info_link, headers={"User-Agent": USER_AGENT})
-        if r.status_code == 401:
-            # The lecture requires a login
-            print_information(
-                "Received 401 response. The following lecture requires a valid login cookie:",
-                type="error",
-            )
-            item = vo_json_data["episodes"][item_nr]
-            print_information(
-                f"{item_nr:2d} {item['title']} {str(item['createdBy'])} {item['createdAt'][:10]}",
-                type="error",
-            )
-            print_information(
-                "Make sure your token is valid. See README.md on how to acquire it.",
-                type="error",
-            )
-            print()
-            continue
-        video_json_data = json.loads(r.text)
+    Keyword arguments:
+    variants      -- List of `(height, bandwidth, variant)` tuples, height is 0 for audio only variants
+    video_quality -- The desired video quality
 
-        # Get video src url from json based on resolution
-        try:
-            video_src_link, available_video_quality = get_video_src_link_for_resolution(
-                video_json_data, video_quality
-            )
-        except IndexError:
-            # Audio only lectures error out, skip them
-            print_information(
-                f"Couldn't get download link for recording {item_nr}. Skipping",
-                type="warning",
+    Returns:
+    The chosen `(height, bandwidth, variant)` tuple
+    """
+    # Sort by quality: highest -> lowest
+    variants = sorted(variants, key=lambda t: (t[0], t[1]), reverse=True)
+    if video_quality == "highest":
+        return variants[0]
+    if video_quality == "lowest":
+        return variants[-1]
+    video_quality_parsed = resolution_from_input(video_quality)
+    return min(variants, key=lambda t: abs(video_quality_parsed - t[0]))
+
+
+def parse_hls_attributes(line):
+    """Parses the attribute list of an HLS tag like `#EXT-X-STREAM-INF:BANDWIDTH=1,RESOLUTION=2x3`"""
+    attributes = dict()
+    for match in re.finditer(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(":", 1)[-1]):
+        attributes[match.group(1)] = match.group(2).strip('"')
+    return attributes
+
+
+def get_hls_variants(master_link):
+    """Gets the variants listed in an HLS master playlist
+
+    Keyword arguments:
+    master_link -- Link to the playlist
+
+    Returns:
+    List of `(height, bandwidth, link to media playlist)` tuples.
+    If the link points to a media playlist, it is returned as only variant.
+    """
+    r = requests.get(master_link, headers={"User-Agent": USER_AGENT}, timeout=30)
+    r.raise_for_status()
+
+    variants = list()
+    attributes = None
+    for line in r.text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF"):
+            attributes = parse_hls_attributes(line)
+        elif line and not line.startswith("#") and attributes is not None:
+            resolution = attributes.get("RESOLUTION", "0x0").split("x")
+            variants.append(
+                (
+                    int(resolution[-1]),
+                    int(attributes.get("BANDWIDTH", 0)),
+                    urljoin(master_link, line),
+                )
             )
-            continue
+            attributes = None
 
-        lecture_title = vo_json_data["title"]
-        episode_title = vo_json_data["episodes"][item_nr]["title"]
+    if not variants:
+        # Not a master playlist
+        variants.append((0, 0, master_link))
+    return variants
 
-        # If video and lecture title overlap, remove lecture title from video title
-        episode_title = episode_title.replace(lecture_title, "")
 
-        # Extract episode name before adding the date to episode_title
-        episode_name = item["createdAt"][:10] + " " + lecture_title + episode_title
+def get_hls_segments(media_link):
+    """Gets the segments listed in an HLS media playlist
 
-        # Append date
-        episode_title = item["createdAt"][:10] + episode_title
+    Keyword arguments:
+    media_link -- Link to the playlist
 
-        # Generate a pseudo hash by using part of the filename of the online version (which appears to be a UUID)
-        pseudo_hash = video_src_link.replace(
-            "https://oc-vp-dist-downloads.ethz.ch/mh_default_org/oaipmh-mmp/", ""
-        )[:8]
-        print_information(pseudo_hash, verbose_only=True)
+    Returns:
+    List of `(link, byte range)` tuples in playback order, where the byte range is `None` or `(start, end)`.
+    The initialization segment, if any, is the first element.
+    """
+    r = requests.get(media_link, headers={"User-Agent": USER_AGENT}, timeout=30)
+    r.raise_for_status()
+
+    segments = list()
+    byte_range = None
+    next_offset = 0
+    for line in r.text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-KEY"):
+            if parse_hls_attributes(line).get("METHOD", "NONE") != "NONE":
+                raise MediaError("Encrypted HLS streams are not supported")
+        elif line.startswith("#EXT-X-MAP"):
+            attributes = parse_hls_attributes(line)
+            init_range = None
+            if "BYTERANGE" in attributes:
+                length, _, offset = attributes["BYTERANGE"].partition("@")
+                init_range = (int(offset or 0), int(offset or 0) + int(length) - 1)
+            segments.append((urljoin(media_link, attributes["URI"]), init_range))
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            length, _, offset = line.split(":", 1)[1].partition("@")
+            start = int(offset) if offset else next_offset
+            byte_range = (start, start + int(length) - 1)
+            next_offset = start + int(length)
+        elif line and not line.startswith("#"):
+            segments.append((urljoin(media_link, line), byte_range))
+            byte_range = None
+    return segments
+
+
+def parse_iso_duration(duration):
+    """Turns an ISO 8601 duration like `PT1H2M3.5S` into seconds"""
+    match = re.match(
+        r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?", duration or ""
+    )
+    if not match:
+        return 0
+    days, hours, minutes, seconds = (float(x) if x else 0 for x in match.groups())
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
 
-        # Filename is `directory/<video date (YYYY-MM-DD)><leftovers from video title>_<quality>-<pseudo_hash>.mp4`
-        directory = directory_prefix + lecture_title + os.sep
-        file_name = (
-            f"{directory}{episode_title}_{available_video_quality}-{pseudo_hash}.mp4"
-        )
-        print_information(file_name, verbose_only=True)
 
-        local_video_src_collection.append((file_name, video_src_link, episode_name))
+def get_dash_manifest(mpd_link):
+    """Downloads a DASH manifest and returns its root element with the XML namespace removed from all tags"""
+    r = requests.get(mpd_link, headers={"User-Agent": USER_AGENT}, timeout=30)
+    r.raise_for_status()
+    root = ElementTree.fromstring(r.content)
+    for element in root.iter():
+        element.tag = element.tag.split("}")[-1]
+    return root
 
-    return local_video_src_collection
 
+def get_dash_variants(mpd_link):
+    """Gets the representations listed in a DASH manifest
 
-def downloader(file_name, video_src_link, episode_name):
-    """Downloads the video and gives progress information
+    Only manifests with a single adaptation set (e.g. audio only recordings) can be turned into a single file
+    without remuxing, so manifests with separate audio and video are rejected.
 
     Keyword arguments:
-    file_name      -- Name of the file to write the data to
-    video_src_link -- The link to download the data from
-    episode_name   -- Name of the episode
+    mpd_link -- Link to the manifest
+
+    Returns:
+    List of `(height, bandwidth, link to manifest#representation id)` tuples
     """
-    global download_counter
-    global skip_counter
+    period = get_dash_manifest(mpd_link).find("Period")
+    adaptation_sets = period.findall("AdaptationSet") if period is not None else []
+    if len(adaptation_sets) != 1:
+        raise ValueError(
+            f"DASH manifests with {len(adaptation_sets)} adaptation sets are not supported"
+        )
 
-    global print_src
-    global file_to_print_src_to
+    return [
+        (
+            int(representation.get("height", 0)),
+            int(representation.get("bandwidth", 0)),
+            f"{mpd_link}#{representation.get('id')}",
+        )
+        for representation in adaptation_sets[0].findall("Representation")
+    ]
 
-    # Check for print_src flag
-    if print_src:
-        # Print to file if given
-        if file_to_print_src_to:
-            print_information(
-                f"Printing {video_src_link} to file: {file_to_print_src_to}",
-                verbose_only=True,
+
+def get_dash_segments(variant_link):
+    """Gets the segments of a representation in a DASH manifest
+
+    Keyword arguments:
+    variant_link -- Link to the manifest with the id of the representation as fragment, e.g. `<link>.mpd#1`
+
+    Returns:
+    List of `(link, byte range)` tuples in playback order, see `get_hls_segments()`
+    """
+    mpd_link, _, representation_id = variant_link.partition("#")
+    root = get_dash_manifest(mpd_link)
+    period = root.find("Period")
+    adaptation_set = period.find("AdaptationSet")
+    representation = [
+        r
+        for r in adaptation_set.findall("Representation")
+        if r.get("id") == representation_id
+    ][0]
+
+    # Resolve relative links through all levels of the manifest
+    base_link = mpd_link
+    for element in (root, period, adaptation_set, representation):
+        if element.find("BaseURL") is not None:
+            base_link = urljoin(base_link, element.find("BaseURL").text.strip())
+
+    def fill_template(template, number=None, segment_time=None):
+        """Replaces the `$...$` identifiers in a segment template"""
+        values = {
+            "RepresentationID": representation_id,
+            "Bandwidth": representation.get("bandwidth", ""),
+            "Number": number,
+            "Time": segment_time,
+        }
+
+        def replace(match):
+            value = values[match.group(1)]
+            return match.group(2) % value if match.group(2) else str(value)
+
+        template = re.sub(
+            r"\$(RepresentationID|Bandwidth|Number|Time)(%0\d+d)?\$", replace, template
+        )
+        return urljoin(base_link, template.replace("$$", "$"))
+
+    segment_template = representation.find("SegmentTemplate")
+    if segment_template is None:
+        segment_template = adaptation_set.find("SegmentTemplate")
+    segment_list = representation.find("SegmentList")
+
+    segments = list()
+    if segment_template is not None:
+        media = segment_template.get("media")
+        if segment_template.get("initialization"):
+            segments.append(
+                (fill_template(segment_template.get("initialization")), None)
             )
-            with open(file_to_print_src_to, "a") as f:
-                f.write(video_src_link + "\n")
+        number = int(segment_template.get("startNumber", 1))
+        timeline = segment_template.find("SegmentTimeline")
+        if timeline is not None:
+            segment_time = 0
+            for entry in timeline.findall("S"):
+                segment_time = int(entry.get("t", segment_time))
+                for _ in range(int(entry.get("r", 0)) + 1):
+                    segments.append((fill_template(media, number, segment_time), None))
+                    segment_time += int(entry.get("d"))
+                    number += 1
         else:
-            print_information(video_src_link)
-    # Otherwise download video
+            segment_duration = int(segment_template.get("duration")) / int(
+                segment_template.get("timescale", 1)
+            )
+            total_duration = parse_iso_duration(
+                period.get("duration") or root.get("mediaPresentationDuration")
+            )
+            # Round up to include the last, shorter segment
+            for i in range(int(-(-total_duration // segment_duration))):
+                segments.append((fill_template(media, number + i), None))
+    elif segment_list is not None:
+        initialization = segment_list.find("Initialization")
+        if initialization is not None:
+            segments.append(
+                (urljoin(base_link, initialization.get("sourceURL", "")), None)
+            )
+        for segment_url in segment_list.findall("SegmentURL"):
+            segments.append((urljoin(base_link, segment_url.get("media", "")), None))
     else:
-        print_information(f"Video source: {video_src_link}", verbose_only=True)
+        # The whole representation is a single file
+        segments.append((base_link, None))
+    return segments
 
-        # Check history file (if one has been specified) whether episode has already been downloaded
-        if history_file:
+
+def get_manifest_src_link_for_resolution(
+    state, video_json_data, video_quality, stream_nr=0
+):
+    """
+    Fallback for recordings without MP4 sources: Takes the JSON data and requested quality and returns
+    the link to the closest HLS or DASH variant.
+
+    Keyword arguments:
+    video_json_data -- JSON structure containing information about the requested recording
+    video_quality   -- The desired video quality
+    stream_nr       -- Index of the stream to use
+
+    Returns:
+    Link to the variant, its quality (e.g. `720p` or `audio`) and the file extension to save it with
+
+    Raises `IndexError` if the stream has no usable manifest.
+    """
+    sources = video_json_data["streams"][stream_nr].get("sources", dict())
+    for manifest_type in ("hls", "dash"):
+        manifests = sources.get(manifest_type) or list()
+        if isinstance(manifests, dict):
+            manifests = [manifests]
+        for manifest in manifests:
             try:
-                with open(history_file, "r") as file:
-                    if video_src_link in [
-                        line.rstrip("\n") for line in file.readlines()
-                    ]:
-                        print(
-                            f"download skipped - file already recorded in history: {episode_name}"
-                        )
-                        skip_counter += 1
-                        return
-                    else:
-                        print_information(
-                            "Link has not yet been recorded in history file",
-                            verbose_only=True,
-                        )
-            except FileNotFoundError:
+                if manifest_type == "hls":
+                    variants = get_hls_variants(manifest["src"])
+                else:
+                    variants = get_dash_variants(manifest["src"])
+                if not variants:
+                    continue
+                height, _, variant_link = select_closest_variant(
+                    variants, video_quality
+                )
+
+                # HLS segments are either MPEG-TS or fragmented MP4
+                extension = "mp4"
+                if manifest_type == "hls":
+                    segments = get_hls_segments(variant_link)
+                    if segments and urlparse(segments[-1][0]).path.endswith(".ts"):
+                        extension = "ts"
+            except (
+                requests.exceptions.RequestException,
+                ValueError,
+                KeyError,
+                ElementTree.ParseError,
+            ) as e:
                 print_information(
-                    f"No history file found at specified location: {history_file}",
-                    type="warning",
+                    state,
+                    f"Could not use {manifest_type} manifest {manifest.get('src')}: {e}",
                     verbose_only=True,
                 )
+                continue
 
-        # Create directory for video if it does not already exist
-        directory = os.path.dirname(os.path.abspath(file_name))
-        if not os.path.isdir(directory):
-            os.makedirs(directory)
+            quality = f"{height}p" if height else "audio"
             print_information(
-                f"This folder was generated: {directory}", verbose_only=True
+                state,
+                f"Using {manifest_type} stream in {quality}: {variant_link}",
+                verbose_only=True,
             )
+            return variant_link, quality, extension
+    raise IndexError("No usable manifest found")
+
+
+def get_stream_name(stream, stream_nr):
+    """Guesses what a stream of a recording shows
+
+    Keyword arguments:
+    stream    -- JSON structure of the stream
+    stream_nr -- Index of the stream in the recording
+
+    Returns:
+    `presenter`, `presentation` or `stream<stream_nr>` if it can't be determined
+    """
+    # Look at the stream's type as well as the file names of its sources
+    hints = [str(stream.get(key, "")) for key in ("type", "flavor", "role")]
+    hints += [
+        os.path.basename(source.get("src", ""))
+        for source in stream.get("sources", dict()).get("mp4", list())
+    ]
+    for hint in hints:
+        for name in ("presenter", "presentation"):
+            if name in hint.lower():
+                return name
+    return f"stream{stream_nr}"
+
+
+def select_streams(state, video_json_data, stream_selection):
+    """Returns the indices of the streams of a recording matching the user's selection
+
+    Keyword arguments:
+    video_json_data  -- JSON structure containing information about the requested recording
+    stream_selection -- Comma separated list of stream indices and/or names (`presenter`, `presentation`),
+                        or `all`. If empty only the first stream is selected.
+    """
+    streams = video_json_data.get("streams", list())
+    if not stream_selection:
+        return [0]
+    if stream_selection == "all":
+        return list(range(len(streams)))
+
+    selected = list()
+    for item in stream_selection.split(","):
+        item = item.strip().lower()
+        if item.isnumeric():
+            matches = [int(item)] if int(item) < len(streams) else []
         else:
+            matches = [
+                stream_nr
+                for stream_nr, stream in enumerate(streams)
+                if get_stream_name(stream, stream_nr) == item
+            ]
+        if not matches:
             print_information(
-                f"This folder already exists: {directory}", verbose_only=True
+                state, f"No stream matching `{item}` found", verbose_only=True
             )
+        selected += [stream_nr for stream_nr in matches if stream_nr not in selected]
+    return selected
 
-        # Check if file already exists
-        if os.path.isfile(file_name):
-            print_information(f"download skipped - file already exists: {episode_name}")
-            skip_counter += 1
-        # Otherwise download it
-        else:
-            # cf.: https://stackoverflow.com/questions/15644964/python-progress-bar-and-downloads
-            with open(file_name + ".part", "wb") as f:
-                response = requests.get(video_src_link, stream=True)
-                total_length = response.headers.get("content-length")
 
-                print_information(
-                    f"Downloading {episode_name} ({int(total_length) / 1024 / 1024:.2f} MiB)"
-                )
+def parse_shard(value):
+    """Parses the value of `--shard` in the form of `i/N`
 
-                if total_length is None or HIDE_PROGRESS_BAR:
-                    # We received no content length header...
-                    # ... or user wanted to hide the progress bar
-                    f.write(response.content)
-                else:
-                    # Download file and show progress bar
-                    total_length = int(total_length)
-
-                    try:
-                        # Module with better progressbar
-                        from tqdm import tqdm
-
-                        # Setup progressbar
-                        pbar = tqdm(
-                            unit="B",
-                            unit_scale=True,
-                            unit_divisor=1024,
-                            total=total_length,
-                        )
-                        pbar.clear()
+    Returns:
+    A tuple `(i, N)`
+    """
+    try:
+        number, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected the form i/N, got `{value}`")
+    if count < 1 or not 1 <= number <= count:
+        raise argparse.ArgumentTypeError(
+            f"shard number must be between 1 and {count}, got `{value}`"
+        )
+    return number, count
+
+
+def in_shard(state, key):
+    """Checks whether a lecture or episode belongs to this machine's shard
+
+    The decision only depends on the key, so every machine running with the same number of shards
+    agrees on which shard a lecture or episode belongs to.
+
+    Keyword arguments:
+    key -- The lecture link or episode id
+    """
+    if not state.shard:
+        return True
+    number, count = state.shard
+    digest = hashlib.sha1(key.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % count == number - 1
+
+
+def normalize_lecture_link(link):
+    """Turns different ways of writing the same lecture link into the same string"""
+    return link.strip().replace(".html", "").replace("www.", "").rstrip("/")
+
+
+def get_pseudo_hash(video_src_link):
+    """Returns the first 8 characters of the recording's UUID, taken from its source link
+
+    The UUID is the same for all resolutions of a recording and for all lectures it is published in.
+    Links without a UUID get the first 8 characters of their SHA-1 hash instead.
+    """
+    if video_src_link.startswith(VIDEO_SRC_PREFIX):
+        return video_src_link.replace(VIDEO_SRC_PREFIX, "")[:8]
+    # Streaming manifests are served from a different location, look for the UUID instead
+    match = re.search(r"[0-9a-f]{8}-[0-9a-f]{4}-", video_src_link)
+    if match:
+        return match.group(0)[:8]
+    # Without a UUID, at least keep the names of different recordings apart
+    return hashlib.sha1(video_src_link.encode()).hexdigest()[:8]
+
+
+def parse_recording_file_name(file_name):
+    """Extracts quality and pseudo hash from the name of a downloaded recording
+
+    Keyword arguments:
+    file_name -- A file name in the form of `<episode title>_<quality>-<pseudo_hash>[-<stream name>][-<clip>].<mp4 or ts>`
+
+    Returns:
+    A tuple `(quality, pseudo_hash)` or `None` if the name does not match.
+    For additional streams and clips of a recording, the stream name and clip are part of the pseudo hash.
+    """
+    match = re.search(r"_(\d+p|audio)-([^-_.]{8}(?:-[^-_.]+)*)\.(?:mp4|ts)$", file_name)
+    if not match:
+        return None
+    return match.group(1), match.group(2)
+
+
+class ConcurrencyController:
+    """Limits the number of connections to a host and adapts the limit to how the host responds
+
+    Like TCP congestion control (AIMD), the limit grows by one connection per measuring window as long as
+    the throughput keeps rising without the requests getting slower, and is halved whenever the host
+    answers with 429 or 5xx or a request times out.
+
+    Keyword arguments:
+    name      -- Name of the controller shown in messages, e.g. `download video.ethz.ch`
+    max_limit -- Upper limit of connections
+    """
+
+    def __init__(self, state, name, max_limit):
+        self.state = state
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.limit = 1
+        self.active = 0
+        self.condition = threading.Condition()
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.last_throughput = 0
+        self.base_latency = None
+        self.start_window(time.monotonic())
+
+    def start_window(self, now):
+        """Starts a new measuring window"""
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_latencies = list()
+        # Whether there were more requests than allowed connections, otherwise a higher limit doesn't help
+        self.window_saturated = False
+
+    def acquire(self):
+        """Waits until a connection is available"""
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    break
+                if wait <= 0:
+                    self.window_saturated = True
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            self.active += 1
+            if self.active >= self.limit:
+                self.window_saturated = True
+
+    def release(self):
+        """Makes a connection available again"""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def record(self, amount=0, latency=None):
+        """Records received data and adjusts the limit at the end of each measuring window
+
+        Keyword arguments:
+        amount  -- Number of bytes received
+        latency -- Seconds until the response arrived
+        """
+        with self.condition:
+            self.window_bytes += amount
+            if latency is not None:
+                self.window_latencies.append(latency)
+
+            now = time.monotonic()
+            if now - self.window_start < ADAPTIVE_WINDOW:
+                return
+
+            throughput = self.window_bytes / (now - self.window_start)
+            latency_flat = True
+            if self.window_latencies:
+                latency = sorted(self.window_latencies)[len(self.window_latencies) // 2]
+                if self.base_latency is None or latency < self.base_latency:
+                    self.base_latency = latency
+                latency_flat = latency <= 2 * self.base_latency + 0.05
+
+            if (
+                self.window_saturated
+                and latency_flat
+                and throughput > 1.05 * self.last_throughput
+                and self.limit < self.max_limit
+            ):
+                self.limit += 1
+                print_information(
+                    self.state,
+                    f"Increased connections for {self.name} to {self.limit}",
+                    verbose_only=True,
+                )
+                self.condition.notify_all()
+            elif not latency_flat and self.limit > 1:
+                # Requests queue up at the host
+                self.limit -= 1
+                print_information(
+                    self.state,
+                    f"Decreased connections for {self.name} to {self.limit} as requests got slower",
+                    verbose_only=True,
+                )
+            self.last_throughput = throughput
+            self.start_window(now)
+
+    def throttle(self, pause):
+        """Halves the limit after the host signalled that it is overloaded
+
+        Keyword arguments:
+        pause -- Seconds to wait before sending the next request to the host
+        """
+        with self.condition:
+            now = time.monotonic()
+            # Requests sent before the last decrease still used the old limit, so only decrease once per window
+            if now - self.last_decrease >= ADAPTIVE_WINDOW:
+                self.limit = max(1, self.limit // 2)
+                self.last_decrease = now
+                print_information(
+                    self.state,
+                    f"Host is overloaded, decreased connections for {self.name} to {self.limit}",
+                    verbose_only=True,
+                )
+            self.paused_until = max(self.paused_until, now + pause)
+            self.last_throughput = 0
+            self.start_window(now)
+
+
+def get_concurrency_controller(state, stage, link):
+    """Returns the controller limiting the connections to the host of a link
+
+    Keyword arguments:
+    stage -- `metadata` or `download`, each has its own limit
+    link  -- The link to send a request to
+    """
+    key = (stage, urlparse(link).netloc)
+    with state.concurrency_controllers_lock:
+        if key not in state.concurrency_controllers:
+            state.concurrency_controllers[key] = ConcurrencyController(
+                state, " ".join(key), state.max_connections
+            )
+        return state.concurrency_controllers[key]
+
+
+def get_retry_after(response):
+    """Returns the seconds the server asks us to wait before trying again or `None`"""
+    try:
+        return min(float(response.headers.get("retry-after", "")), 300)
+    except ValueError:
+        return None
+
+
+@contextlib.contextmanager
+def adaptive_request(state, stage, link, method="GET", **kwargs):
+    """Sends a request once a connection to the host is available, retrying if the host is overloaded
+
+    The connection is counted as in use until the `with` block is left. When streaming the response,
+    report the received data to the controller returned by `get_concurrency_controller()`.
+
+    Keyword arguments:
+    stage  -- `metadata` or `download`, see `get_concurrency_controller()`
+    link   -- The link to send the request to
+    method -- The HTTP method
+    kwargs -- Passed on to `requests.request()`
+
+    Yields:
+    The response
+    """
+    controller = get_concurrency_controller(state, stage, link)
+    for attempt in range(THROTTLE_RETRIES + 1):
+        controller.acquire()
+        try:
+            start = time.monotonic()
+            try:
+                response = requests.request(method, link, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if attempt == THROTTLE_RETRIES:
+                    raise
+                print_information(
+                    state,
+                    f"Retrying {link} after error: {e}",
+                    type="warning",
+                    verbose_only=True,
+                )
+                emit_event(state, "retry", link=link, reason=str(e))
+                controller.throttle(2**attempt)
+                continue
+
+            if attempt < THROTTLE_RETRIES and (
+                response.status_code == 429 or response.status_code >= 500
+            ):
+                print_information(
+                    state,
+                    f"Retrying {link} after response {response.status_code}",
+                    type="warning",
+                    verbose_only=True,
+                )
+                emit_event(
+                    state, "retry", link=link, reason=f"HTTP {response.status_code}"
+                )
+                controller.throttle(get_retry_after(response) or 2**attempt)
+                response.close()
+                continue
+
+            latency = time.monotonic() - start
+            if kwargs.get("stream"):
+                controller.record(latency=latency)
+            else:
+                controller.record(len(response.content), latency)
+            with response:
+                yield response
+            return
+        finally:
+            controller.release()
+
+
+def get_video_info(state, video_info_link):
+    """Downloads the metadata of an episode
+
+    Keyword arguments:
+    video_info_link -- Link to the metadata json file of the episode
+
+    Returns:
+    The response or `None` if the request failed
+    """
+    # Use login-cookie if provided otherwise make request without cookie
+    try:
+        with adaptive_request(
+            state,
+            "metadata",
+            video_info_link,
+            cookies=state.cookie_jar if state.cookie_jar else None,
+            headers={"User-Agent": USER_AGENT},
+            timeout=30,
+        ) as r:
+            return r
+    except requests.exceptions.RequestException as e:
+        print_information(
+            state, f"Could not get metadata from {video_info_link}: {e}", type="warning"
+        )
+        return None
+
+
+def vo_scrapper(state, vo_link, video_quality, user, passw, episodes=None):
+    """
+    Gets the list of all available videos for a lecture.
+    Allows user to select multiple videos.
+    Returns the selected episodes
+
+    Keyword arguments:
+    vo_link  -- The link to the lecture
+    user     -- The username passed from a text file
+    passw    -- The password passed from a text file
+    episodes -- Numbers of the episodes to get as shown by the scraper, instead of asking the user
+
+    Returns:
+    A tuple consisting out of the filename and the video_src_link
+    """
+    global USER_AGENT
+
+    global quality_dict
+
+    global SERIES_METADATA_SUFFIX
+    global VIDEO_INFO_PREFIX
+
+    # Remove `.html` file extension
+    vo_link = vo_link.replace(".html", "")
+
+    # Remove `www.` prefix from domain name
+    # If in link used as a referer during the authentication it causes a failure
+    vo_link = vo_link.replace("www.", "")
+
+    # Get lecture metadata for episode list
+    with adaptive_request(
+        state,
+        "metadata",
+        vo_link + SERIES_METADATA_SUFFIX,
+        headers={"User-Agent": USER_AGENT},
+        timeout=30,
+    ) as r:
+        series_metadata = r.text
+    # Try reading the received data as JSON.
+    # If it fails, e.g. due to no lectures having been uploaded yet, we skip this lecture
+    try:
+        vo_json_data = json.loads(series_metadata)
+    except json.decoder.JSONDecodeError:
+        print_information(
+            state,
+            f"Could not get metadata for {vo_link}.html, skipping",
+            type="warning",
+        )
+        emit_event(state, "lecture_failed", lecture=vo_link, reason="no metadata")
+        return list()  # Return an empty list
+
+    # Increase counter for stats
+    state.link_counter += len(vo_json_data["episodes"])
+
+    # Print available lectures
+    pretty_print_episodes(state, vo_json_data, range(len(vo_json_data["episodes"])))
+
+    # Remember the lecture and its episodes for `--match`, `--since` and `--lecturer`
+    add_to_episode_catalogue(state, vo_link, vo_json_data)
+
+    # Get video selections
+    choice = list()
+    if episode_filters_set(state):
+        # Select the episodes matching the filters
+        matching_ids = {
+            episode["id"] for _, episode in search_episode_catalogue(state, vo_link)
+        }
+        choice = [
+            item_nr
+            for item_nr, item in enumerate(vo_json_data["episodes"])
+            if item["id"] in matching_ids
+        ]
+    elif episodes is not None:
+        # Only add the requested episodes that exist
+        choice = sorted(
+            {nr for nr in episodes if 0 <= nr < len(vo_json_data["episodes"])}
+        )
+    elif state.download_all:
+        # Add all available videos to the selected
+        choice = list(range(len(vo_json_data["episodes"])))
+    elif state.download_latest:
+        # Only add newest video to the selected
+        choice = [0]
+    else:
+        # Let user pick videos
+        try:
+            choice = get_user_choice(max(range(len(vo_json_data["episodes"]))))
+        except KeyboardInterrupt:
+            if not state.interactive:
+                raise
+            print(file=state.output)
+            print_information(state, "Exiting...")
+            sys.exit()
+
+    return get_episode_recordings(state, vo_link, vo_json_data, choice, user, passw)
+
+
+def get_episode_recordings(state, vo_link, vo_json_data, choice, user, passw):
+    """Gets the recordings of the selected episodes of a lecture
+
+    Keyword arguments:
+    vo_link      -- The link to the lecture without `.html`
+    vo_json_data -- The series metadata of the lecture
+    choice       -- The numbers of the selected episodes
+    user         -- The username passed from a text file
+    passw        -- The password passed from a text file
+
+    Returns:
+    A list of `(file_name, video_src_link, episode_name)` tuples
+    """
+    # Only keep the episodes belonging to this shard
+    if state.shard and state.shard_by == "episode":
+        choice = [
+            item_nr
+            for item_nr in choice
+            if in_shard(state, vo_json_data["episodes"][item_nr]["id"])
+        ]
+        print_information(
+            state,
+            f"{len(choice)} of the selected episodes belong to shard {state.shard[0]}/{state.shard[1]}",
+            verbose_only=True,
+        )
+
+    # Print the user's choice
+    if not choice:
+        print_information(state, "No videos selected")
+        emit_event(
+            state,
+            "lecture_resolved",
+            lecture=vo_link,
+            title=vo_json_data["title"],
+            episodes=len(vo_json_data["episodes"]),
+            selected=0,
+            recordings=0,
+        )
+        return list()  # Nothing to do anymore
+    else:
+        print_information(state, "You selected:")
+        pretty_print_episodes(state, vo_json_data, choice)
+    if not state.quiet:
+        print(file=state.output)
+
+    # Check whether lecture requires login and get credentials if necessary
+    print_information(
+        state, "Protection: " + vo_json_data["protection"], verbose_only=True
+    )
+    if vo_json_data["protection"] != "NONE":
+        try:
+            state.cookie_jar.update(
+                acquire_login_cookie(
+                    state, vo_json_data["protection"], vo_link, user, passw
+                )
+            )
+        except KeyboardInterrupt:
+            print(file=state.output)
+            print_information(
+                state, "Keyboard interrupt detected, skipping lecture", type="warning"
+            )
+            return list()
+
+    local_video_src_collection = list()
+
+    # Get links to video metadata json files
+    video_info_links = [
+        VIDEO_INFO_PREFIX + vo_json_data["episodes"][item_nr]["id"]
+        for item_nr in choice
+    ]
+
+    # Download the video metadata files in parallel
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=state.max_connections
+    ) as executor:
+        responses = list(
+            executor.map(functools.partial(get_video_info, state), video_info_links)
+        )
+
+    # Collect links for download
+    for item_nr, video_info_link, r in zip(choice, video_info_links, responses):
+        item = vo_json_data["episodes"][item_nr]
+
+        # Print it for debbuging
+        print_information(state, video_info_link, verbose_only=True)
+
+        if r is None:
+            emit_event(
+                state,
+                "episode_skipped",
+                lecture=vo_link,
+                episode=item["title"],
+                reason="metadata_error",
+            )
+            continue
+        if r.status_code == 401:
+            # The lecture requires a login
+            print_information(
+                state,
+                "Received 401 response. The following lecture requires a valid login cookie:",
+                type="error",
+            )
+            item = vo_json_data["episodes"][item_nr]
+            print_information(
+                state,
+                f"{item_nr:2d} {item['title']} {str(item['createdBy'])} {item['createdAt'][:10]}",
+                type="error",
+            )
+            print_information(
+                state,
+                "Make sure your token is valid. See README.md on how to acquire it.",
+                type="error",
+            )
+            emit_event(
+                state,
+                "episode_skipped",
+                lecture=vo_link,
+                episode=item["title"],
+                reason="login_required",
+            )
+            if not state.quiet:
+                print(file=state.output)
+            continue
+        video_json_data = json.loads(r.text)
+
+        lecture_title = vo_json_data["title"]
+        episode_title = vo_json_data["episodes"][item_nr]["title"]
+
+        # If video and lecture title overlap, remove lecture title from video title
+        episode_title = episode_title.replace(lecture_title, "")
+
+        # Extract episode name before adding the date to episode_title
+        episode_name = item["createdAt"][:10] + " " + lecture_title + episode_title
+
+        # Append date
+        episode_title = item["createdAt"][:10] + episode_title
+
+        for stream_nr in select_streams(state, video_json_data, state.stream_selection):
+            # Get video src url from json based on resolution
+            extension = "mp4"
+            try:
+                video_src_link, available_video_quality = (
+                    get_video_src_link_for_resolution(
+                        state, video_json_data, state.video_quality, stream_nr
+                    )
+                )
+            except (IndexError, KeyError, ValueError):
+                # Audio only lectures have no MP4 sources, try HLS or DASH instead
+                try:
+                    video_src_link, available_video_quality, extension = (
+                        get_manifest_src_link_for_resolution(
+                            state, video_json_data, state.video_quality, stream_nr
+                        )
+                    )
+                except (IndexError, KeyError):
+                    print_information(
+                        state,
+                        f"Couldn't get download link for recording {item_nr}. Skipping",
+                        type="warning",
+                    )
+                    emit_event(
+                        state,
+                        "episode_skipped",
+                        lecture=vo_link,
+                        episode=episode_name,
+                        reason="no_download_link",
+                    )
+                    continue
+
+            # Generate a pseudo hash by using part of the filename of the online version (which appears to be a UUID)
+            pseudo_hash = get_pseudo_hash(video_src_link)
+            print_information(state, pseudo_hash, verbose_only=True)
+
+            # Name additional streams after what they show
+            stream_suffix = ""
+            stream_episode_name = episode_name
+            if stream_nr != 0:
+                stream_name = get_stream_name(
+                    video_json_data["streams"][stream_nr], stream_nr
+                )
+                stream_suffix = "-" + stream_name
+                stream_episode_name = f"{episode_name} ({stream_name})"
+
+            # Clips are stored next to the whole recording
+            if state.clip and not is_manifest_link(video_src_link):
+                stream_suffix += get_clip_suffix(state)
+                stream_episode_name += f" [{format_time(state.clip[0])}-{format_time(state.clip[1]) if state.clip[1] is not None else 'end'}]"
+
+            # Filename is `directory/<video date (YYYY-MM-DD)><leftovers from video title>_<quality>-<pseudo_hash>[-<stream name>].<extension>`
+            directory = state.directory_prefix + lecture_title + os.sep
+            file_name = f"{directory}{episode_title}_{available_video_quality}-{pseudo_hash}{stream_suffix}.{extension}"
+            print_information(state, file_name, verbose_only=True)
+
+            # Remember the lower qualities in case the recording doesn't fit into the budget
+            if (state.lecture_budget or state.time_budget) and not is_manifest_link(
+                video_src_link
+            ):
+                state.quality_options[file_name] = [
+                    (
+                        quality,
+                        link,
+                        f"{directory}{episode_title}_{quality}-{get_pseudo_hash(link)}{stream_suffix}.{extension}",
+                    )
+                    for quality, link in get_mp4_variants(video_json_data, stream_nr)
+                    if quality_height(quality)
+                    <= quality_height(available_video_quality)
+                ]
+
+            local_video_src_collection.append(
+                (file_name, video_src_link, stream_episode_name)
+            )
+
+    emit_event(
+        state,
+        "lecture_resolved",
+        lecture=vo_link,
+        title=vo_json_data["title"],
+        episodes=len(vo_json_data["episodes"]),
+        selected=len(choice),
+        recordings=len(local_video_src_collection),
+    )
+    return local_video_src_collection
+
+
+def open_episode_catalogue(state):
+    """Opens the episode catalogue inside `directory_prefix`, creating it if necessary
+
+    The catalogue is an SQLite database with a table of lectures, a table of episodes
+    and a full text index over the titles and lecturers of the episodes.
+    """
+
+    if state.episode_catalogue is not None:
+        return state.episode_catalogue
+
+    if not os.path.isdir(state.directory_prefix):
+        os.makedirs(state.directory_prefix)
+
+    catalogue_file = state.directory_prefix + EPISODE_CATALOGUE_FILE
+    # The catalogue is shared by all threads, `episode_catalogue_lock` serializes the access
+    catalogue = sqlite3.connect(catalogue_file, check_same_thread=False)
+    try:
+        with catalogue:
+            catalogue.executescript(
+                """
+            CREATE TABLE IF NOT EXISTS lectures (
+                link TEXT PRIMARY KEY, title TEXT, protection TEXT, updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS episodes (
+                lecture TEXT, id TEXT, title TEXT, lecturer TEXT, created TEXT,
+                PRIMARY KEY (lecture, id)
+            );
+            CREATE INDEX IF NOT EXISTS episodes_by_date ON episodes (created);
+            CREATE VIRTUAL TABLE IF NOT EXISTS episodes_text USING fts5 (
+                lecture UNINDEXED, id UNINDEXED, title, lecturer, lecture_title,
+                tokenize = "unicode61 remove_diacritics 2"
+            );
+            """
+            )
+    except sqlite3.Error:
+        # Don't try again for every lecture
+        catalogue.close()
+        state.episode_catalogue_failed = True
+        raise
+    state.episode_catalogue = catalogue
+    print_information(
+        state, f"Opened episode catalogue {catalogue_file}", verbose_only=True
+    )
+    return state.episode_catalogue
+
+
+def episode_catalogue_used(state):
+    """Returns whether lectures should be stored in the episode catalogue
+
+    The catalogue is only created by runs with `--match`, `--since` or `--lecturer`. Afterwards, all runs
+    downloading to the same directory keep it up to date, except for `--print-src` and `--export-plan`.
+    """
+    if state.episode_catalogue_failed:
+        return False
+    if episode_filters_set(state):
+        return True
+    if state.print_src or state.export_plan_file:
+        return False
+    return state.episode_catalogue is not None or os.path.isfile(
+        state.directory_prefix + EPISODE_CATALOGUE_FILE
+    )
+
+
+def add_to_episode_catalogue(state, vo_link, vo_json_data):
+    """Stores a lecture and all of its episodes in the episode catalogue
+
+    Keyword arguments:
+    vo_link      -- The link to the lecture without `.html`
+    vo_json_data -- The series metadata of the lecture
+    """
+    if not episode_catalogue_used(state):
+        return
+    episodes = [
+        (
+            vo_link,
+            episode["id"],
+            episode["title"],
+            str(episode["createdBy"]),
+            episode["createdAt"],
+        )
+        for episode in vo_json_data["episodes"]
+    ]
+    try:
+        with state.episode_catalogue_lock:
+            catalogue = open_episode_catalogue(state)
+            with catalogue:
+                catalogue.execute(
+                    "INSERT OR REPLACE INTO lectures VALUES (?, ?, ?, ?)",
+                    (
+                        vo_link,
+                        vo_json_data["title"],
+                        vo_json_data["protection"],
+                        time.time(),
+                    ),
+                )
+                # Episodes that were removed from the lecture are removed from the catalogue as well
+                catalogue.execute(
+                    "DELETE FROM episodes_text WHERE lecture = ?", (vo_link,)
+                )
+                catalogue.execute("DELETE FROM episodes WHERE lecture = ?", (vo_link,))
+                catalogue.executemany(
+                    "INSERT INTO episodes VALUES (?, ?, ?, ?, ?)", episodes
+                )
+                catalogue.executemany(
+                    "INSERT INTO episodes_text VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (vo_link, episode_id, title, lecturer, vo_json_data["title"])
+                        for _, episode_id, title, lecturer, _ in episodes
+                    ],
+                )
+    except sqlite3.Error as e:
+        print_information(
+            state, f"Could not update episode catalogue: {e}", type="warning"
+        )
+
+
+def episode_filters_set(state):
+    """Returns whether episodes should be selected with `--match`, `--since` or `--lecturer`"""
+    return bool(state.episode_match or state.episode_since or state.episode_lecturer)
+
+
+def parse_since(value):
+    """Parses a date like `2021-03-01` or a number of days like `14d` into an ISO date"""
+    try:
+        if value.endswith("d"):
+            days = int(value[:-1])
+            return (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Invalid date `{value}`, expected e.g. `2021-03-01` or `14d`"
+        )
+
+
+def search_episode_catalogue(state, vo_link=None):
+    """Finds the episodes in the catalogue matching `--match`, `--since` and `--lecturer`
+
+    Every word of `--match` must appear in the title of the episode, the title of its lecture
+    or its lecturer, and `--lecturer` must be part of the lecturer's name.
+
+    Keyword arguments:
+    vo_link -- Only search the episodes of this lecture, search all lectures if not given
+
+    Returns:
+    A list of `(lecture, episode)` tuples, where `lecture` and `episode` look like in the series metadata
+    """
+    # The reason was already shown when the catalogue couldn't be opened
+    if state.episode_catalogue_failed:
+        return list()
+
+    conditions = list()
+    parameters = list()
+    if state.episode_match:
+        # Quote the words so they are not mistaken for search operators, and also match word beginnings
+        query = " ".join(
+            '"' + word.replace('"', '""') + '"*' for word in state.episode_match.split()
+        )
+        conditions.append(
+            "(episodes.lecture, episodes.id) IN"
+            " (SELECT lecture, id FROM episodes_text WHERE episodes_text MATCH ?)"
+        )
+        parameters.append(query)
+    if state.episode_since:
+        conditions.append("episodes.created >= ?")
+        parameters.append(state.episode_since)
+    if state.episode_lecturer:
+        conditions.append("episodes.lecturer LIKE ?")
+        parameters.append(f"%{state.episode_lecturer}%")
+    if vo_link is not None:
+        conditions.append("episodes.lecture = ?")
+        parameters.append(vo_link)
+
+    try:
+        with state.episode_catalogue_lock:
+            rows = (
+                open_episode_catalogue(state)
+                .execute(
+                    "SELECT lectures.link, lectures.title, lectures.protection,"
+                    " episodes.id, episodes.title, episodes.lecturer, episodes.created"
+                    " FROM episodes JOIN lectures ON lectures.link = episodes.lecture"
+                    + "".join(
+                        (" WHERE " if nr == 0 else " AND ") + condition
+                        for nr, condition in enumerate(conditions)
+                    )
+                    + " ORDER BY lectures.link, episodes.created DESC",
+                    parameters,
+                )
+                .fetchall()
+            )
+    except sqlite3.Error as e:
+        print_information(
+            state, f"Could not search episode catalogue: {e}", type="error"
+        )
+        return list()
+
+    return [
+        (
+            {"link": link, "title": lecture_title, "protection": protection},
+            {
+                "id": episode_id,
+                "title": title,
+                "createdBy": lecturer,
+                "createdAt": created,
+            },
+        )
+        for link, lecture_title, protection, episode_id, title, lecturer, created in rows
+    ]
+
+
+def scrape_episode_catalogue(state):
+    """Gets the recordings of all episodes in the catalogue matching `--match`, `--since` and `--lecturer`
+
+    The series metadata of the lectures is taken from the catalogue instead of being downloaded again.
+
+    Returns:
+    A list of `(file_name, video_src_link, episode_name)` tuples
+    """
+
+    lectures = dict()
+    for lecture, episode in search_episode_catalogue(state):
+        vo_json_data = lectures.setdefault(
+            lecture["link"],
+            {
+                "title": lecture["title"],
+                "protection": lecture["protection"],
+                "episodes": list(),
+            },
+        )
+        vo_json_data["episodes"].append(episode)
+    print_information(
+        state,
+        f"Found {sum(len(data['episodes']) for data in lectures.values())} matching episodes"
+        f" in {len(lectures)} lectures of the episode catalogue",
+    )
+
+    collection = list()
+    for vo_link, vo_json_data in lectures.items():
+        if (
+            state.shard
+            and state.shard_by == "lecture"
+            and not in_shard(state, normalize_lecture_link(vo_link))
+        ):
+            continue
+        print_information(state, vo_json_data["title"])
+        state.link_counter += len(vo_json_data["episodes"])
+        collection += get_episode_recordings(
+            state,
+            vo_link,
+            vo_json_data,
+            list(range(len(vo_json_data["episodes"]))),
+            "",
+            "",
+        )
+        if not state.quiet:
+            print(file=state.output)
+    return collection
+
+
+def load_library_index(state):
+    """Loads the library index from `directory_prefix` if it hasn't been loaded yet
+
+    The index maps the pseudo hash of every recording to the qualities stored on disk:
+    `{"version": 1, "recordings": {pseudo_hash: {quality: {"path": ..., "size": ...}}}}`
+    where `path` is relative to `directory_prefix`.
+    Recordings deleted by `enforce_storage_budget()` are listed under `"evicted"` by their pseudo hash.
+    If no usable index exists the download directory is scanned to build one.
+    """
+
+    if state.library_index is not None:
+        return state.library_index
+
+    state.library_index_time = time.time()
+    index_file = state.directory_prefix + LIBRARY_INDEX_FILE
+    try:
+        with open(index_file, "r") as f:
+            state.library_index = json.load(f)
+        if state.library_index.get("version") != LIBRARY_INDEX_VERSION:
+            print_information(
+                state,
+                f"Library index {index_file} has an outdated format",
+                type="warning",
+            )
+            state.library_index = None
+        else:
+            print_information(
+                state,
+                f"Loaded library index with {len(state.library_index['recordings'])} recordings",
+                verbose_only=True,
+            )
+    except FileNotFoundError:
+        print_information(
+            state, f"No library index found at {index_file}", verbose_only=True
+        )
+    except (json.decoder.JSONDecodeError, AttributeError):
+        print_information(
+            state, f"Library index {index_file} is corrupted", type="warning"
+        )
+        state.library_index = None
+
+    if state.library_index is None or state.rescan_library:
+        scan_library(state)
+    return state.library_index
+
+
+def mark_library_index_changed(state):
+    """Notes that the library index changed, it is written once by `write_library_index()` at the end of the run"""
+
+    state.library_index_changed = True
+
+
+def write_library_index(state):
+    """Writes the library index to `directory_prefix` if it changed since it was last written
+
+    Other scraper processes might have saved their index since we loaded ours, so the index on disk is
+    merged into ours first, see `merge_library_index()`.
+    """
+
+    if state.library_index is None or not state.library_index_changed:
+        return
+
+    if not os.path.isdir(state.directory_prefix):
+        os.makedirs(state.directory_prefix)
+
+    index_file = state.directory_prefix + LIBRARY_INDEX_FILE
+    deadline = time.monotonic() + LIBRARY_INDEX_LOCK_TIMEOUT
+    while True:
+        lock = acquire_file_lock(state, index_file)
+        if lock or time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    if lock is None:
+        print_information(
+            state,
+            f"Could not lock library index {index_file}, saving it anyway",
+            type="warning",
+        )
+
+    try:
+        try:
+            with open(index_file, "r") as f:
+                merge_library_index(state, json.load(f))
+        except FileNotFoundError:
+            pass
+        except (json.decoder.JSONDecodeError, AttributeError, TypeError):
+            print_information(
+                state, f"Library index {index_file} is corrupted", type="warning"
+            )
+
+        # Write to a temporary file first so an interrupted run does not leave a broken index behind
+        temporary_file = f"{index_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(state.library_index, f)
+        os.replace(temporary_file, index_file)
+        state.library_index_changed = False
+        state.library_index_time = time.time()
+    finally:
+        if lock:
+            release_file_lock(lock)
+
+
+def merge_library_index(state, stored_index):
+    """Adds what other scraper processes saved in the library index to ours
+
+    Our own entries win. Recordings of the stored index are only added if their file still exists, and
+    eviction records only if the evicted file wasn't downloaded again since.
+
+    Keyword arguments:
+    stored_index -- The library index read from disk
+    """
+    if stored_index.get("version") != LIBRARY_INDEX_VERSION:
+        return
+
+    recordings = state.library_index["recordings"]
+    for pseudo_hash, qualities in stored_index.get("recordings", dict()).items():
+        for quality, entry in qualities.items():
+            if quality in recordings.get(pseudo_hash, dict()):
+                continue
+            if os.path.isfile(os.path.join(state.directory_prefix, entry["path"])):
+                recordings.setdefault(pseudo_hash, dict())[quality] = entry
+
+    evicted = state.library_index.setdefault("evicted", dict())
+    for pseudo_hash, entry in stored_index.get("evicted", dict()).items():
+        if pseudo_hash in evicted:
+            continue
+        paths = {
+            entry["path"] for entry in recordings.get(pseudo_hash, dict()).values()
+        }
+        if not paths & set(entry.get("paths", list())):
+            evicted[pseudo_hash] = entry
+
+
+def scan_library(state):
+    """Rebuilds the library index by scanning all recordings inside `directory_prefix`"""
+
+    print_information(
+        state, f"Scanning library in {state.directory_prefix}", verbose_only=True
+    )
+
+    # Keep additional information about recordings that are still there
+    old_recordings = (state.library_index or dict()).get("recordings", dict())
+    recordings = dict()
+    for root, _, files in os.walk(state.directory_prefix):
+        for name in files:
+            parsed = parse_recording_file_name(name)
+            if not parsed:
+                continue
+            quality, pseudo_hash = parsed
+            path = os.path.relpath(os.path.join(root, name), state.directory_prefix)
+
+            # Prefer the original copy of a recording over links pointing to it
+            existing = recordings.get(pseudo_hash, dict()).get(quality)
+            if existing and not os.path.islink(
+                os.path.join(state.directory_prefix, existing["path"])
+            ):
+                continue
+
+            entry = old_recordings.get(pseudo_hash, dict()).get(quality, dict())
+            if entry.get("path") != path:
+                entry = dict()
+            entry.update(
+                {"path": path, "size": os.path.getsize(os.path.join(root, name))}
+            )
+            recordings.setdefault(pseudo_hash, dict())[quality] = entry
+
+    state.library_index = {
+        "version": LIBRARY_INDEX_VERSION,
+        "recordings": recordings,
+        # Evicted recordings are not on disk anymore, so they have to be kept from the old index
+        "evicted": (state.library_index or dict()).get("evicted", dict()),
+    }
+    print_information(
+        state, f"Found {len(recordings)} recordings in library", verbose_only=True
+    )
+    mark_library_index_changed(state)
+
+
+def add_to_library_index(state, file_name):
+    """Records a downloaded recording in the library index
+
+    Keyword arguments:
+    file_name -- Path of the recording on disk
+    """
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return
+    quality, pseudo_hash = parsed
+
+    recordings = load_library_index(state)["recordings"]
+    path = os.path.relpath(file_name, state.directory_prefix)
+    entry = recordings.get(pseudo_hash, dict()).get(quality)
+
+    # The recording was downloaded again with `--include-evicted`
+    downloaded_again = state.library_index.get("evicted", dict()).pop(pseudo_hash, None)
+
+    # Keep pointing to the original copy as long as it exists
+    if entry and (
+        entry["path"] == path
+        or os.path.isfile(os.path.join(state.directory_prefix, entry["path"]))
+    ):
+        if downloaded_again:
+            mark_library_index_changed(state)
+        return
+    recordings.setdefault(pseudo_hash, dict())[quality] = {
+        "path": path,
+        "size": os.path.getsize(file_name),
+    }
+    mark_library_index_changed(state)
+
+
+def remove_from_library_index(state, file_name):
+    """Removes a recording that has been deleted from disk from the library index
+
+    Keyword arguments:
+    file_name -- Path of the recording on disk
+    """
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return
+    quality, pseudo_hash = parsed
+
+    recordings = load_library_index(state)["recordings"]
+    entry = recordings.get(pseudo_hash, dict()).get(quality)
+    if entry and entry["path"] == os.path.relpath(file_name, state.directory_prefix):
+        del recordings[pseudo_hash][quality]
+        if not recordings[pseudo_hash]:
+            del recordings[pseudo_hash]
+        mark_library_index_changed(state)
+
+
+def is_evicted(state, file_name):
+    """Returns whether a recording was deleted to stay within `--storage-budget`"""
+    if state.include_evicted or os.path.isfile(file_name):
+        return False
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return False
+    # Don't build an index just to find out that nothing has been evicted
+    if state.library_index is None and not os.path.isfile(
+        state.directory_prefix + LIBRARY_INDEX_FILE
+    ):
+        return False
+    with state.library_lock:
+        return parsed[1] in load_library_index(state).get("evicted", dict())
+
+
+def get_recording_date(name, timestamp):
+    """Returns the recording date from the file name of a recording, or the date of `timestamp` if it has none
+
+    Keyword arguments:
+    name      -- File name of the recording
+    timestamp -- Fallback, usually the time the recording was downloaded
+    """
+    date = name[:10]
+    if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", date):
+        date = time.strftime("%Y-%m-%d", time.localtime(timestamp))
+    return date
+
+
+def get_library_files(state):
+    """Returns all recordings stored inside `directory_prefix`
+
+    Hard links to the same data are grouped together, as their space is only freed once all of them are deleted.
+
+    Returns:
+    A list of dicts with `paths`, `pseudo_hashes`, `size`, `date`, `atime` and `priority`, and a list of symlinks
+    """
+    files = dict()
+    symlinks = list()
+    priorities = {
+        os.path.normpath(lecture): priority
+        for lecture, (priority, _) in state.lecture_priorities.items()
+    }
+    for root, _, names in os.walk(state.directory_prefix):
+        for name in names:
+            path = os.path.join(root, name)
+            parsed = parse_recording_file_name(name)
+            if not parsed:
+                continue
+            try:
+                stat = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if os.path.islink(path):
+                symlinks.append(path)
+                continue
+
+            # Use the recording date from the file name and fall back to the date it was downloaded
+            date = get_recording_date(name, stat.st_mtime)
+            priority = priorities.get(os.path.normpath(root), 0)
+
+            recording = files.setdefault(
+                (stat.st_dev, stat.st_ino),
+                {
+                    "paths": list(),
+                    "pseudo_hashes": set(),
+                    "size": stat.st_size,
+                    "date": date,
+                    "atime": stat.st_atime,
+                    "priority": priority,
+                },
+            )
+            recording["paths"].append(path)
+            recording["pseudo_hashes"].add(parsed[1])
+            recording["date"] = min(recording["date"], date)
+            recording["priority"] = max(recording["priority"], priority)
+    return list(files.values()), symlinks
+
+
+def sort_for_eviction(state, recordings):
+    """Sorts recordings in the order `enforce_storage_budget()` deletes them according to `eviction_policy`
+
+    Keyword arguments:
+    recordings -- List of recordings as returned by `get_library_files()`
+    """
+    if state.eviction_policy == "least-accessed":
+        recordings.sort(key=lambda recording: recording["atime"])
+    elif state.eviction_policy == "lowest-priority":
+        recordings.sort(
+            key=lambda recording: (recording["priority"], recording["date"])
+        )
+    else:
+        recordings.sort(key=lambda recording: recording["date"])
+
+
+def record_eviction(state, evicted, paths, size):
+    """Records deleted recordings in the library index so they are not downloaded again, see `is_evicted()`
+
+    Must only be called while holding `library_lock`
+
+    Keyword arguments:
+    evicted -- The `"evicted"` part of the library index
+    paths   -- Paths of the deleted recording, several if it was hard-linked
+    size    -- Size of the recording in bytes
+    """
+    pseudo_hashes = {parse_recording_file_name(path)[1] for path in paths}
+    for pseudo_hash in pseudo_hashes:
+        evicted[pseudo_hash] = {
+            "paths": [os.path.relpath(path, state.directory_prefix) for path in paths],
+            "size": size,
+            "time": time.time(),
+        }
+
+
+def would_be_evicted(state, file_name, video_src_link, size):
+    """Returns whether `enforce_storage_budget()` would delete a recording again right after it is downloaded
+
+    Compares the recording with the library and the recordings downloaded earlier in the run, so the budget
+    can't make the scraper download recordings only to delete them. Such recordings are recorded as evicted.
+
+    Keyword arguments:
+    file_name      -- Name of the file of the recording
+    video_src_link -- The link to the recording
+    size           -- Size of the recording in bytes, `None` if it isn't known yet
+    """
+
+    # The size of streams and clips isn't known before downloading them
+    parsed = parse_recording_file_name(file_name)
+    if (
+        not state.storage_budget
+        or size is None
+        or not parsed
+        or state.clip
+        or is_manifest_link(video_src_link)
+    ):
+        return False
+
+    with state.library_lock:
+        if state.storage_plan is None:
+            state.storage_plan = get_library_files(state)[0]
+        now = time.time()
+        recording = {
+            "paths": [file_name],
+            "pseudo_hashes": {parsed[1]},
+            "size": size,
+            "date": get_recording_date(os.path.basename(file_name), now),
+            "atime": now,
+            "priority": state.lecture_priorities.get(
+                os.path.dirname(file_name), (0, 1)
+            )[0],
+        }
+        # A recording downloaded again replaces the old file
+        recordings = [
+            other
+            for other in state.storage_plan
+            if os.path.abspath(file_name)
+            not in [os.path.abspath(path) for path in other["paths"]]
+        ]
+        recordings.append(recording)
+        sort_for_eviction(state, recordings)
+        total_size = sum(other["size"] for other in recordings)
+        for other in recordings:
+            if total_size <= state.storage_budget:
+                break
+            if other is recording:
+                # As if it was downloaded and deleted, so it's skipped like other evicted recordings
+                record_eviction(
+                    state,
+                    load_library_index(state).setdefault("evicted", dict()),
+                    [file_name],
+                    size,
+                )
+                mark_library_index_changed(state)
+                return True
+            total_size -= other["size"]
+        state.storage_plan = recordings
+    return False
+
+
+def skip_evicted_download(state, file_name, episode_name):
+    """Notes that a recording isn't downloaded because of `would_be_evicted()`
+
+    Keyword arguments:
+    file_name    -- Name of the file of the recording
+    episode_name -- Name of the episode
+    """
+
+    print_information(
+        state,
+        f"download skipped - recording would be evicted right away to stay within the storage budget: {episode_name}",
+    )
+    emit_event(
+        state,
+        "episode_skipped",
+        file=file_name,
+        episode=episode_name,
+        reason="storage_budget",
+    )
+    with state.stats_lock:
+        state.skip_counter += 1
+    write_journal(state, "done", file=file_name)
+
+
+def enforce_storage_budget(state):
+    """Deletes recordings according to `eviction_policy` until all of them fit into `storage_budget`
+
+    Deleted recordings are recorded in the library index so they are not downloaded again, see `is_evicted()`.
+    Nothing is deleted if the run didn't download anything, e.g. because it only exported a plan.
+    """
+
+    if (
+        not state.storage_budget
+        or state.print_src
+        or state.export_plan_file
+        or not state.download_counter
+        or not os.path.isdir(state.directory_prefix)
+    ):
+        return
+
+    with state.library_lock:
+        evicted = load_library_index(state).setdefault("evicted", dict())
+        recordings, symlinks = get_library_files(state)
+        total_size = sum(recording["size"] for recording in recordings)
+        print_information(
+            state,
+            f"Library uses {total_size / 1024**3:.2f} GiB of {state.storage_budget / 1024**3:.2f} GiB",
+            verbose_only=True,
+        )
+        if total_size <= state.storage_budget:
+            return
+
+        sort_for_eviction(state, recordings)
+        freed = 0
+        for recording in recordings:
+            if total_size - freed <= state.storage_budget:
+                break
+            removed = list()
+            try:
+                for path in recording["paths"]:
+                    os.remove(path)
+                    removed.append(path)
+            except OSError as e:
+                print_information(
+                    state, f"Could not delete {path}: {e}", type="warning"
+                )
+            for path in removed:
+                remove_from_library_index(state, path)
+                print_information(state, f"Evicted {path}", verbose_only=True)
+                emit_event(
+                    state,
+                    "evicted",
+                    file=path,
+                    bytes=recording["size"],
+                    policy=state.eviction_policy,
+                )
+            # Don't download the deleted paths again, even if others could not be deleted
+            record_eviction(state, evicted, removed, recording["size"])
+            # The space is only freed once all hard links are deleted
+            if len(removed) < len(recording["paths"]):
+                continue
+            freed += recording["size"]
+            with state.stats_lock:
+                state.evict_counter += 1
+
+        # Symlinks to deleted recordings are of no use anymore
+        for path in symlinks:
+            if not os.path.exists(path):
+                os.remove(path)
+                remove_from_library_index(state, path)
+
+        mark_library_index_changed(state)
+        write_library_index(state)
+        print_information(
+            state,
+            f"Evicted {state.evict_counter} recordings ({freed / 1024 / 1024:.2f} MiB) to stay within the storage budget",
+        )
+        if total_size - freed > state.storage_budget:
+            print_information(
+                state,
+                "The library is still larger than the storage budget",
+                type="warning",
+            )
+
+
+def get_fingerprint(response, video_src_link):
+    """Returns what identifies the version of a recording on the server
+
+    Keyword arguments:
+    response       -- Response to a request for the recording
+    video_src_link -- The link to the recording
+    """
+    length = response.headers.get("content-length")
+    return {
+        "link": video_src_link,
+        "etag": response.headers.get("etag"),
+        "length": int(length) if length else None,
+        "last_modified": response.headers.get("last-modified"),
+    }
+
+
+def get_stored_fingerprint(state, file_name):
+    """Returns the fingerprint of a downloaded recording stored in the library index or `None`"""
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return None
+    quality, pseudo_hash = parsed
+    entry = (
+        load_library_index(state)["recordings"].get(pseudo_hash, dict()).get(quality)
+    )
+    return entry.get("fingerprint") if entry else None
+
+
+def set_fingerprint(state, file_name, fingerprint):
+    """Stores the fingerprint of a downloaded recording in the library index
+
+    The change is not noted, call `mark_library_index_changed()` afterwards
+
+    Keyword arguments:
+    file_name   -- Path of the recording on disk
+    fingerprint -- See `get_fingerprint()`
+    """
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return
+    quality, pseudo_hash = parsed
+    entry = (
+        load_library_index(state)["recordings"].get(pseudo_hash, dict()).get(quality)
+    )
+    if entry is None:
+        return
+    entry["fingerprint"] = fingerprint
+    # The recording might have been replaced by a new version
+    if entry["path"] == os.path.relpath(file_name, state.directory_prefix):
+        entry["size"] = os.path.getsize(file_name)
+
+
+def check_for_change(state, file_name, video_src_link, stored):
+    """Asks the server whether a downloaded recording changed since it was downloaded
+
+    Keyword arguments:
+    file_name      -- Path of the recording on disk
+    video_src_link -- The link to the recording
+    stored         -- The stored fingerprint of the recording, if any
+
+    Returns:
+    A tuple `(changed, new fingerprint or None)`
+    """
+    # Let the server tell us if nothing changed
+    headers = get_download_headers(state, video_src_link)
+    if stored and stored.get("link") == video_src_link:
+        if stored.get("etag"):
+            headers["If-None-Match"] = stored["etag"]
+        if stored.get("last_modified"):
+            headers["If-Modified-Since"] = stored["last_modified"]
+
+    try:
+        with adaptive_request(
+            state,
+            "metadata",
+            video_src_link,
+            method="HEAD",
+            headers=headers,
+            allow_redirects=True,
+            timeout=30,
+        ) as r:
+            if r.status_code == 304:
+                return False, None
+            if not r.ok:
+                print_information(
+                    state,
+                    f"Could not check {video_src_link} for changes: {r.status_code}",
+                    type="warning",
+                )
+                return False, None
+            fingerprint = get_fingerprint(r, video_src_link)
+    except requests.exceptions.RequestException as e:
+        print_information(
+            state, f"Could not check {video_src_link} for changes: {e}", type="warning"
+        )
+        return False, None
+
+    if stored is None:
+        # Without a stored fingerprint we can only compare the size, which doesn't work for clips
+        changed = not re.search(
+            r"-clip\d+to(\d+|end)\.mp4$", file_name
+        ) and fingerprint["length"] not in (None, os.path.getsize(file_name))
+    else:
+        changed = any(
+            stored.get(key) is not None
+            and fingerprint[key] is not None
+            and stored.get(key) != fingerprint[key]
+            for key in fingerprint
+        )
+    return changed, fingerprint
+
+
+def find_changed_recordings(state, collection):
+    """Checks which downloaded recordings changed on the server and marks them to be downloaded again
+
+    Uses parallel conditional HEAD requests, recordings only available as HLS or DASH stream are not checked
+
+    Keyword arguments:
+    collection -- List of `(file_name, video_src_link, episode_name)` tuples
+    """
+
+    candidates = [
+        (file_name, video_src_link, episode_name)
+        for file_name, video_src_link, episode_name in collection
+        if os.path.isfile(file_name) and not is_manifest_link(video_src_link)
+    ]
+    if not candidates:
+        return
+    print_information(state, f"Checking {len(candidates)} recordings for changes")
+
+    with state.library_lock:
+        for file_name, _, _ in candidates:
+            add_to_library_index(state, file_name)
+        stored = [
+            get_stored_fingerprint(state, file_name) for file_name, _, _ in candidates
+        ]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=state.max_connections
+    ) as executor:
+        results = list(
+            executor.map(
+                functools.partial(check_for_change, state),
+                [file_name for file_name, _, _ in candidates],
+                [video_src_link for _, video_src_link, _ in candidates],
+                stored,
+            )
+        )
+
+    with state.library_lock:
+        for (file_name, video_src_link, episode_name), (changed, fingerprint) in zip(
+            candidates, results
+        ):
+            if changed:
+                print_information(
+                    state,
+                    f"Recording changed on the server, downloading it again: {episode_name}",
+                )
+                emit_event(
+                    state, "recording_changed", file=file_name, episode=episode_name
+                )
+                state.changed_recordings.add(file_name)
+                with state.stats_lock:
+                    state.changed_counter += 1
+            elif fingerprint:
+                set_fingerprint(state, file_name, fingerprint)
+        mark_library_index_changed(state)
+
+
+def get_indexed_qualities(state, pseudo_hash):
+    """Returns all qualities of a recording that exist in the library
+
+    Keyword arguments:
+    pseudo_hash -- The pseudo hash identifying the recording
+
+    Returns:
+    A dictionary mapping the quality (e.g. `720p`) to the path of the file on disk
+    """
+    qualities = dict()
+    for quality, entry in (
+        load_library_index(state)["recordings"].get(pseudo_hash, dict()).items()
+    ):
+        path = os.path.join(state.directory_prefix, entry["path"])
+        # The copy might have been deleted since it was indexed
+        if os.path.isfile(path):
+            qualities[quality] = path
+    return qualities
+
+
+def find_duplicate(state, file_name):
+    """Looks up whether the same recording in the same quality already exists somewhere in the library
+
+    Keyword arguments:
+    file_name -- Path the recording should be saved to
+
+    Returns:
+    Path to the existing copy or `None` if there is none
+    """
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return None
+    quality, pseudo_hash = parsed
+
+    path = get_indexed_qualities(state, pseudo_hash).get(quality)
+    if not path or os.path.abspath(path) == os.path.abspath(file_name):
+        return None
+    return path
+
+
+def find_sufficient_quality(state, file_name):
+    """Looks up whether the library already contains the recording in a quality that is good enough
+    according to `existing_quality`
+
+    Keyword arguments:
+    file_name -- Path the recording should be saved to
+
+    Returns:
+    A tuple `(quality, path)` of the existing copy or `None` if the recording should be downloaded
+    """
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return None
+    quality, pseudo_hash = parsed
+
+    candidates = [
+        (other_quality, path)
+        for other_quality, path in get_indexed_qualities(state, pseudo_hash).items()
+        if state.existing_quality == "any"
+        or quality_height(other_quality) >= quality_height(quality)
+    ]
+    if not candidates:
+        return None
+    # Report the best copy we have
+    return max(candidates, key=lambda t: quality_height(t[0]))
+
+
+def remove_lower_qualities(state, file_name):
+    """Deletes copies of a recording in the same folder that have a lower quality than `file_name`
+
+    Keyword arguments:
+    file_name -- Path of the newly downloaded recording
+    """
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return
+    quality, pseudo_hash = parsed
+
+    directory = os.path.dirname(os.path.abspath(file_name))
+    for other_quality, path in get_indexed_qualities(state, pseudo_hash).items():
+        if quality_height(other_quality) < quality_height(
+            quality
+        ) and directory == os.path.dirname(os.path.abspath(path)):
+            print_information(state, f"Removing lower quality copy: {path}")
+            os.remove(path)
+            remove_from_library_index(state, path)
+
+
+def link_duplicate(state, source, file_name):
+    """Makes an existing recording available under a new file name without downloading it again
+
+    Keyword arguments:
+    source    -- Path to the existing copy of the recording
+    file_name -- Path under which the recording should be made available
+
+    Returns:
+    True if the link was created, False if the recording has to be downloaded instead
+    """
+    try:
+        if state.link_duplicates == "hardlink":
+            os.link(source, file_name)
+        elif state.link_duplicates == "symlink":
+            os.symlink(
+                os.path.relpath(source, os.path.dirname(os.path.abspath(file_name))),
+                file_name,
+            )
+        elif state.link_duplicates == "reflink":
+            # Copy-on-write clone, only supported by some file systems like Btrfs or XFS
+            import fcntl
+
+            FICLONE = 0x40049409
+            with open(source, "rb") as src, open(file_name + ".part", "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.rename(file_name + ".part", file_name)
+    except (OSError, ImportError) as e:
+        print_information(
+            state,
+            f"Could not {state.link_duplicates} {source} to {file_name}: {e}",
+            type="warning",
+        )
+        if os.path.isfile(file_name + ".part"):
+            os.remove(file_name + ".part")
+        return False
+    return True
+
+
+def find_library_recording(state, pseudo_hash, quality):
+    """Finds a recording in the library index
+
+    Keyword arguments:
+    pseudo_hash -- The pseudo hash of the recording, see `get_pseudo_hash()`
+    quality     -- The quality of the recording, e.g. `720p`
+
+    Returns:
+    A tuple `(path, fingerprint)` where fingerprint is `None` if it is unknown, or `None` if the recording isn't in the library
+    """
+
+    index_file = state.directory_prefix + LIBRARY_INDEX_FILE
+    with state.library_lock:
+        entry = (
+            load_library_index(state)["recordings"]
+            .get(pseudo_hash, dict())
+            .get(quality)
+        )
+        # Other scraper processes might have downloaded the recording in the meantime
+        if entry is None and os.path.isfile(index_file):
+            if os.path.getmtime(index_file) > state.library_index_time:
+                # Writing merges the index on disk into ours, so our own changes aren't lost
+                if state.library_index_changed:
+                    write_library_index(state)
+                else:
+                    state.library_index = None
+                entry = (
+                    load_library_index(state)["recordings"]
+                    .get(pseudo_hash, dict())
+                    .get(quality)
+                )
+        if entry is None:
+            return None
+        path = os.path.join(state.directory_prefix, entry["path"])
+        if not os.path.isfile(path):
+            return None
+        return path, entry.get("fingerprint")
+
+
+def parse_range(value, size):
+    """Parses the `Range` header of a request
+
+    Keyword arguments:
+    value -- The value of the header, e.g. `bytes=100-`
+    size  -- The size of the requested file
+
+    Returns:
+    A tuple `(first byte, last byte)` or `None` if the range is invalid or can't be satisfied
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", value.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # The last N bytes
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class LibraryRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the recordings of the library as `/recordings/<pseudo_hash>/<quality>`, see `--serve-library`"""
+
+    # Keep connections open for the next recording
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.send_recording(send_body=False)
+
+    def do_GET(self):
+        self.send_recording(send_body=True)
+
+    def send_recording(self, send_body):
+        state = self.server.state
+        match = re.fullmatch(r"/recordings/([^/]+)/([^/?]+)", self.path)
+        recording = find_library_recording(state, *match.groups()) if match else None
+        if recording is None:
+            self.send_error(404)
+            return
+        path, fingerprint = recording
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            if self.headers.get("Range"):
+                byte_range = parse_range(self.headers["Range"], size)
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            # Pass on how the upstream server identified this version, so `--refresh-changed` keeps working
+            if fingerprint:
+                if fingerprint.get("etag"):
+                    self.send_header("ETag", fingerprint["etag"])
+                if fingerprint.get("last_modified"):
+                    self.send_header("Last-Modified", fingerprint["last_modified"])
+            self.end_headers()
+            if not send_body:
+                return
+
+            f.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    data = f.read(min(LIBRARY_SERVER_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # The peer cancelled the download, it will reconnect if it still needs the rest
+                pass
+
+    def log_message(self, format, *args):
+        state = self.server.state
+        print_information(
+            state,
+            f"Library server: {self.address_string()} {format % args}",
+            verbose_only=True,
+        )
+
+
+def parse_address(value, default_host="0.0.0.0"):
+    """Parses `[HOST:]PORT` into `(host, port)`, listening on all interfaces if no host is given"""
+    host, _, port = value.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected [HOST:]PORT, got `{value}`")
+    return host.strip("[]") or default_host, port
+
+
+def start_library_server(state, address):
+    """Serves the library to other scrapers in a background thread
+
+    Keyword arguments:
+    address -- `(host, port)` to listen on
+    """
+
+    state.library_server = http.server.ThreadingHTTPServer(
+        address, LibraryRequestHandler
+    )
+    # The handlers run in the threads of the server and find the scraper state there
+    state.library_server.state = state
+    state.library_server.daemon_threads = True
+    threading.Thread(target=state.library_server.serve_forever, daemon=True).start()
+    print_information(
+        state,
+        f"Serving library {state.directory_prefix} on {address[0]}:{state.library_server.server_address[1]}",
+    )
+
+
+def read_post_process_file(state, file):
+    """Reads the post-processing commands from a text file
+
+    Each line has the form `<lecture> <quality> <command>`, where `<lecture>` is a pattern matched against
+    the lecture title (e.g. `*` or `Advanced*`) and `<quality>` is a quality like `720p` or `*` for any.
+    Lines starting with `#` are ignored.
+
+    Returns:
+    A list of `(lecture pattern, quality, command)` tuples
+    """
+    commands = list()
+    if not os.path.isfile(file):
+        print_information(
+            state, f'No post-processing file with name "{file}" found', type="error"
+        )
+        return commands
+
+    with open(file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split(maxsplit=2)
+            if len(fields) < 3:
+                print_information(
+                    state,
+                    f"Invalid line in post-processing file, expected `<lecture> <quality> <command>`: {line}",
+                    type="warning",
+                )
+                continue
+            commands.append(tuple(fields))
+    return commands
+
+
+def run_post_process_command(state, command, episode_name):
+    """Runs a single post-processing command and returns its result
+
+    Keyword arguments:
+    command      -- The shell command to run
+    episode_name -- Name of the episode, for reporting
+
+    Returns:
+    A tuple `(episode_name, command, return code, error output)`
+    """
+    print_information(state, f"Running post-processing: {command}", verbose_only=True)
+    result = subprocess.run(
+        command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    error_output = result.stderr.decode(errors="replace").strip()
+    if result.returncode != 0:
+        print_information(
+            state,
+            f"Post-processing of {episode_name} failed with exit code {result.returncode}",
+            type="warning",
+        )
+    emit_event(
+        state,
+        "post_processed",
+        episode=episode_name,
+        command=command,
+        exit_code=result.returncode,
+    )
+    return episode_name, command, result.returncode, error_output
+
+
+def submit_post_processing(state, file_name, episode_name):
+    """Starts the post-processing commands matching a downloaded recording in the background
+
+    Keyword arguments:
+    file_name    -- Path of the downloaded recording
+    episode_name -- Name of the episode
+    """
+
+    if not state.post_process_commands:
+        return
+
+    parsed = parse_recording_file_name(file_name)
+    quality = parsed[0] if parsed else ""
+    lecture = os.path.basename(os.path.dirname(os.path.abspath(file_name)))
+    placeholders = {
+        "file": shlex.quote(file_name),
+        "directory": shlex.quote(os.path.dirname(file_name)),
+        "name": shlex.quote(os.path.splitext(os.path.basename(file_name))[0]),
+        "quality": shlex.quote(quality),
+        "lecture": shlex.quote(lecture),
+        "episode": shlex.quote(episode_name),
+    }
+
+    for lecture_pattern, quality_pattern, command in state.post_process_commands:
+        if not fnmatch.fnmatch(lecture, lecture_pattern):
+            continue
+        if quality_pattern not in ("*", quality):
+            continue
+        try:
+            command = command.format(**placeholders)
+        except (KeyError, IndexError, ValueError) as e:
+            print_information(
+                state,
+                f"Invalid placeholder in post-processing command `{command}`: {e}",
+                type="warning",
+            )
+            continue
+
+        # Commands run as separate processes, so the downloads can continue in the meantime
+        with state.post_process_lock:
+            if state.post_process_executor is None:
+                state.post_process_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=state.post_process_workers
+                )
+            state.post_process_futures.append(
+                state.post_process_executor.submit(
+                    run_post_process_command, state, command, episode_name
+                )
+            )
+
+
+def finish_post_processing(state):
+    """Waits for all post-processing commands to finish and reports the ones that failed"""
+
+    with state.post_process_lock:
+        executor = state.post_process_executor
+        futures = state.post_process_futures
+        state.post_process_executor = None
+        state.post_process_futures = list()
+    if executor is None:
+        return
+
+    if not all(future.done() for future in futures):
+        print_information(state, "Waiting for post-processing to finish...")
+    executor.shutdown(wait=True)
+
+    failures = [future.result() for future in futures if future.result()[2] != 0]
+    print_information(
+        state, f"{len(futures)} post-processing commands run, {len(failures)} failed"
+    )
+    for episode_name, command, returncode, error_output in failures:
+        print_information(
+            state,
+            f"{episode_name}: `{command}` exited with {returncode}",
+            type="warning",
+        )
+        if error_output:
+            print_information(state, error_output, type="warning", verbose_only=True)
+
+
+def is_manifest_link(video_src_link):
+    """Checks whether a link points to an HLS or DASH manifest instead of a video file"""
+    path = urlparse(video_src_link).path
+    return path.endswith(".m3u8") or path.endswith(".mpd")
+
+
+def fetch_segment(state, segment):
+    """Downloads a single segment of an HLS or DASH stream, retrying a few times if it fails
+
+    Keyword arguments:
+    segment -- A `(link, byte range)` tuple, see `get_hls_segments()`
+
+    Returns:
+    The content of the segment
+    """
+    link, byte_range = segment
+    headers = {"User-Agent": USER_AGENT}
+    if byte_range:
+        headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+
+    for attempt in range(SEGMENT_RETRIES + 1):
+        try:
+            with adaptive_request(
+                state, "download", link, headers=headers, timeout=60
+            ) as r:
+                r.raise_for_status()
+                wait_for_transfer(state, len(r.content))
+                return r.content
+        except requests.exceptions.RequestException as e:
+            if attempt == SEGMENT_RETRIES:
+                raise
+            print_information(
+                state,
+                f"Retrying segment {link} after error: {e}",
+                type="warning",
+                verbose_only=True,
+            )
+            emit_event(state, "retry", link=link, reason=str(e))
+            time.sleep(2**attempt)
+
+
+def download_segments(state, video_src_link, f, episode_name, progress_position=None):
+    """Downloads all segments of an HLS or DASH stream in parallel and writes them to a file in order
+
+    Keyword arguments:
+    video_src_link    -- Link to the HLS media playlist or DASH manifest (with representation id as fragment)
+    f                 -- The file to write to
+    episode_name      -- Name of the episode
+    progress_position -- Line of the progress bar if several downloads run at the same time
+    """
+    try:
+        if urlparse(video_src_link).path.endswith(".m3u8"):
+            segments = get_hls_segments(video_src_link)
+        else:
+            segments = get_dash_segments(video_src_link)
+    except MediaError:
+        raise
+    # Missing or malformed entries of the manifest
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError) as e:
+        raise MediaError(f"broken manifest: {e!r}")
+    print_information(state, f"Downloading {episode_name} ({len(segments)} segments)")
+
+    pbar = None
+    status_line = False
+    if not state.hide_progress_bar:
+        try:
+            from tqdm import tqdm
+
+            pbar = tqdm(
+                unit="segments",
+                total=len(segments),
+                position=progress_position,
+                desc=episode_name if progress_position is not None else None,
+            )
+        except ModuleNotFoundError:
+            status_line = progress_position is not None
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=state.segment_workers
+    ) as executor:
+        # Only keep a limited number of segments in memory while waiting for earlier ones
+        pending = collections.deque()
+        try:
+            for segment in segments:
+                pending.append(executor.submit(fetch_segment, state, segment))
+                while len(pending) > 2 * state.segment_workers or (
+                    pending and pending[0].done()
+                ):
+                    f.write(pending.popleft().result())
+                    if pbar:
+                        pbar.update(1)
+                    elif status_line:
+                        print_status_line(state)
+            while pending:
+                f.write(pending.popleft().result())
+                if pbar:
+                    pbar.update(1)
+                elif status_line:
+                    print_status_line(state)
+        except Exception:
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            if pbar:
+                pbar.close()
+
+
+class DownloadStalled(requests.exceptions.RequestException):
+    """Raised when a download stays slower than `--min-speed` for too long"""
+
+
+class MediaError(ValueError):
+    """Raised when a manifest or MP4 file of a recording is broken or uses features we don't support"""
+
+
+class DownloadEvicted(Exception):
+    """Raised when a download is stopped because the storage budget would delete it right away"""
+
+
+def parse_size(value):
+    """Parses a size like `500M` or `20G` given in bytes
+
+    Returns:
+    The size in bytes
+    """
+    units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?", value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            f"expected a size like 500M or 20G, got `{value}`"
+        )
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def parse_speed(value):
+    """Parses a speed like `50K` or `1.5M` given in bytes per second
+
+    Returns:
+    The speed in bytes per second
+    """
+    units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+    match = re.fullmatch(
+        r"(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?", value.strip().upper()
+    )
+    if not match:
+        raise argparse.ArgumentTypeError(
+            f"expected a speed like 50K or 1M, got `{value}`"
+        )
+    return float(match.group(1)) * units[match.group(2)]
+
+
+def iter_content_with_stall_check(state, response, chunk_size=4096):
+    """Yields the content of a streamed response, raising `DownloadStalled` if it gets too slow
+
+    The speed is measured over the last `stall_timeout` seconds, so short drops don't abort the download.
+
+    Keyword arguments:
+    response   -- A response of a request with `stream=True`
+    chunk_size -- Number of bytes per chunk
+    """
+    start = time.monotonic()
+    received = 0
+    resumes = state.resume_counter
+    # `(time, bytes received so far)` about once per second, covering the last `stall_timeout` seconds
+    checkpoints = collections.deque([(start, 0)])
+    for data in response.iter_content(chunk_size=chunk_size):
+        wait_for_transfer(state, len(data))
+        yield data
+        received += len(data)
+        now = time.monotonic()
+        if resumes != state.resume_counter:
+            # Downloads were paused, start measuring again
+            resumes = state.resume_counter
+            checkpoints = collections.deque([(now, received)])
+        if now - checkpoints[-1][0] >= 1:
+            checkpoints.append((now, received))
+        while len(checkpoints) > 1 and checkpoints[1][0] <= now - state.stall_timeout:
+            checkpoints.popleft()
+
+        elapsed = now - checkpoints[0][0]
+        if state.min_speed and elapsed >= state.stall_timeout:
+            speed = (received - checkpoints[0][1]) / elapsed
+            # Downloads slowed down by `--limit-rate` are not stalled
+            expected_speed = state.min_speed
+            if state.rate_limit:
+                expected_speed = min(
+                    state.min_speed,
+                    state.rate_limit / 2 / max(1, len(state.active_transfers)),
+                )
+            if speed < expected_speed:
+                raise DownloadStalled(
+                    f"only {speed / 1024:.1f} KiB/s during the last {elapsed:.0f} seconds"
+                )
+
+
+def parse_fsync_policy(value):
+    """Parses the value of `--fsync`: `none`, `close` or a number of MiB
+
+    Returns:
+    A `(policy, interval in bytes)` tuple
+    """
+    if value in ("none", "close"):
+        return value, 0
+    try:
+        interval = float(value)
+    except ValueError:
+        interval = 0
+    if interval <= 0:
+        raise argparse.ArgumentTypeError(
+            f"expected `none`, `close` or a number of MiB, got `{value}`"
+        )
+    return "interval", int(interval * 1024 * 1024)
+
+
+class RecordingFile:
+    """A file a recording is downloaded to, written according to `--preallocate`, `--drop-cache` and `--fsync`
+
+    Keyword arguments:
+    file_name     -- Name of the file, it is created or overwritten
+    journal_name  -- Name of the recording in the run journal, see `write_journal()`
+    resume_offset -- Keep this many bytes of an existing file and continue writing after them
+    """
+
+    def __init__(self, state, file_name, journal_name=None, resume_offset=0):
+        self.state = state
+        if resume_offset:
+            self.file = open(file_name, "r+b")
+            self.file.truncate(resume_offset)
+            self.file.seek(resume_offset)
+        else:
+            self.file = open(file_name, "wb")
+        self.journal_name = journal_name
+        self.position = resume_offset
+        self.checkpointed = resume_offset
+        # Size of the whole recording, if known
+        self.expected_size = None
+        self.preallocated = 0
+        self.synced = resume_offset
+        self.dropped = resume_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def preallocate(self, size):
+        """Reserves space for the whole recording at once, so the file isn't scattered across the disk"""
+        self.expected_size = size
+        if (
+            not self.state.preallocate
+            or not hasattr(os, "posix_fallocate")
+            or size <= 0
+        ):
+            return
+        try:
+            self.file.flush()
+            os.posix_fallocate(self.file.fileno(), 0, size)
+            self.preallocated = size
+        except OSError as e:
+            # Not all file systems support it
+            print_information(
+                self.state, f"Could not preallocate file: {e}", verbose_only=True
+            )
+
+    def write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+        if (
+            self.state.fsync_policy == "interval"
+            and self.position - self.synced >= self.state.fsync_interval
+        ):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.position
+        if self.state.drop_cache and self.position - self.dropped >= DROP_CACHE_STEP:
+            self.drop_cache(self.position)
+
+    def checkpoint(self):
+        """Writes how much of the recording is on disk to the run journal, so `--recover` can continue from there
+
+        The data is always synced first, regardless of `--fsync`, otherwise the journal could survive a reboot
+        that the data didn't. With `--preallocate` the file would then continue after a block of zeros.
+        """
+        self.file.flush()
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(self.file.fileno())
+        else:
+            os.fsync(self.file.fileno())
+        self.synced = self.position
+        self.checkpointed = self.position
+        write_journal(
+            self.state, "progress", file=self.journal_name, offset=self.position
+        )
+
+    def drop_cache(self, end):
+        """Removes the written data up to `end` from the page cache as we won't read it again"""
+        if not hasattr(os, "posix_fadvise"):
+            return
+        self.file.flush()
+        # Pages that are not yet written to disk stay in the cache, but the kernel starts writing them now.
+        # So also include the previous step, which should have been written to disk by now.
+        start = max(0, self.dropped - DROP_CACHE_STEP)
+        os.posix_fadvise(self.file.fileno(), start, end - start, os.POSIX_FADV_DONTNEED)
+        self.dropped = end
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self.position = offset
+        self.synced = min(self.synced, offset)
+        self.dropped = min(self.dropped, offset)
+        self.checkpointed = min(self.checkpointed, offset)
+
+    def truncate(self):
+        self.file.truncate()
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            # Remove preallocated space that wasn't used
+            if self.preallocated > self.position:
+                self.file.truncate(self.position)
+            self.file.flush()
+            if self.state.fsync_policy != "none":
+                os.fsync(self.file.fileno())
+            if self.state.drop_cache and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(self.file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            self.file.close()
+
+
+def download_video(
+    state, video_src_link, f, episode_name, progress_position=None, resume=None
+):
+    """Downloads a video file and shows its progress
+
+    If the connection stalls or breaks, the scraper reconnects and continues where it stopped.
+
+    Keyword arguments:
+    video_src_link    -- The link to download the data from
+    f                 -- The `RecordingFile` to write to
+    episode_name      -- Name of the episode
+    progress_position -- Line of the progress bar if several downloads run at the same time
+    resume            -- Resume point of an interrupted run to continue from `f.position`, see `--recover`
+
+    Returns:
+    The fingerprint of the recording, see `get_fingerprint()`
+    """
+
+    controller = get_concurrency_controller(state, "download", video_src_link)
+    offset = f.position
+    total_length = None
+    pbar = None
+    builtin_progressbar = False
+    status_line = False
+    try:
+        for attempt in range(STALL_RETRIES + 1):
+            # Continue where the last connection stopped
+            headers = get_download_headers(state, video_src_link)
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+            # Only continue a download of an earlier run if the recording didn't change since
+            if attempt == 0 and offset and resume:
+                validator = resume.get("etag") or resume.get("last_modified")
+                if validator:
+                    headers["If-Range"] = validator
+            with adaptive_request(
+                state,
+                "download",
+                video_src_link,
+                headers=headers,
+                stream=True,
+                timeout=(30, state.stall_timeout),
+            ) as response:
+                response.raise_for_status()
+                restarted = attempt == 0 and not offset
+                if offset and response.status_code != 206:
+                    # The server doesn't support continuing, start from the beginning
+                    print_information(
+                        state,
+                        f"Server does not support resuming or the recording changed, restarting download of {episode_name}",
+                        type="warning",
+                    )
+                    restarted = True
+                    offset = 0
+                    f.seek(0)
+                    f.truncate()
+                    if pbar:
+                        pbar.reset()
+
+                # Only note downloads starting from the beginning, reconnecting keeps the progress noted so far
+                if restarted and f.journal_name:
+                    write_journal(
+                        state,
+                        "started",
+                        file=f.journal_name,
+                        part=f.file.name,
+                        etag=response.headers.get("etag"),
+                        last_modified=response.headers.get("last-modified"),
+                    )
+
+                if attempt == 0:
+                    fingerprint = get_fingerprint(response, video_src_link)
+                    total_length = response.headers.get("content-length")
+                    if total_length is None:
+                        print_information(state, f"Downloading {episode_name}")
+                    else:
+                        # A continued download only receives the rest of the recording
+                        total_length = int(total_length) + offset
+                        fingerprint["length"] = total_length
+                        if (
+                            not offset
+                            and f.journal_name
+                            and would_be_evicted(
+                                state, f.journal_name, video_src_link, total_length
+                            )
+                        ):
+                            raise DownloadEvicted(video_src_link)
+                        f.preallocate(total_length)
+                        print_information(
+                            state,
+                            f"Downloading {episode_name} ({total_length / 1024 / 1024:.2f} MiB)",
+                        )
+                    if offset:
+                        print_information(
+                            state,
+                            f"Continuing after {offset / 1024 / 1024:.2f} MiB of {episode_name}",
+                        )
+
+                    # We received no content length header or user wanted to hide the progress bar
+                    if total_length is not None and not state.hide_progress_bar:
+                        try:
+                            # Module with better progressbar
+                            from tqdm import tqdm
+
+                            # Setup progressbar
+                            pbar = tqdm(
+                                unit="B",
+                                unit_scale=True,
+                                unit_divisor=1024,
+                                total=total_length,
+                                initial=offset,
+                                position=progress_position,
+                                desc=(
+                                    episode_name
+                                    if progress_position is not None
+                                    else None
+                                ),
+                            )
+                            pbar.clear()
+
+                        # If tqdm is not installed, fallback to self-made version
+                        except ModuleNotFoundError:
+                            print_information(
+                                state,
+                                "Optionally dependency tqdm not installed, falling back to built-in progressbar",
+                                type="warning",
+                                verbose_only=True,
+                            )
+                            # Several progress bars would overwrite each other, show the status of all instead
+                            builtin_progressbar = progress_position is None
+                            status_line = not builtin_progressbar
+
+                try:
+                    # Download to file and update progressbar
+                    for data in iter_content_with_stall_check(state, response):
+                        offset += len(data)
+                        controller.record(len(data))
+                        f.write(data)
+                        if f.journal_name and (
+                            offset - f.checkpointed >= JOURNAL_CHECKPOINT_SIZE
+                        ):
+                            f.checkpoint()
+                        if pbar:
+                            pbar.update(len(data))
+                        elif builtin_progressbar:
+                            progressbar_width = shutil.get_terminal_size().columns - 2
+                            done = int(progressbar_width * offset / total_length)
+                            sys.stdout.write(
+                                f"\r[{'=' * done}{' ' * (progressbar_width - done)}]"
+                            )
+                            sys.stdout.flush()
+                        elif status_line:
+                            print_status_line(state)
+                except (
+                    DownloadStalled,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                ) as e:
+                    if attempt == STALL_RETRIES:
+                        raise
+                    with state.stats_lock:
+                        state.stall_counter += 1
+                    print_information(
+                        state,
+                        f"Reconnecting after {offset / 1024 / 1024:.2f} MiB of {episode_name}: {e}",
+                        type="warning",
+                    )
+                    emit_event(
+                        state,
+                        "retry",
+                        link=video_src_link,
+                        reason=str(e),
+                        offset=offset,
+                    )
+                    continue
+
+            # Without content length we can't tell whether the download is complete
+            if total_length is None or offset >= total_length:
+                break
+            if attempt == STALL_RETRIES:
+                raise DownloadStalled(
+                    f"connection closed after {offset} of {total_length} bytes"
+                )
+            with state.stats_lock:
+                state.stall_counter += 1
+            print_information(
+                state,
+                f"Reconnecting after the connection closed early: {episode_name}",
+                type="warning",
+            )
+            emit_event(
+                state,
+                "retry",
+                link=video_src_link,
+                reason="connection closed early",
+                offset=offset,
+            )
+    finally:
+        if pbar:
+            pbar.close()
+    if not state.quiet:
+        print(file=state.output)
+    return fingerprint
+
+
+def download_from_peers(
+    state, file_name, video_src_link, f, episode_name, progress_position=None
+):
+    """Tries to download a recording from the other scrapers given with `--peer`
+
+    Keyword arguments:
+    file_name         -- Name of the file of the recording
+    video_src_link    -- The upstream link of the recording
+    f                 -- The `RecordingFile` to write to
+    episode_name      -- Name of the episode
+    progress_position -- Line of the progress bar if several downloads run at the same time
+
+    Returns:
+    The fingerprint of the recording, see `get_fingerprint()`, or `None` if no peer could provide it
+    """
+
+    # Peers might still have the old version of a recording that changed upstream
+    if not state.peers or file_name in state.changed_recordings:
+        return None
+    parsed = parse_recording_file_name(file_name)
+    if not parsed:
+        return None
+    quality, pseudo_hash = parsed
+
+    for peer in state.peers:
+        if peer in state.unreachable_peers:
+            continue
+        peer_link = f"{peer}/recordings/{pseudo_hash}/{quality}"
+        try:
+            response = requests.head(peer_link, timeout=PEER_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            # Don't try again for every recording
+            print_information(
+                state,
+                f"Peer {peer} is not reachable, not using it anymore: {e}",
+                type="warning",
+            )
+            state.unreachable_peers.add(peer)
+            continue
+        if response.status_code != 200:
+            print_information(
+                state, f"Peer {peer} doesn't have {episode_name}", verbose_only=True
+            )
+            continue
+
+        print_information(state, f"Getting {episode_name} from peer {peer}")
+        try:
+            fingerprint = download_video(
+                state, peer_link, f, episode_name, progress_position
+            )
+        except requests.exceptions.RequestException as e:
+            print_information(
+                state,
+                f"Could not download {episode_name} from peer {peer}: {e}",
+                type="warning",
+            )
+            # Throw away what we got so far, the next source starts from the beginning
+            f.seek(0)
+            f.truncate()
+            continue
+
+        with state.stats_lock:
+            state.peer_counter += 1
+        fingerprint["link"] = video_src_link
+        return fingerprint
+    return None
+
+
+def parse_time(value):
+    """Parses a time like `1:05:30`, `65:30` or `3930` into seconds"""
+    seconds = 0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_clip(value):
+    """Parses `START-END` for `--clip`, END can be left out to get the rest of the recording
+
+    Returns:
+    A tuple `(start, end)` in seconds, where end is `None` if it was left out
+    """
+    start, _, end = value.partition("-")
+    try:
+        start = parse_time(start) if start else 0
+        end = parse_time(end) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected START-END like 10:00-20:00, got `{value}`"
+        )
+    if end is not None and end <= start:
+        raise argparse.ArgumentTypeError(f"the clip `{value}` ends before it starts")
+    return start, end
+
+
+def format_time(seconds):
+    """Formats seconds as `H:MM:SS`"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def get_clip_suffix(state):
+    """Returns what is added to the file names of clips, e.g. `-clip600to1200`"""
+    start, end = state.clip
+    return f"-clip{int(start)}to{int(end) if end is not None else 'end'}"
+
+
+def parse_mp4_boxes(data):
+    """Splits MP4 data into its boxes
+
+    Boxes in `MP4_CONTAINER_BOXES` are split up recursively.
+
+    Returns:
+    A list of `[box type, payload]` where payload is either bytes or a list of boxes
+    """
+    boxes = list()
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack(">I4s", data[offset : offset + 8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+            header_size = 16
+        elif size == 0:
+            # The box extends to the end of the data
+            size = len(data) - offset
+        if size < header_size or offset + size > len(data):
+            raise MediaError(f"broken MP4 box `{box_type.decode('latin-1')}`")
+        payload = data[offset + header_size : offset + size]
+        if box_type in MP4_CONTAINER_BOXES:
+            payload = parse_mp4_boxes(payload)
+        boxes.append([box_type, payload])
+        offset += size
+    return boxes
+
+
+def build_mp4_box(box_type, payload):
+    """Turns a box returned by `parse_mp4_boxes()` back into bytes"""
+    if isinstance(payload, list):
+        payload = b"".join(build_mp4_box(*box) for box in payload)
+    if len(payload) + 8 > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, box_type, len(payload) + 16) + payload
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def find_mp4_box(boxes, *path):
+    """Returns the payload of the first box at `path`, e.g. `find_mp4_box(trak, b"mdia", b"mdhd")`, or `None`"""
+    for box_type, payload in boxes:
+        if box_type == path[0]:
+            return payload if len(path) == 1 else find_mp4_box(payload, *path[1:])
+    return None
+
+
+def get_mp4_duration_field(payload, box_type):
+    """Returns `(offset, format)` of the duration in a `mvhd`, `mdhd` or `tkhd` box"""
+    version_1 = payload[0] == 1
+    if box_type == b"tkhd":
+        return (28, ">Q") if version_1 else (20, ">I")
+    return (24, ">Q") if version_1 else (16, ">I")
+
+
+def get_mp4_timescale(payload):
+    """Returns the timescale of a `mvhd` or `mdhd` box"""
+    if not payload or len(payload) < (24 if payload[0] == 1 else 16):
+        raise MediaError("missing or broken MP4 header box")
+    return struct.unpack(">I", payload[20:24] if payload[0] == 1 else payload[12:16])[0]
+
+
+def set_mp4_duration(payload, box_type, duration):
+    """Returns a `mvhd`, `mdhd` or `tkhd` box with a new duration"""
+    offset, duration_format = get_mp4_duration_field(payload, box_type)
+    size = struct.calcsize(duration_format)
+    return (
+        payload[:offset]
+        + struct.pack(duration_format, min(duration, 256**size - 1))
+        + payload[offset + size :]
+    )
+
+
+def read_mp4_samples(stbl):
+    """Reads the sample table of a track
+
+    Returns:
+    A dict with lists `offsets`, `sizes`, `times` and `durations`, and optionally `composition_offsets`
+    (with `ctts_version`) and `sync` (set of sample numbers counting from 0), as well as `description_index`
+    """
+    # Truncated or unusual files break the parsing in many places
+    try:
+        tables = {box_type: payload for box_type, payload in stbl}
+        if b"stz2" in tables:
+            raise MediaError("compact sample sizes are not supported")
+
+        # Sample sizes
+        sample_size, count = struct.unpack(">II", tables[b"stsz"][4:12])
+        if sample_size:
+            sizes = [sample_size] * count
+        else:
+            sizes = list(
+                struct.unpack(f">{count}I", tables[b"stsz"][12 : 12 + 4 * count])
+            )
+
+        # Decoding times
+        times = list()
+        durations = list()
+        decode_time = 0
+        stts = tables[b"stts"]
+        for nr in range(struct.unpack(">I", stts[4:8])[0]):
+            run, delta = struct.unpack(">II", stts[8 + 8 * nr : 16 + 8 * nr])
+            for _ in range(run):
+                times.append(decode_time)
+                durations.append(delta)
+                decode_time += delta
+
+        # Offsets in the file
+        if b"co64" in tables:
+            chunk_count = struct.unpack(">I", tables[b"co64"][4:8])[0]
+            chunk_offsets = struct.unpack(
+                f">{chunk_count}Q", tables[b"co64"][8 : 8 + 8 * chunk_count]
+            )
+        else:
+            chunk_count = struct.unpack(">I", tables[b"stco"][4:8])[0]
+            chunk_offsets = struct.unpack(
+                f">{chunk_count}I", tables[b"stco"][8 : 8 + 4 * chunk_count]
+            )
+        stsc = tables[b"stsc"]
+        stsc_entries = [
+            struct.unpack(">III", stsc[8 + 12 * nr : 20 + 12 * nr])
+            for nr in range(struct.unpack(">I", stsc[4:8])[0])
+        ]
+        offsets = list()
+        for nr, (first_chunk, samples_per_chunk, _) in enumerate(stsc_entries):
+            last_chunk = (
+                stsc_entries[nr + 1][0] - 1
+                if nr + 1 < len(stsc_entries)
+                else chunk_count
+            )
+            for chunk in range(first_chunk - 1, last_chunk):
+                offset = chunk_offsets[chunk]
+                for _ in range(samples_per_chunk):
+                    if len(offsets) == len(sizes):
+                        break
+                    offsets.append(offset)
+                    offset += sizes[len(offsets) - 1]
+
+        if not len(sizes) == len(times) == len(offsets):
+            raise MediaError("inconsistent MP4 sample tables")
+
+        samples = {
+            "offsets": offsets,
+            "sizes": sizes,
+            "times": times,
+            "durations": durations,
+            "description_index": stsc_entries[0][2] if stsc_entries else 1,
+        }
+
+        # Composition time offsets, for videos with B-frames
+        if b"ctts" in tables:
+            ctts = tables[b"ctts"]
+            composition_offsets = list()
+            for nr in range(struct.unpack(">I", ctts[4:8])[0]):
+                run, composition_offset = struct.unpack(
+                    ">II", ctts[8 + 8 * nr : 16 + 8 * nr]
+                )
+                composition_offsets += [composition_offset] * run
+            samples["composition_offsets"] = composition_offsets[: len(sizes)]
+            samples["ctts_version"] = ctts[0]
+
+        # Samples a player can start decoding at, all of them if there is no table
+        if b"stss" in tables:
+            stss = tables[b"stss"]
+            count = struct.unpack(">I", stss[4:8])[0]
+            samples["sync"] = {
+                nr - 1 for nr in struct.unpack(f">{count}I", stss[8 : 8 + 4 * count])
+            }
+        return samples
+    except (struct.error, KeyError, IndexError, TypeError) as e:
+        raise MediaError(f"unsupported MP4 sample table: {e!r}")
+
+
+def run_length_encode(values):
+    """Returns `[(count, value), ...]` for consecutive equal values"""
+    runs = list()
+    for value in values:
+        if runs and runs[-1][1] == value:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, value])
+    return runs
+
+
+def build_mp4_sample_tables(samples, first, last, chunks, large_offsets):
+    """Builds the sample table boxes of a clip
+
+    Keyword arguments:
+    samples       -- The sample table of the track, see `read_mp4_samples()`
+    first, last   -- The samples of the clip are `first` to `last - 1`
+    chunks        -- `[(offset, number of samples), ...]` of the clip in the new file
+    large_offsets -- Whether to use 64 bit chunk offsets
+
+    Returns:
+    A list of boxes
+    """
+    full_box = b"\0\0\0\0"
+    stts = run_length_encode(samples["durations"][first:last])
+    boxes = [
+        [
+            b"stts",
+            full_box
+            + struct.pack(">I", len(stts))
+            + b"".join(struct.pack(">II", *run) for run in stts),
+        ]
+    ]
+    if "composition_offsets" in samples:
+        ctts = run_length_encode(samples["composition_offsets"][first:last])
+        boxes.append(
+            [
+                b"ctts",
+                bytes([samples["ctts_version"], 0, 0, 0])
+                + struct.pack(">I", len(ctts))
+                + b"".join(struct.pack(">II", *run) for run in ctts),
+            ]
+        )
+    if "sync" in samples:
+        sync = [nr - first + 1 for nr in range(first, last) if nr in samples["sync"]]
+        boxes.append(
+            [
+                b"stss",
+                full_box + struct.pack(f">I{len(sync)}I", len(sync), *sync),
+            ]
+        )
+
+    # Describe how many samples each chunk has, only listing changes
+    stsc = list()
+    for nr, (_, count) in enumerate(chunks):
+        if not stsc or stsc[-1][1] != count:
+            stsc.append((nr + 1, count, samples["description_index"]))
+    boxes.append(
+        [
+            b"stsc",
+            full_box
+            + struct.pack(">I", len(stsc))
+            + b"".join(struct.pack(">III", *entry) for entry in stsc),
+        ]
+    )
+
+    sizes = samples["sizes"][first:last]
+    boxes.append(
+        [b"stsz", full_box + struct.pack(f">II{len(sizes)}I", 0, len(sizes), *sizes)]
+    )
+    offsets = [offset for offset, _ in chunks]
+    if large_offsets:
+        boxes.append(
+            [
+                b"co64",
+                full_box + struct.pack(f">I{len(offsets)}Q", len(offsets), *offsets),
+            ]
+        )
+    else:
+        boxes.append(
+            [
+                b"stco",
+                full_box + struct.pack(f">I{len(offsets)}I", len(offsets), *offsets),
+            ]
+        )
+    return boxes
+
+
+def fetch_range(state, video_src_link, start, end):
+    """Downloads the bytes `start` to `end` (inclusive) of a file
+
+    Returns:
+    A tuple `(data, response)`
+    """
+    headers = get_download_headers(state, video_src_link)
+    headers["Range"] = f"bytes={start}-{end}"
+    # Stream the response, so a server ignoring the range doesn't send the whole recording into memory
+    with adaptive_request(
+        state,
+        "download",
+        video_src_link,
+        headers=headers,
+        stream=True,
+        timeout=(30, state.stall_timeout),
+    ) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise MediaError("the server does not support downloading parts of a file")
+        get_concurrency_controller(state, "download", video_src_link).record(
+            len(r.content)
+        )
+        return r.content, r
+
+
+def find_mp4_index(state, video_src_link):
+    """Downloads the `ftyp` and `moov` boxes of a remote MP4 file without downloading its media data
+
+    Returns:
+    A tuple `(ftyp box or b"", moov payload, fingerprint)`
+    """
+    data, r = fetch_range(state, video_src_link, 0, CLIP_PROBE_SIZE - 1)
+    fingerprint = get_fingerprint(r, video_src_link)
+    # The length of the whole file is only part of the range header
+    total_length = int(r.headers["content-range"].rpartition("/")[2])
+    fingerprint["length"] = total_length
+
+    # `data` holds the bytes starting at `data_offset`
+    data_offset = 0
+    ftyp = b""
+    offset = 0
+    while offset < total_length:
+        # Get the header of the next box if we don't have it yet
+        header_end = min(offset + 16, total_length)
+        if offset < data_offset or header_end > data_offset + len(data):
+            data, _ = fetch_range(
+                state,
+                video_src_link,
+                offset,
+                min(offset + CLIP_PROBE_SIZE, total_length) - 1,
+            )
+            data_offset = offset
+        start = offset - data_offset
+        if len(data) < start + 8:
+            raise MediaError("truncated MP4 file")
+        size, box_type = struct.unpack(">I4s", data[start : start + 8])
+        header_size = 8
+        if size == 1:
+            if len(data) < start + 16:
+                raise MediaError("truncated MP4 file")
+            size = struct.unpack(">Q", data[start + 8 : start + 16])[0]
+            header_size = 16
+        elif size == 0:
+            size = total_length - offset
+        if size < header_size:
+            raise MediaError("broken MP4 file")
+
+        if box_type in (b"ftyp", b"moov"):
+            if offset + size <= data_offset + len(data):
+                box = data[start : start + size]
+            else:
+                box, _ = fetch_range(state, video_src_link, offset, offset + size - 1)
+            if box_type == b"ftyp":
+                ftyp = box
+            else:
+                return ftyp, box[header_size:], fingerprint
+        elif box_type == b"moof":
+            raise MediaError("fragmented MP4 files are not supported")
+        offset += size
+    raise MediaError("the MP4 file has no index (`moov` box)")
+
+
+def download_clip(state, video_src_link, f, episode_name, progress_position=None):
+    """Downloads the part of an MP4 recording given with `--clip` and writes it as a standalone MP4 file
+
+    Only the index of the recording (the `moov` box) and the data of the samples within the clip are
+    downloaded. The clip starts at the last key frame before the start, so it can be played from the beginning.
+    If the connection stalls or breaks, the scraper reconnects and continues with the samples not written yet.
+
+    Keyword arguments:
+    video_src_link    -- The link to download the data from
+    f                 -- The `RecordingFile` to write to
+    episode_name      -- Name of the episode
+    progress_position -- Line of the progress bar if several downloads run at the same time
+
+    Returns:
+    The fingerprint of the whole recording, see `get_fingerprint()`
+    """
+
+    ftyp, moov_payload, fingerprint = find_mp4_index(state, video_src_link)
+    moov = parse_mp4_boxes(moov_payload)
+    movie_timescale = get_mp4_timescale(find_mp4_box(moov, b"mvhd"))
+    start, end = state.clip
+
+    tracks = list()
+    for box_type, trak in moov:
+        if box_type != b"trak":
+            continue
+        stbl = find_mp4_box(trak, b"mdia", b"minf", b"stbl")
+        mdhd = find_mp4_box(trak, b"mdia", b"mdhd")
+        hdlr = find_mp4_box(trak, b"mdia", b"hdlr")
+        if stbl is None or hdlr is None or len(hdlr) < 12:
+            raise MediaError("incomplete MP4 track")
+        tracks.append(
+            {
+                "trak": trak,
+                "timescale": get_mp4_timescale(mdhd),
+                "video": hdlr[8:12] == b"vide",
+                "samples": read_mp4_samples(stbl),
+            }
+        )
+    if not tracks:
+        raise MediaError("the MP4 file has no tracks")
+
+    # Start at the last key frame before the start of the clip
+    for track in tracks:
+        samples = track["samples"]
+        if track["video"] and "sync" in samples:
+            first_time = start * track["timescale"]
+            key_frames = [
+                nr for nr in samples["sync"] if samples["times"][nr] <= first_time
+            ]
+            if key_frames:
+                start = samples["times"][max(key_frames)] / track["timescale"]
+            break
+
+    # Select the samples within the clip
+    for track in tracks:
+        times = track["samples"]["times"]
+        track["first"] = next(
+            (nr for nr, time in enumerate(times) if time >= start * track["timescale"]),
+            len(times),
+        )
+        track["last"] = (
+            len(times)
+            if end is None
+            else next(
+                (
+                    nr
+                    for nr, time in enumerate(times)
+                    if time >= end * track["timescale"]
+                ),
+                len(times),
+            )
+        )
+        track["last"] = max(track["first"], track["last"])
+
+    # Keep the samples in their original order, so audio and video stay interleaved
+    selected = sorted(
+        (track["samples"]["offsets"][nr], track["samples"]["sizes"][nr], track_nr)
+        for track_nr, track in enumerate(tracks)
+        for nr in range(track["first"], track["last"])
+    )
+    if not selected:
+        raise MediaError(f"the recording has no data within the clip {state.clip}")
+    media_size = sum(size for _, size, _ in selected)
+    large_offsets = media_size > 0xFFFFFFFF - 64 * 1024 * 1024
+
+    # Consecutive samples of the same track form a chunk
+    def build_moov(media_offset):
+        chunks = [list() for _ in tracks]
+        position = media_offset
+        previous_track = None
+        for _, size, track_nr in selected:
+            if track_nr != previous_track:
+                chunks[track_nr].append([position, 0])
+                previous_track = track_nr
+            chunks[track_nr][-1][1] += 1
+            position += size
+
+        new_moov = list()
+        movie_duration = 0
+        for box_type, payload in moov:
+            if box_type == b"mvex":
+                raise MediaError("fragmented MP4 files are not supported")
+            if box_type != b"trak":
+                new_moov.append([box_type, payload])
+                continue
+            track = next(track for track in tracks if track["trak"] is payload)
+            samples = track["samples"]
+            duration = sum(samples["durations"][track["first"] : track["last"]])
+            movie_track_duration = duration * movie_timescale // track["timescale"]
+            movie_duration = max(movie_duration, movie_track_duration)
+            new_moov.append(
+                [
+                    b"trak",
+                    rebuild_mp4_track(
+                        payload,
+                        build_mp4_sample_tables(
+                            samples,
+                            track["first"],
+                            track["last"],
+                            chunks[tracks.index(track)],
+                            large_offsets,
+                        ),
+                        duration,
+                        movie_track_duration,
+                    ),
+                ]
+            )
+        return build_mp4_box(
+            b"moov",
+            [
+                (
+                    [box_type, set_mp4_duration(payload, box_type, movie_duration)]
+                    if box_type == b"mvhd"
+                    else [box_type, payload]
+                )
+                for box_type, payload in new_moov
+            ],
+        )
+
+    # The size of the index doesn't depend on the offsets, so build it once to find where the media data starts
+    mdat_header = (
+        struct.pack(">I4s", media_size + 8, b"mdat")
+        if media_size + 8 <= 0xFFFFFFFF
+        else struct.pack(">I4sQ", 1, b"mdat", media_size + 16)
+    )
+    media_offset = len(ftyp) + len(build_moov(0)) + len(mdat_header)
+    f.preallocate(media_offset + media_size)
+    f.write(ftyp + build_moov(media_offset) + mdat_header)
+
+    # Fetch samples that are close to each other with one request
+    ranges = list()
+    for offset, size, _ in selected:
+        if ranges and offset - ranges[-1][1] <= CLIP_MERGE_GAP:
+            ranges[-1][1] = max(ranges[-1][1], offset + size)
+            ranges[-1][2].append((offset, size))
+        else:
+            ranges.append([offset, offset + size, [(offset, size)]])
+    transferred = sum(range_end - range_start for range_start, range_end, _ in ranges)
+    print_information(
+        state,
+        f"Downloading {episode_name} ({transferred / 1024 / 1024:.2f} MiB of {fingerprint['length'] / 1024 / 1024:.2f} MiB)",
+    )
+
+    controller = get_concurrency_controller(state, "download", video_src_link)
+    for range_start, range_end, range_samples in ranges:
+        pending = collections.deque(range_samples)
+        for attempt in range(STALL_RETRIES + 1):
+            # Continue with the first sample that isn't written yet
+            position = pending[0][0]
+            headers = get_download_headers(state, video_src_link)
+            headers["Range"] = f"bytes={position}-{range_end - 1}"
+            try:
+                with adaptive_request(
+                    state,
+                    "download",
+                    video_src_link,
+                    headers=headers,
+                    stream=True,
+                    timeout=(30, state.stall_timeout),
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise MediaError(
+                            "the server does not support downloading parts of a file"
+                        )
+                    # Copy the samples out of the received data, skipping what lies between them
+                    buffer = bytearray()
+                    for data in iter_content_with_stall_check(
+                        state, response, chunk_size=64 * 1024
+                    ):
+                        controller.record(len(data))
+                        buffer += data
+                        while pending and pending[0][0] + pending[0][
+                            1
+                        ] <= position + len(buffer):
+                            offset, size = pending.popleft()
+                            f.write(
+                                buffer[offset - position : offset - position + size]
+                            )
+                        skip = (
+                            pending[0][0] if pending else position + len(buffer)
+                        ) - position
+                        skip = max(0, min(skip, len(buffer)))
+                        del buffer[:skip]
+                        position += skip
+            except (
+                DownloadStalled,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                if attempt == STALL_RETRIES:
+                    raise
+                reason = str(e)
+            else:
+                if not pending:
+                    break
+                reason = "connection closed early"
+                if attempt == STALL_RETRIES:
+                    raise DownloadStalled(
+                        f"connection closed after {position - range_start} of {range_end - range_start} bytes"
+                    )
+            with state.stats_lock:
+                state.stall_counter += 1
+            print_information(
+                state,
+                f"Reconnecting after {position - range_start} of {range_end - range_start} bytes of a part of {episode_name}: {reason}",
+                type="warning",
+            )
+            emit_event(
+                state, "retry", link=video_src_link, reason=reason, offset=position
+            )
+    return fingerprint
+
+
+def rebuild_mp4_track(trak, sample_tables, duration, movie_duration):
+    """Returns a `trak` box with new sample tables and durations
+
+    Keyword arguments:
+    trak           -- The boxes of the original track
+    sample_tables  -- The new sample table boxes, see `build_mp4_sample_tables()`
+    duration       -- The duration of the track in its own timescale
+    movie_duration -- The duration of the track in the timescale of the movie
+    """
+    new_trak = list()
+    for box_type, payload in trak:
+        if box_type == b"tkhd":
+            payload = set_mp4_duration(payload, box_type, movie_duration)
+        elif box_type == b"edts":
+            # Keep the offset of the first edit, which makes up for the delay of B-frames
+            elst = find_mp4_box(payload, b"elst")
+            media_time = 0
+            if elst:
+                version = elst[0]
+                entry_format = ">Qq" if version == 1 else ">Ii"
+                entry_size = struct.calcsize(entry_format) + 4
+                try:
+                    for nr in range(struct.unpack(">I", elst[4:8])[0]):
+                        start = 8 + entry_size * nr
+                        _, entry_media_time = struct.unpack(
+                            entry_format, elst[start : start + entry_size - 4]
+                        )
+                        if entry_media_time != -1:
+                            media_time = entry_media_time
+                            break
+                except struct.error as e:
+                    raise MediaError(f"broken MP4 edit list: {e}")
+            payload = [
+                [
+                    b"elst",
+                    b"\1\0\0\0"
+                    + struct.pack(">IQqhh", 1, movie_duration, media_time, 1, 0),
+                ]
+            ]
+        elif box_type == b"mdia":
+            payload = [
+                (
+                    [b"mdhd", set_mp4_duration(mdia_payload, b"mdhd", duration)]
+                    if mdia_type == b"mdhd"
+                    else (
+                        [
+                            b"minf",
+                            [
+                                (
+                                    [
+                                        b"stbl",
+                                        [
+                                            box
+                                            for box in minf_payload
+                                            if box[0] not in MP4_SAMPLE_TABLE_BOXES
+                                        ]
+                                        + sample_tables,
+                                    ]
+                                    if minf_type == b"stbl"
+                                    else [minf_type, minf_payload]
+                                )
+                                for minf_type, minf_payload in mdia_payload
+                            ],
+                        ]
+                        if mdia_type == b"minf"
+                        else [mdia_type, mdia_payload]
+                    )
+                )
+                for mdia_type, mdia_payload in payload
+            ]
+        new_trak.append([box_type, payload])
+    return new_trak
+
+
+def acquire_file_lock(state, file_name):
+    """Tries to get an exclusive lock for a file that is respected by all scraper processes,
+    even on other machines sharing the same (network) file system
+
+    Uses `flock` on a `<file_name>.lock` file where available, which is released automatically if the
+    process dies. Elsewhere the lock file is created exclusively and considered abandoned after
+    `STALE_LOCK_SECONDS`.
+
+    Keyword arguments:
+    file_name -- The file to lock
+
+    Returns:
+    A lock to pass to `release_file_lock()` or `None` if another process holds the lock
+    """
+    lock_file = file_name + ".lock"
+    owner = f"{socket.gethostname()} {os.getpid()}\n".encode()
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    if fcntl:
+        while True:
+            fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return None
+            # The previous owner might have deleted the lock file while we were opening it
+            try:
+                if os.stat(lock_file).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        os.ftruncate(fd, 0)
+        os.write(fd, owner)
+        return lock_file, fd
+
+    for attempt in range(2):
+        try:
+            fd = os.open(lock_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(fd, owner)
+            return lock_file, fd
+        except FileExistsError:
+            try:
+                lock_age = time.time() - os.path.getmtime(lock_file)
+            except FileNotFoundError:
+                continue
+            if attempt > 0 or lock_age < STALE_LOCK_SECONDS:
+                return None
+            print_information(
+                state, f"Removing abandoned lock file: {lock_file}", type="warning"
+            )
+            os.remove(lock_file)
+    return None
+
+
+def release_file_lock(lock):
+    """Releases a lock acquired with `acquire_file_lock()`"""
+    lock_file, fd = lock
+    # Delete the file before unlocking it, so nobody can lock the old file afterwards
+    try:
+        os.remove(lock_file)
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+
+def append_to_history(state, video_src_link):
+    """Adds a link to the history file without interfering with other scraper processes writing to it
+
+    Keyword arguments:
+    video_src_link -- The link to add
+    """
+    with state.stats_lock, open(state.history_file, "a") as file:
+        try:
+            import fcntl
+
+            # Released when the file is closed
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        file.write(video_src_link + "\n")
+
+
+def downloader(state, file_name, video_src_link, episode_name, progress_position=None):
+    """Downloads the video and gives progress information
+
+    Keyword arguments:
+    file_name         -- Name of the file to write the data to
+    video_src_link    -- The link to download the data from
+    episode_name      -- Name of the episode
+    progress_position -- Line of the progress bar if several downloads run at the same time
+    """
+
+    # Check for print_src flag
+    if state.print_src:
+        # Print to file if given
+        if state.file_to_print_src_to:
+            print_information(
+                state,
+                f"Printing {video_src_link} to file: {state.file_to_print_src_to}",
+                verbose_only=True,
+            )
+            # Collect links and write them all at once at the end
+            state.printed_src_links.append(video_src_link)
+        else:
+            # The links are the output, so `--quiet` doesn't hide them
+            print(video_src_link, file=state.output)
+    # Otherwise download video
+    else:
+        print_information(state, f"Video source: {video_src_link}", verbose_only=True)
+
+        # Check history file (if one has been specified) whether episode has already been downloaded
+        # Recordings that changed upstream are downloaded again anyway
+        if state.history_file and file_name not in state.changed_recordings:
+            try:
+                with open(state.history_file, "r") as file:
+                    if video_src_link in [
+                        line.rstrip("\n") for line in file.readlines()
+                    ]:
+                        print_information(
+                            state,
+                            f"download skipped - file already recorded in history: {episode_name}",
+                        )
+                        emit_event(
+                            state,
+                            "episode_skipped",
+                            file=file_name,
+                            episode=episode_name,
+                            reason="history",
+                        )
+                        with state.stats_lock:
+                            state.skip_counter += 1
+                        return
+                    else:
+                        print_information(
+                            state,
+                            "Link has not yet been recorded in history file",
+                            verbose_only=True,
+                        )
+            except FileNotFoundError:
+                print_information(
+                    state,
+                    f"No history file found at specified location: {state.history_file}",
+                    type="warning",
+                    verbose_only=True,
+                )
+
+        # Recordings deleted to stay within the storage budget are not downloaded again
+        if is_evicted(state, file_name):
+            print_information(
+                state,
+                f"download skipped - recording was evicted from the library: {episode_name}",
+            )
+            emit_event(
+                state,
+                "episode_skipped",
+                file=file_name,
+                episode=episode_name,
+                reason="evicted",
+            )
+            with state.stats_lock:
+                state.skip_counter += 1
+            return
+
+        # Create directory for video if it does not already exist
+        directory = os.path.dirname(os.path.abspath(file_name))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            print_information(
+                state, f"This folder was generated: {directory}", verbose_only=True
+            )
+        else:
+            print_information(
+                state, f"This folder already exists: {directory}", verbose_only=True
+            )
+
+        # Make sure no other scraper process works on the same file at the same time
+        lock = acquire_file_lock(state, file_name)
+        if lock is None:
+            print_information(
+                state,
+                f"download skipped - file is being downloaded by another process: {episode_name}",
+            )
+            emit_event(
+                state,
+                "episode_skipped",
+                file=file_name,
+                episode=episode_name,
+                reason="locked",
+            )
+            with state.stats_lock:
+                state.skip_counter += 1
+            return
+        moving = False
+        try:
+            moving = store_recording(
+                state, file_name, video_src_link, episode_name, lock, progress_position
+            )
+        finally:
+            if not moving:
+                release_file_lock(lock)
+
+
+def store_recording(
+    state, file_name, video_src_link, episode_name, lock, progress_position=None
+):
+    """Downloads a recording unless it already exists and records it in the history and library index
+
+    Must only be called while holding the lock for `file_name`, see `acquire_file_lock()`
+
+    Keyword arguments:
+    file_name         -- Name of the file to write the data to
+    video_src_link    -- The link to download the data from
+    episode_name      -- Name of the episode
+    lock              -- The lock of `file_name`
+    progress_position -- Line of the progress bar if several downloads run at the same time
+
+    Returns:
+    `True` if the recording is still being moved out of the staging directory, which then releases the lock
+    """
+
+    # Only known if the recording is downloaded now
+    fingerprint = None
+
+    # Check whether the library already has the recording in a different quality or under a different lecture
+    sufficient_copy = None
+    duplicate = None
+    if not os.path.isfile(file_name):
+        with state.library_lock:
+            if state.existing_quality != "exact":
+                sufficient_copy = find_sufficient_quality(state, file_name)
+            if state.link_duplicates and not sufficient_copy:
+                duplicate = find_duplicate(state, file_name)
+
+    # Check if file already exists
+    if os.path.isfile(file_name) and file_name not in state.changed_recordings:
+        print_information(
+            state, f"download skipped - file already exists: {episode_name}"
+        )
+        emit_event(
+            state,
+            "episode_skipped",
+            file=file_name,
+            episode=episode_name,
+            reason="exists",
+        )
+        with state.stats_lock:
+            state.skip_counter += 1
+    # Check if a good enough version of the file already exists
+    elif sufficient_copy:
+        print_information(
+            state,
+            f"download skipped - recording already exists in {sufficient_copy[0]}: {episode_name}",
+        )
+        print_information(
+            state, f"Existing copy: {sufficient_copy[1]}", verbose_only=True
+        )
+        emit_event(
+            state,
+            "episode_skipped",
+            file=file_name,
+            episode=episode_name,
+            reason="sufficient_quality",
+            existing=sufficient_copy[1],
+        )
+        with state.stats_lock:
+            state.skip_counter += 1
+    # Reuse an existing copy if possible
+    elif duplicate and link_duplicate(state, duplicate, file_name):
+        print_information(
+            state,
+            f"download skipped - linked existing copy ({state.link_duplicates}): {episode_name}",
+        )
+        print_information(state, f"Existing copy: {duplicate}", verbose_only=True)
+        emit_event(
+            state,
+            "episode_skipped",
+            file=file_name,
+            episode=episode_name,
+            reason="linked_duplicate",
+            existing=duplicate,
+        )
+        with state.stats_lock:
+            state.duplicate_counter += 1
+    # A previous run finished the download but could not move it
+    elif state.staging_dir and os.path.isfile(get_staging_file(state, file_name)):
+        print_information(
+            state,
+            f"Found finished download in staging directory: {episode_name}",
+            verbose_only=True,
+        )
+        write_journal(state, "done", file=file_name)
+        submit_move(state, file_name, episode_name, video_src_link, lock, None)
+        return True
+    # Don't download recordings only to delete them again to stay within the storage budget
+    # The size is known if it was asked for before, otherwise `download_video()` checks the response
+    elif would_be_evicted(
+        state, file_name, video_src_link, state.recording_sizes.get(video_src_link)
+    ):
+        skip_evicted_download(state, file_name, episode_name)
+        return False
+    # Otherwise download it
+    else:
+        part_file = (
+            get_staging_file(state, file_name) if state.staging_dir else file_name
+        ) + ".part"
+        # Continue the download of an interrupted run, only possible for plain video files
+        resume = state.resume_points.pop(file_name, None)
+        if (
+            not resume
+            or resume["part"] != part_file
+            or state.clip
+            or is_manifest_link(video_src_link)
+            or not os.path.isfile(part_file)
+            or resume["offset"] > os.path.getsize(part_file)
+        ):
+            resume = None
+        emit_event(
+            state,
+            "download_started",
+            file=file_name,
+            episode=episode_name,
+            link=video_src_link,
+        )
+        start = time.monotonic()
+        try:
+            with RecordingFile(
+                state, part_file, file_name, resume["offset"] if resume else 0
+            ) as f:
+                start_transfer(state, file_name, episode_name, f)
+                # Recordings only available as HLS or DASH stream are downloaded segment by segment
+                if is_manifest_link(video_src_link):
+                    download_segments(
+                        state, video_src_link, f, episode_name, progress_position
+                    )
+                elif resume:
+                    fingerprint = download_video(
+                        state,
+                        video_src_link,
+                        f,
+                        episode_name,
+                        progress_position,
+                        resume,
+                    )
+                else:
+                    fingerprint = download_from_peers(
+                        state,
+                        file_name,
+                        video_src_link,
+                        f,
+                        episode_name,
+                        progress_position,
+                    ) or (download_clip if state.clip else download_video)(
+                        state, video_src_link, f, episode_name, progress_position
+                    )
+        except DownloadEvicted:
+            os.remove(part_file)
+            skip_evicted_download(state, file_name, episode_name)
+            return False
+        except (
+            requests.exceptions.RequestException,
+            MediaError,
+            ElementTree.ParseError,
+        ) as e:
+            print_information(
+                state, f"Failed to download {episode_name}: {e}", type="error"
+            )
+            emit_event(
+                state,
+                "download_failed",
+                file=file_name,
+                episode=episode_name,
+                error=str(e),
+            )
+            return False
+        finally:
+            finish_transfer(state, file_name)
+
+        emit_event(
+            state,
+            "download_finished",
+            file=file_name,
+            episode=episode_name,
+            bytes=os.path.getsize(part_file),
+            seconds=round(time.monotonic() - start, 3),
+        )
+
+        # Remove `.part` suffix from file name, replacing the old version if the recording changed
+        os.replace(part_file, part_file[: -len(".part")])
+        if state.staging_dir:
+            write_journal(state, "done", file=file_name)
+            # The mover finishes the download once the file is at its destination
+            submit_move(
+                state, file_name, episode_name, video_src_link, lock, fingerprint
+            )
+            return True
+        complete_download(state, file_name, episode_name)
+
+    write_journal(state, "done", file=file_name)
+    record_recording(state, file_name, video_src_link, fingerprint)
+    return False
+
+
+def complete_download(state, file_name, episode_name):
+    """Counts a finished download and starts its post-processing
+
+    Keyword arguments:
+    file_name    -- Name of the downloaded file
+    episode_name -- Name of the episode
+    """
+
+    print_information(state, "Downloaded file: " + episode_name)
+    with state.stats_lock:
+        state.download_counter += 1
+    submit_post_processing(state, file_name, episode_name)
+
+
+def record_recording(state, file_name, video_src_link, fingerprint=None):
+    """Adds a recording to the library index and history file
+
+    Keyword arguments:
+    file_name      -- Name of the file of the recording
+    video_src_link -- The link the recording was downloaded from
+    fingerprint    -- Fingerprint of the recording if it was just downloaded, see `get_fingerprint()`
+    """
+    if (
+        state.link_duplicates
+        or state.existing_quality != "exact"
+        or state.refresh_changed
+        or state.library_server
+        or state.storage_budget
+        or state.include_evicted
+    ):
+        with state.library_lock:
+            if os.path.isfile(file_name):
+                add_to_library_index(state, file_name)
+                if fingerprint:
+                    set_fingerprint(state, file_name, fingerprint)
+                    mark_library_index_changed(state)
+            if state.existing_quality == "upgrade":
+                remove_lower_qualities(state, file_name)
+
+    if state.history_file:
+        # Regardless whether we just downloaded the file or it already exists on disk, we want to add it to the history file
+        append_to_history(state, video_src_link)
+
+
+def get_staging_file(state, file_name):
+    """Returns where a recording is downloaded to before it's moved to `file_name`, see `--staging-dir`"""
+    relative_path = os.path.relpath(
+        os.path.abspath(file_name), os.path.abspath(state.directory_prefix)
+    )
+    if relative_path.startswith(os.pardir):
+        relative_path = os.path.basename(file_name)
+    staging_file = os.path.join(state.staging_dir, relative_path)
+    os.makedirs(os.path.dirname(staging_file), exist_ok=True)
+    return staging_file
+
+
+def move_staged_file(state, staging_file, file_name):
+    """Moves a downloaded recording from the staging directory to its destination
+
+    The recording is copied next to its destination first and only renamed once the copy is complete,
+    so the destination never contains a partial file.
+
+    Keyword arguments:
+    staging_file -- The downloaded recording in the staging directory
+    file_name    -- The destination
+
+    Returns:
+    `True` if the recording was moved
+    """
+    temporary_file = file_name + ".part"
+    for attempt in range(MOVE_RETRIES + 1):
+        try:
+            shutil.copyfile(staging_file, temporary_file)
+            with open(temporary_file, "r+b") as f:
+                os.fsync(f.fileno())
+            if os.path.getsize(temporary_file) != os.path.getsize(staging_file):
+                raise OSError("size of the copy does not match")
+            os.replace(temporary_file, file_name)
+            os.remove(staging_file)
+            print_information(
+                state, f"Moved {staging_file} to {file_name}", verbose_only=True
+            )
+            emit_event(state, "moved", file=file_name, staging_file=staging_file)
+            return True
+        except OSError as e:
+            if attempt == MOVE_RETRIES:
+                print_information(
+                    state,
+                    f"Could not move {staging_file} to {file_name}: {e}. It is moved on the next run.",
+                    type="error",
+                )
+                emit_event(state, "move_failed", file=file_name, error=str(e))
+                return False
+            print_information(
+                state,
+                f"Retrying to move {staging_file} after error: {e}",
+                type="warning",
+                verbose_only=True,
+            )
+            time.sleep(2**attempt)
+
+
+def run_mover(state, jobs):
+    """Moves finished downloads to their destination until `None` is received, see `submit_move()`"""
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        file_name, episode_name, video_src_link, lock, fingerprint = job
+        try:
+            if move_staged_file(state, get_staging_file(state, file_name), file_name):
+                complete_download(state, file_name, episode_name)
+                record_recording(state, file_name, video_src_link, fingerprint)
+        except Exception as e:
+            # Keep the mover running, otherwise downloads would wait for it forever
+            print_information(
+                state, f"Failed to finish {episode_name}: {e}", type="error"
+            )
+        finally:
+            release_file_lock(lock)
+
+
+def submit_move(state, file_name, episode_name, video_src_link, lock, fingerprint):
+    """Hands a download in the staging directory to the mover thread
+
+    Waits if too many downloads are already waiting to be moved
+
+    Keyword arguments:
+    file_name      -- The destination of the recording
+    episode_name   -- Name of the episode
+    video_src_link -- The link the recording was downloaded from
+    lock           -- The lock of `file_name`, released once the recording has been moved
+    fingerprint    -- Fingerprint of the recording, see `get_fingerprint()`
+    """
+
+    with state.stats_lock:
+        if state.mover_thread is None:
+            state.move_queue = queue.Queue(maxsize=STAGING_QUEUE_SIZE)
+            state.mover_thread = threading.Thread(
+                target=run_mover, args=(state, state.move_queue), daemon=True
+            )
+            state.mover_thread.start()
+        jobs = state.move_queue
+    jobs.put((file_name, episode_name, video_src_link, lock, fingerprint))
+
+
+def finish_staging(state):
+    """Waits until all downloads have been moved out of the staging directory"""
+
+    with state.stats_lock:
+        thread = state.mover_thread
+        jobs = state.move_queue
+        state.mover_thread = None
+        state.move_queue = None
+    if thread is None:
+        return
+
+    if not jobs.empty():
+        print_information(
+            state, "Waiting for downloads to be moved out of the staging directory"
+        )
+    jobs.put(None)
+    thread.join()
+    # The mover added the moved recordings to the library index
+    with state.library_lock:
+        write_library_index(state)
+
+
+def parse_lecture_line(state, line):
+    """Splits a line of the links file into its parts
+
+    The link can be followed by username and password, as well as by `priority=N` and `weight=N`
+    to control the order of the downloads, see `DownloadScheduler`. With username and password,
+    the options come after them.
+
+    Returns:
+    A tuple `(link, user, password, priority, weight)` where user and password can be empty
+    """
+    link, *words = line.split(" ")
+    # Only take a word for an option where it can't be the username or password, e.g. `priority=1x`
+    if all(word.startswith(("priority=", "weight=")) for word in words if word):
+        credentials, options = list(), words
+    else:
+        credentials, options = words[:2], words[2:]
+    user, password = (credentials + ["", ""])[:2]
+
+    priority, weight = 0, 1
+    for word in options:
+        try:
+            if word.startswith("priority="):
+                priority = int(word[len("priority=") :])
+            elif word.startswith("weight="):
+                value = float(word[len("weight=") :])
+                if value <= 0:
+                    raise ValueError("weight must be positive")
+                weight = value
+        except ValueError as e:
+            print_information(state, f"Ignoring invalid `{word}`: {e}", type="warning")
+    return link, user, password, priority, weight
+
+
+class DownloadScheduler:
+    """Decides which recording to download next
+
+    Recordings from the last `NEWEST_DAYS` days come first. Apart from that lectures with a higher priority
+    come first, and lectures with the same priority take turns according to their weight (weighted round
+    robin), so a lecture with many recordings doesn't hold up all others.
+
+    Keyword arguments:
+    groups -- Lists of `(file_name, video_src_link, episode_name)` tuples, see `group_by_recording()`
+    """
+
+    def __init__(self, state, groups):
+        self.state = state
+        self.condition = threading.Condition()
+        # Recordings to download by `(newest, lecture directory)`
+        self.queues = dict()
+        # Credit of each queue for the weighted round robin
+        self.credit = dict()
+
+        cutoff = (
+            datetime.date.today() - datetime.timedelta(days=NEWEST_DAYS)
+        ).isoformat()
+        for group in groups:
+            file_name = group[0][0]
+            date = os.path.basename(file_name)[:10]
+            newest = bool(re.fullmatch(r"\d{4}-\d{2}-\d{2}", date)) and date >= cutoff
+            key = (newest, os.path.dirname(file_name))
+            self.queues.setdefault(key, collections.deque()).append(group)
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(recordings) for recordings in self.queues.values())
+
+    def get_priority(self, lecture):
+        """Returns `(priority, weight)` of a lecture"""
+        return self.state.lecture_priorities.get(lecture, (0, 1))
+
+    def get_lectures(self):
+        """Returns the directories of all lectures with recordings left to download"""
+        with self.condition:
+            return {key[1] for key, recordings in self.queues.items() if recordings}
+
+    def set_priority(self, lecture, priority, weight):
+        """Changes the priority and weight of a lecture for the recordings left to download"""
+        with self.condition:
+            self.state.lecture_priorities[lecture] = (priority, weight)
+
+    def run(self, download, workers):
+        """Downloads all recordings with several threads
+
+        Keyword arguments:
+        download -- Function downloading a recording, see `download_recording()`
+        workers  -- Number of threads, more can be added later with `add_workers()`
+        """
+        self.download = download
+        self.futures = list()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_DOWNLOAD_WORKERS
+        )
+        try:
+            self.add_workers(workers)
+            # Raise errors of the downloads, if any
+            finished = 0
+            while True:
+                with self.condition:
+                    if finished == len(self.futures):
+                        break
+                    future = self.futures[finished]
+                future.result()
+                finished += 1
+        except KeyboardInterrupt:
+            # Don't start the remaining downloads and stop the running ones instead of waiting for them
+            with self.condition:
+                self.queues.clear()
+            stop_downloads(self.state)
+            raise
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def add_workers(self, count):
+        """Starts more threads downloading recordings"""
+        with self.condition:
+            count = min(count, MAX_DOWNLOAD_WORKERS - len(self.futures))
+            self.futures += [self.executor.submit(self.work) for _ in range(count)]
+
+    def work(self):
+        """Downloads recordings until there are none left"""
+        while True:
+            streams = self.next()
+            if streams is None:
+                return
+            self.download(streams, True)
+
+    def next(self):
+        """Returns the next recording to download or `None` if there is none left"""
+        # Don't start new downloads while paused
+        wait_for_transfer(self.state, 0)
+        with self.condition:
+            candidates = [key for key, recordings in self.queues.items() if recordings]
+            if not candidates:
+                return None
+
+            # Newest recordings first, then the lectures with the highest priority
+            best = max((key[0], self.get_priority(key[1])[0]) for key in candidates)
+            candidates = [
+                key
+                for key in candidates
+                if (key[0], self.get_priority(key[1])[0]) == best
+            ]
+
+            # Lectures take turns, lectures with a higher weight get more turns
+            total_weight = 0
+            for key in candidates:
+                weight = self.get_priority(key[1])[1]
+                self.credit[key] = self.credit.get(key, 0) + weight
+                total_weight += weight
+            key = max(candidates, key=lambda key: self.credit[key])
+            self.credit[key] -= total_weight
+            return self.queues[key].popleft()
+
+
+def group_by_recording(collection):
+    """Groups consecutive entries of the collection that belong to the same recording, e.g. its different streams
+
+    Keyword arguments:
+    collection -- List of `(file_name, video_src_link, episode_name)` tuples
+
+    Returns:
+    A list of lists of `(file_name, video_src_link, episode_name)` tuples
+    """
+    groups = list()
+    for item in collection:
+        if groups and get_pseudo_hash(groups[-1][-1][1]) == get_pseudo_hash(item[1]):
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+    return groups
+
+
+def acquire_progress_position(state):
+    """Reserves the topmost free line for a progress bar"""
+    with state.stats_lock:
+        position = 0
+        while position in state.progress_positions:
+            position += 1
+        state.progress_positions.add(position)
+        return position
+
+
+def release_progress_position(state, position):
+    """Frees the line of a progress bar, see `acquire_progress_position()`"""
+    with state.stats_lock:
+        state.progress_positions.discard(position)
+
+
+def download_stream(state, file_name, video_src_link, episode_name):
+    """Downloads a recording while other downloads run at the same time, each with its own progress bar"""
+    position = acquire_progress_position(state)
+    try:
+        downloader(state, file_name, video_src_link, episode_name, position)
+    finally:
+        release_progress_position(state, position)
+
+
+def download_recording(state, streams, parallel=False):
+    """Downloads all streams of a recording at the same time
+
+    Keyword arguments:
+    streams  -- List of `(file_name, video_src_link, episode_name)` tuples belonging to the same recording
+    parallel -- Whether other recordings are downloaded at the same time
+    """
+    if len(streams) == 1:
+        if parallel:
+            download_stream(state, *streams[0])
+        else:
+            downloader(state, *streams[0])
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        futures = [
+            executor.submit(download_stream, state, *stream) for stream in streams
+        ]
+        # Raise errors of the downloads, if any
+        try:
+            for future in futures:
+                future.result()
+        except KeyboardInterrupt:
+            # Leaving the block waits for the other streams
+            stop_downloads(state)
+            raise
+
+
+def download_recordings(state, collection):
+    """Downloads all recordings, several at the same time as far as the hosts allow it
+
+    The number of parallel downloads per host is adjusted to the throughput, see `ConcurrencyController`
+
+    Keyword arguments:
+    collection -- List of `(file_name, video_src_link, episode_name)` tuples
+    """
+
+    # An earlier run may have been interrupted
+    state.downloads_stopped = False
+    if state.refresh_changed and not state.print_src:
+        find_changed_recordings(state, collection)
+    # Look at the library again, other processes may have changed it since the last run
+    state.storage_plan = None
+
+    groups = group_by_recording(collection)
+
+    # Printed links should stay in order
+    if state.print_src:
+        for streams in groups:
+            download_recording(state, streams)
+        return
+
+    # Remember what this run downloads in case it is interrupted
+    open_run_journal(state, collection)
+
+    scheduler = DownloadScheduler(state, groups)
+    state.download_scheduler = scheduler
+    try:
+        # With the control endpoint the connections can be raised later, so always use threads
+        if (state.max_connections == 1 and not state.control_server) or len(
+            groups
+        ) == 1:
+            while True:
+                streams = scheduler.next()
+                if streams is None:
+                    break
+                download_recording(state, streams)
+        else:
+            scheduler.run(
+                functools.partial(download_recording, state), state.max_connections
+            )
+    finally:
+        state.download_scheduler = None
+        with state.library_lock:
+            write_library_index(state)
+
+    # Nothing left to recover, the journal is kept if the run was interrupted by an error
+    close_run_journal(state)
+
+
+def open_run_journal(state, collection):
+    """Starts the journal of a run, which `--recover` uses to continue the run if it is interrupted
+
+    The journal lists all recordings of the run and is appended to as they are downloaded. It is locked while
+    the run is in progress and deleted once the run finished, so only journals of interrupted runs remain.
+
+    Keyword arguments:
+    collection -- List of `(file_name, video_src_link, episode_name)` tuples the run downloads
+    """
+
+    if not collection or state.run_journal is not None:
+        return
+    journal_dir = state.directory_prefix + JOURNAL_DIR
+    os.makedirs(journal_dir, exist_ok=True)
+    state.run_journal_file = os.path.join(
+        journal_dir,
+        f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}.jsonl",
+    )
+    state.run_journal_lock = acquire_file_lock(state, state.run_journal_file)
+    state.run_journal = open(state.run_journal_file, "a", encoding="utf-8")
+    print_information(
+        state, f"Writing run journal: {state.run_journal_file}", verbose_only=True
+    )
+
+    # Syncing once after writing the whole plan is enough
+    write_journal(
+        state, "run", sync=False, directory=state.directory_prefix, pid=os.getpid()
+    )
+    for file_name, video_src_link, episode_name in collection:
+        priority, weight = state.lecture_priorities.get(
+            os.path.dirname(file_name), (0, 1)
+        )
+        write_journal(
+            state,
+            "planned",
+            sync=False,
+            file=file_name,
+            link=video_src_link,
+            episode=episode_name,
+            priority=priority,
+            weight=weight,
+        )
+    # Carry over where the downloads of recovered runs stopped
+    for file_name, resume in state.resume_points.items():
+        write_journal(
+            state,
+            "started",
+            sync=False,
+            file=file_name,
+            **{key: value for key, value in resume.items() if key != "offset"},
+        )
+        write_journal(
+            state, "progress", sync=False, file=file_name, offset=resume["offset"]
+        )
+    with state.run_journal_write_lock:
+        os.fsync(state.run_journal.fileno())
+
+    # Everything of the recovered runs is in this journal now
+    while state.recovered_journals:
+        journal_file, lock = state.recovered_journals.pop()
+        os.remove(journal_file)
+        release_file_lock(lock)
+
+
+def write_journal(state, record_type, sync=True, **fields):
+    """Appends a record to the journal of the current run, if there is one
+
+    Keyword arguments:
+    record_type -- One of `run`, `planned`, `started`, `progress` or `done`
+    sync        -- Whether to make sure the record is on disk before returning
+    fields      -- Details of the record, most records have the `file` of the recording
+    """
+    line = json.dumps({"type": record_type, **fields}, ensure_ascii=False)
+    with state.run_journal_write_lock:
+        if state.run_journal is None:
+            return
+        state.run_journal.write(line + "\n")
+        state.run_journal.flush()
+        if sync:
+            os.fsync(state.run_journal.fileno())
+
+
+def close_run_journal(state):
+    """Deletes the journal of the current run after all its recordings were processed"""
+
+    with state.run_journal_write_lock:
+        if state.run_journal is None:
+            return
+        state.run_journal.close()
+        state.run_journal = None
+    try:
+        os.remove(state.run_journal_file)
+    except FileNotFoundError:
+        pass
+    release_file_lock(state.run_journal_lock)
+    state.run_journal_lock = None
+
+
+def read_run_journal(state, journal_file):
+    """Reads the journal of an interrupted run
+
+    Keyword arguments:
+    journal_file -- The journal to read
+
+    Returns:
+    A tuple of the list of `(file_name, video_src_link, episode_name)` tuples that are not done yet
+    and a dictionary of resume points for the recordings that were partially downloaded
+    """
+    planned = dict()
+    done = set()
+    started = dict()
+    progress = dict()
+    with open(journal_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                record_type = record["type"]
+                if record_type == "planned":
+                    planned[record["file"]] = record
+                elif record_type == "done":
+                    done.add(record["file"])
+                elif record_type == "started":
+                    started[record["file"]] = record
+                    # A new download of the recording started from the beginning
+                    progress.pop(record["file"], None)
+                elif record_type == "progress":
+                    progress[record["file"]] = record["offset"]
+            except (json.decoder.JSONDecodeError, KeyError, TypeError):
+                # The last line might be incomplete if the scraper was killed while writing it
+                print_information(
+                    state,
+                    f"Skipping invalid line in run journal {journal_file}",
+                    type="warning",
+                    verbose_only=True,
+                )
+
+    collection = list()
+    resume = dict()
+    for file_name, record in planned.items():
+        if file_name in done:
+            continue
+        collection.append((file_name, record["link"], record["episode"]))
+        state.lecture_priorities[os.path.dirname(file_name)] = (
+            record.get("priority", 0),
+            record.get("weight", 1),
+        )
+        if progress.get(file_name) and file_name in started:
+            resume[file_name] = {
+                "part": started[file_name].get("part"),
+                "offset": progress[file_name],
+                "etag": started[file_name].get("etag"),
+                "last_modified": started[file_name].get("last_modified"),
+            }
+    return collection, resume
+
+
+def recover_interrupted_runs(state):
+    """Gets the recordings of all interrupted runs from their journals, see `--recover`
+
+    Journals of runs that are still in progress are locked and left alone. The journals of the recovered
+    runs are deleted once the current run has written its own journal.
+
+    Returns:
+    A list of `(file_name, video_src_link, episode_name)` tuples ready to be passed to `downloader()`
+    """
+    journal_dir = state.directory_prefix + JOURNAL_DIR
+    try:
+        journal_files = sorted(
+            os.path.join(journal_dir, name)
+            for name in os.listdir(journal_dir)
+            if name.endswith(".jsonl")
+        )
+    except FileNotFoundError:
+        journal_files = list()
+
+    collection = list()
+    for journal_file in journal_files:
+        lock = acquire_file_lock(state, journal_file)
+        if lock is None:
+            print_information(
+                state,
+                f"Run journal belongs to a scraper that is still running: {journal_file}",
+                verbose_only=True,
+            )
+            continue
+        try:
+            journal_collection, journal_resume = read_run_journal(state, journal_file)
+        except OSError as e:
+            print_information(
+                state, f"Could not read run journal {journal_file}: {e}", type="warning"
+            )
+            release_file_lock(lock)
+            continue
+        if not journal_collection:
+            # The run was interrupted after it downloaded everything, nothing to recover
+            print_information(
+                state,
+                f"Removing run journal with nothing left to download: {journal_file}",
+                verbose_only=True,
+            )
+            os.remove(journal_file)
+            release_file_lock(lock)
+            continue
+        collection += [item for item in journal_collection if item not in collection]
+        for file_name, resume in journal_resume.items():
+            # Only continue files that still have the downloaded data
+            if resume["part"] and os.path.isfile(resume["part"]):
+                state.resume_points[file_name] = resume
+        state.recovered_journals.append((journal_file, lock))
+
+    if state.recovered_journals:
+        print_information(
+            state,
+            f"Recovered {len(collection)} recordings of {len(state.recovered_journals)} interrupted runs, "
+            f"{len(state.resume_points)} of them partially downloaded",
+        )
+    else:
+        print_information(state, "No interrupted runs found to recover")
+    return collection
+
+
+def wait_for_transfer(state, amount):
+    """Waits while downloads are paused and keeps them within `rate_limit`
+
+    Keyword arguments:
+    amount -- Number of bytes just received
+    """
+
+    # Called for every chunk of every download, so only wait for the lock if necessary
+    if state.downloads_paused:
+        with state.transfer_condition:
+            while state.downloads_paused and not state.downloads_stopped:
+                state.transfer_condition.wait()
+    if state.downloads_stopped:
+        raise KeyboardInterrupt
+    if not amount:
+        return
+
+    now = time.monotonic()
+    second = int(now)
+    with state.received_lock:
+        bucket = state.received_buckets[second % RATE_WINDOW]
+        if bucket[0] != second:
+            bucket[0] = second
+            bucket[1] = 0
+        bucket[1] += amount
+        if state.first_received_time is None:
+            state.first_received_time = now
+
+    if not state.rate_limit:
+        return
+    with state.transfer_condition:
+        # Allow bursts of up to one second worth of data
+        state.rate_allowance = min(
+            state.rate_limit,
+            state.rate_allowance + (now - state.rate_allowance_time) * state.rate_limit,
+        )
+        state.rate_allowance_time = now
+        state.rate_allowance -= amount
+        delay = -state.rate_allowance / state.rate_limit
+    if delay > 0:
+        time.sleep(delay)
+
+
+def start_transfer(state, file_name, episode_name, f):
+    """Shows a download in the status of the control endpoint
+
+    Keyword arguments:
+    file_name    -- Name of the file of the recording
+    episode_name -- Name of the episode
+    f            -- The `RecordingFile` the recording is downloaded to
+    """
+    with state.transfer_condition:
+        state.active_transfers[file_name] = {
+            "episode": episode_name,
+            "file": f,
+            "started": time.monotonic(),
+        }
+
+
+def finish_transfer(state, file_name):
+    """Removes a download from the status of the control endpoint"""
+
+    with state.transfer_condition:
+        transfer = state.active_transfers.pop(file_name, None)
+        if transfer and transfer["file"].position:
+            state.finished_transfers += 1
+            state.finished_transfer_bytes += transfer["file"].position
+
+
+def stop_downloads(state):
+    """Stops the downloads running in other threads after the run was interrupted, e.g. by Ctrl+C"""
+
+    with state.transfer_condition:
+        state.downloads_stopped = True
+        state.transfer_condition.notify_all()
+
+
+def pause_downloads(state):
+    """Pauses all downloads, downloads in progress continue where they stopped after `resume_downloads()`"""
+
+    with state.transfer_condition:
+        state.downloads_paused = True
+    print_information(state, "Downloads paused")
+    emit_event(state, "paused")
+
+
+def resume_downloads(state):
+    """Resumes downloads paused with `pause_downloads()`"""
+
+    with state.transfer_condition:
+        if state.downloads_paused:
+            state.downloads_paused = False
+            state.resume_counter += 1
+        state.transfer_condition.notify_all()
+    print_information(state, "Downloads resumed")
+    emit_event(state, "resumed")
+
+
+def set_rate_limit(state, limit):
+    """Changes the maximum download speed in bytes per second, 0 for no limit"""
+
+    with state.transfer_condition:
+        state.rate_limit = max(0, limit)
+    print_information(
+        state,
+        (
+            f"Download speed limited to {state.rate_limit / 1024 / 1024:.2f} MiB/s"
+            if state.rate_limit
+            else "Download speed not limited anymore"
+        ),
+        verbose_only=True,
+    )
+
+
+def set_max_connections(state, connections):
+    """Changes the maximum number of connections per host while the scraper is running"""
+
+    state.max_connections = min(max(1, connections), MAX_DOWNLOAD_WORKERS)
+    with state.concurrency_controllers_lock:
+        controllers = list(state.concurrency_controllers.values())
+    for controller in controllers:
+        with controller.condition:
+            controller.max_limit = state.max_connections
+            controller.limit = min(controller.limit, state.max_connections)
+            controller.condition.notify_all()
+
+    # Start more downloads at the same time if necessary
+    scheduler = state.download_scheduler
+    if scheduler and hasattr(scheduler, "futures"):
+        running = sum(not future.done() for future in scheduler.futures)
+        if running < state.max_connections:
+            scheduler.add_workers(state.max_connections - running)
+    print_information(
+        state,
+        f"Maximum connections per host set to {state.max_connections}",
+        verbose_only=True,
+    )
+
+
+def set_lecture_priority(state, lecture, priority=None, weight=None):
+    """Changes priority and weight of a lecture, see `DownloadScheduler`
+
+    Keyword arguments:
+    lecture  -- Title or directory of the lecture
+    priority -- New priority, unchanged if not given
+    weight   -- New weight, unchanged if not given
+
+    Returns:
+    The number of lecture directories that were changed
+    """
+    if weight is not None and weight <= 0:
+        raise ValueError("weight must be positive")
+    scheduler = state.download_scheduler
+    lectures = set(state.lecture_priorities)
+    if scheduler:
+        lectures |= scheduler.get_lectures()
+    matching = [
+        directory
+        for directory in lectures
+        if lecture in (directory, os.path.basename(os.path.normpath(directory)))
+    ]
+    for directory in matching:
+        old_priority, old_weight = state.lecture_priorities.get(directory, (0, 1))
+        new_priority = (
+            old_priority if priority is None else priority,
+            old_weight if weight is None else weight,
+        )
+        if scheduler:
+            scheduler.set_priority(directory, *new_priority)
+        else:
+            state.lecture_priorities[directory] = new_priority
+    return len(matching)
+
+
+def print_status_line(state):
+    """Shows the progress of all downloads in one line, for parallel downloads without tqdm
+
+    Called for every chunk, but only prints every `STATUS_LINE_INTERVAL` seconds
+    """
+
+    now = time.monotonic()
+    with state.stats_lock:
+        if now - state.status_line_time < STATUS_LINE_INTERVAL:
+            return
+        state.status_line_time = now
+
+    status = get_status(state)
+    received = sum(transfer["bytes"] for transfer in status["active"])
+    total = sum(transfer["total"] or 0 for transfer in status["active"])
+    line = (
+        f"{len(status['active'])} downloads: {received / 1024 / 1024:.1f} of {total / 1024 / 1024:.1f} MiB"
+        f" at {status['rate'] / 1024 / 1024:.1f} MiB/s, {status['queued']} queued"
+    )
+    width = shutil.get_terminal_size().columns - 1
+    sys.stdout.write(f"\r{line[:width]:<{width}}")
+    sys.stdout.flush()
+
+
+def get_status(state):
+    """Returns the progress of the scraper as shown by the control endpoint"""
+    now = time.monotonic()
+    second = int(now)
+    with state.received_lock:
+        received = sum(
+            amount
+            for bucket_second, amount in state.received_buckets
+            if bucket_second > second - RATE_WINDOW
+        )
+        started = state.first_received_time
+    rate = 0
+    if started is not None:
+        # The current second has only just begun
+        window = min(RATE_WINDOW - 1 + now - second, now - started)
+        rate = received / max(1, window)
+
+    with state.transfer_condition:
+        active = [
+            {
+                "file": file_name,
+                "episode": transfer["episode"],
+                "bytes": transfer["file"].position,
+                "total": transfer["file"].expected_size,
+                "seconds": round(now - transfer["started"], 1),
+                "rate": round(
+                    transfer["file"].position / max(0.001, now - transfer["started"])
+                ),
+            }
+            for file_name, transfer in state.active_transfers.items()
+        ]
+        paused = state.downloads_paused
+        average_size = (
+            state.finished_transfer_bytes / state.finished_transfers
+            if state.finished_transfers
+            else None
+        )
+
+    scheduler = state.download_scheduler
+    queued = len(scheduler) if scheduler else 0
+
+    # Estimate the remaining bytes from the size of the recordings downloaded so far
+    known_sizes = [transfer["total"] for transfer in active if transfer["total"]]
+    if average_size is None and known_sizes:
+        average_size = sum(known_sizes) / len(known_sizes)
+    eta = None
+    if rate and (average_size is not None or not queued):
+        remaining = sum(
+            max(0, transfer["total"] - transfer["bytes"])
+            for transfer in active
+            if transfer["total"]
+        ) + queued * (average_size or 0)
+        eta = round(remaining / rate)
+
+    lectures = set(state.lecture_priorities) | (
+        scheduler.get_lectures() if scheduler else set()
+    )
+    return {
+        "state": "paused" if paused else "running",
+        "queued": queued,
+        "active": active,
+        "rate": round(rate),
+        "eta_seconds": eta,
+        "max_connections": state.max_connections,
+        "rate_limit": state.rate_limit,
+        "lectures": {
+            os.path.basename(os.path.normpath(lecture)): dict(
+                zip(
+                    ("priority", "weight"),
+                    state.lecture_priorities.get(lecture, (0, 1)),
+                )
+            )
+            for lecture in sorted(lectures)
+        },
+        "found": state.link_counter,
+        "downloaded": state.download_counter,
+        "skipped": state.skip_counter,
+        "reconnected": state.stall_counter,
+        "errors": list(state.recent_errors),
+    }
+
+
+class ControlRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Answers requests to the control endpoint, see `--control`
+
+    `GET /status` returns the progress, `POST /pause`, `/resume`, `/priority?lecture=...&priority=...&weight=...`
+    and `/limits?connections=...&rate=...` change how the scraper continues. All answers are JSON.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        state = self.server.state
+        if urlparse(self.path).path == "/status":
+            self.send_json(200, get_status(state))
+        else:
+            self.send_json(404, {"error": "unknown endpoint"})
+
+    def do_POST(self):
+        # Ignore the body, everything is passed in the query
+        state = self.server.state
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/pause":
+                pause_downloads(state)
+            elif url.path == "/resume":
+                resume_downloads(state)
+            elif url.path == "/priority":
+                if "lecture" not in query:
+                    raise ValueError("`lecture` is missing")
+                changed = set_lecture_priority(
+                    state,
+                    query["lecture"],
+                    int(query["priority"]) if "priority" in query else None,
+                    float(query["weight"]) if "weight" in query else None,
+                )
+                if not changed:
+                    self.send_json(
+                        404, {"error": f"unknown lecture {query['lecture']}"}
+                    )
+                    return
+            elif url.path == "/limits":
+                if "connections" in query:
+                    set_max_connections(state, int(query["connections"]))
+                if "rate" in query:
+                    set_rate_limit(state, parse_speed(query["rate"]))
+            else:
+                self.send_json(404, {"error": "unknown endpoint"})
+                return
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.send_json(200, get_status(state))
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        state = self.server.state
+        print_information(
+            state,
+            f"Control endpoint: {self.address_string()} {format % args}",
+            verbose_only=True,
+        )
+
+
+def parse_control_address(value):
+    """Parses `[HOST:]PORT` for `--control`, only listening on the local machine if no host is given"""
+    return parse_address(value, default_host="127.0.0.1")
+
+
+def start_control_server(state, address):
+    """Answers requests to the control endpoint in a background thread
+
+    Keyword arguments:
+    address -- `(host, port)` to listen on
+    """
+
+    state.control_server = http.server.ThreadingHTTPServer(
+        address, ControlRequestHandler
+    )
+    state.control_server.state = state
+    state.control_server.daemon_threads = True
+    threading.Thread(target=state.control_server.serve_forever, daemon=True).start()
+    print_information(
+        state,
+        f"Control endpoint listening on http://{address[0]}:{state.control_server.server_address[1]}/status",
+    )
+
+
+def write_printed_src_links(state):
+    """Writes the source links collected by `downloader()` to `file_to_print_src_to`"""
+    if not state.printed_src_links:
+        return
+    with open(state.file_to_print_src_to, "a") as f:
+        f.write("".join(link + "\n" for link in state.printed_src_links))
+    state.printed_src_links.clear()
+
+
+def get_download_headers(state, video_src_link=""):
+    """Returns the HTTP headers needed to download recordings, including the login cookies
+
+    Keyword arguments:
+    video_src_link -- The link to the recording, recordings of an executed plan use the headers stored with them
+    """
+    if video_src_link in state.plan_headers:
+        return dict(state.plan_headers[video_src_link])
+    headers = {"User-Agent": USER_AGENT}
+    if state.cookie_jar:
+        headers["Cookie"] = "; ".join(
+            f"{cookie.name}={cookie.value}" for cookie in state.cookie_jar
+        )
+    return headers
+
+
+def get_content_length(state, video_src_link):
+    """Asks the server for the size of a recording without downloading it
+
+    Keyword arguments:
+    video_src_link -- The link to the recording
+
+    Returns:
+    The size in bytes or `None` if the server didn't tell us
+    """
+    try:
+        with adaptive_request(
+            state,
+            "metadata",
+            video_src_link,
+            method="HEAD",
+            headers={"User-Agent": USER_AGENT},
+            allow_redirects=True,
+            timeout=30,
+        ) as r:
+            if r.ok and r.headers.get("content-length"):
+                state.recording_sizes[video_src_link] = int(r.headers["content-length"])
+                return state.recording_sizes[video_src_link]
+    except requests.exceptions.RequestException as e:
+        print_information(
+            state, f"Could not get size of {video_src_link}: {e}", type="warning"
+        )
+    return None
+
+
+def get_content_lengths(state, video_src_links):
+    """Gets the size of multiple recordings using parallel requests
+
+    Keyword arguments:
+    video_src_links -- The links to the recordings
 
-                        # Download to file and update progressbar
-                        for data in response.iter_content(chunk_size=4096):
-                            pbar.update(len(data))
-                            f.write(data)
-                        # Close it
-                        pbar.close()
+    Returns:
+    A dictionary mapping each link to its size in bytes (or `None` if unknown)
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        sizes = executor.map(
+            functools.partial(get_content_length, state), video_src_links
+        )
+    return dict(zip(video_src_links, sizes))
 
-                    # If tqdm is not installed, fallback to self-made version
-                    except ModuleNotFoundError:
-                        print_information(
-                            "Optionally dependency tqdm not installed, falling back to built-in progressbar",
-                            type="warning",
-                            verbose_only=True,
-                        )
-                        dl = 0
-                        for data in response.iter_content(chunk_size=4096):
-                            dl += len(data)
-                            f.write(data)
-                            progressbar_width = shutil.get_terminal_size().columns - 2
-                            done = int(progressbar_width * dl / total_length)
-                            sys.stdout.write(
-                                f"\r[{'=' * done}{' ' * (progressbar_width - done)}]"
-                            )
-                            sys.stdout.flush()
-            print()
 
-            # Remove `.part` suffix from file name
-            os.rename(file_name + ".part", file_name)
-            print_information("Downloaded file: " + episode_name)
-            download_counter += 1
+def write_download_plan(state, collection, plan_file, plan_format):
+    """Writes all resolved downloads to a file so they can be handed to an external downloader
+
+    Keyword arguments:
+    collection  -- List of `(file_name, video_src_link, episode_name)` tuples to export
+    plan_file   -- The file to write the plan to
+    plan_format -- One of `jsonl` (one JSON object per recording), `aria2c` (input file for `aria2c -i`)
+                   or `wget` (shell script calling wget)
+    """
+    headers = get_download_headers(state)
+    print_information(
+        state, f"Getting file sizes of {len(collection)} recordings", verbose_only=True
+    )
+    sizes = get_content_lengths(
+        state, [video_src_link for _, video_src_link, _ in collection]
+    )
+
+    lines = list()
+    if plan_format == "wget":
+        lines.append("#!/bin/sh")
+        header_args = " ".join(
+            f"--header {shlex.quote(key + ': ' + value)}"
+            for key, value in headers.items()
+        )
+
+    for file_name, video_src_link, episode_name in collection:
+        parsed = parse_recording_file_name(file_name)
+        if plan_format == "jsonl":
+            lines.append(
+                json.dumps(
+                    {
+                        "file_name": file_name,
+                        "relative_path": os.path.relpath(
+                            file_name, state.directory_prefix
+                        ),
+                        "video_src_link": video_src_link,
+                        "episode_name": episode_name,
+                        "quality": parsed[0] if parsed else None,
+                        "size": sizes[video_src_link],
+                        "headers": headers,
+                    }
+                )
+            )
+        elif plan_format == "aria2c":
+            lines.append(video_src_link)
+            lines.append(f"  dir={os.path.dirname(os.path.abspath(file_name))}")
+            lines.append(f"  out={os.path.basename(file_name)}")
+            for key, value in headers.items():
+                lines.append(f"  header={key}: {value}")
+        elif plan_format == "wget":
+            directory = os.path.dirname(os.path.abspath(file_name))
+            lines.append(
+                f"mkdir -p {shlex.quote(directory)} && wget --continue {header_args} -O {shlex.quote(file_name)} {shlex.quote(video_src_link)}"
+            )
+
+    # Write everything at once
+    with open(plan_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    total_size = sum(size for size in sizes.values() if size)
+    print_information(
+        state,
+        f"Exported {len(collection)} recordings ({total_size / 1024 / 1024:.2f} MiB) to {plan_file}",
+    )
+
+
+def read_download_plan(state, plan_file, rebase=False):
+    """Reads a download plan written by `--export-plan` in the `jsonl` format
 
-        if history_file:
-            # Regardless whether we just downloaded the file or it already exists on disk, we want to add it to the history file
-            with open(history_file, "a") as file:
-                file.write(video_src_link + "\n")
+    Keyword arguments:
+    plan_file -- The file to read the plan from
+    rebase    -- If true the recordings are placed relative to the current `directory_prefix`
+                 instead of the location they were planned for
+
+    Returns:
+    A list of `(file_name, video_src_link, episode_name)` tuples ready to be passed to `downloader()`,
+    raises `ScraperError` if the plan file doesn't exist
+    """
+    collection = list()
+    try:
+        with open(plan_file, "r") as f:
+            for line_nr, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    file_name = item["file_name"]
+                    if rebase:
+                        file_name = state.directory_prefix + item.get(
+                            "relative_path", os.path.basename(file_name)
+                        )
+                    collection.append(
+                        (file_name, item["video_src_link"], item["episode_name"])
+                    )
+                    # The executing host may not be logged in, so send what the planning host sent
+                    if isinstance(item.get("headers"), dict):
+                        state.plan_headers[item["video_src_link"]] = item["headers"]
+                except (json.decoder.JSONDecodeError, KeyError, TypeError):
+                    print_information(
+                        state,
+                        f"Skipping invalid line {line_nr} in plan file {plan_file}",
+                        type="warning",
+                    )
+    except FileNotFoundError:
+        raise ScraperError(f'No plan file with name "{plan_file}" found')
+
+    print_information(
+        state,
+        f"Read {len(collection)} recordings from plan file {plan_file}",
+        verbose_only=True,
+    )
+    return collection
 
 
-def check_connection():
+def check_connection(state):
     """Checks connection to video.ethz.ch and if it fails then also to the internet"""
     try:
-        print_information("Checking connection to video.ethz.ch", verbose_only=True)
+        print_information(
+            state, "Checking connection to video.ethz.ch", verbose_only=True
+        )
         req = Request("https://video.ethz.ch/", headers={"User-Agent": "Mozilla/5.0"})
         urllib.request.urlopen(req)
     except urllib.error.URLError:
         try:
             print_information(
-                "There seems to be no connection to video.ethz.ch", type="error"
+                state, "There seems to be no connection to video.ethz.ch", type="error"
             )
             print_information(
+                state,
                 "Checking connection to the internet by connecting to duckduckgo.com",
                 verbose_only=True,
             )
             urllib.request.urlopen("https://www.duckduckgo.com")
         except urllib.error.URLError:
             print_information(
+                state,
                 "There seems to be no internet connection - please connect to the internet and try again.",
                 type="error",
             )
         sys.exit(1)
 
 
-def report_bug():
+def report_bug(state):
     """Opens GitHub issue page in browser"""
-    print_information(GITHUB_ISSUE_PAGE)
+    print_information(state, GITHUB_ISSUE_PAGE)
     try:
         input("Press enter to open the link in your browser or Ctrl+C to exit.")
         webbrowser.open(GITHUB_ISSUE_PAGE)
     except KeyboardInterrupt:
-        print()
-    print_information("Exiting...")
+        print(file=state.output)
+    print_information(state, "Exiting...")
     sys.exit(0)
 
 
@@ -848,7 +6453,7 @@ def version_tuple(version):
     return tuple(map(int, (version.replace("v", "").split("."))))
 
 
-def check_update():
+def check_update(state):
     """
     Checks for a new version of the scraper and prompts the user if a new version is available
     """
@@ -857,7 +6462,7 @@ def check_update():
     global GITHUB_REPO_PAGE
     global GITHUB_CHANGELOG_PAGE
 
-    print_information("Checking for update", verbose_only=True)
+    print_information(state, "Checking for update", verbose_only=True)
 
     # try/except block to not crash the scraper just because it couldn't connect to server holding the version number
     try:
@@ -874,28 +6479,35 @@ def check_update():
             if remote_version > local_version:
                 # There's an update available, prompt the user
                 print_information(
+                    state,
                     f"A new version of the VO-scraper is available: {'.'.join(map(str, remote_version))}",
                     type="warning",
                 )
                 print_information(
+                    state,
                     f"You have version: {'.'.join(map(str, local_version))}",
                     type="warning",
                 )
                 print_information(
+                    state,
                     f"You can download the new version from here: {GITHUB_REPO_PAGE}",
                     type="warning",
                 )
                 print_information(
+                    state,
                     f"The changelog can be found here: {GITHUB_CHANGELOG_PAGE}/{remote_version_string}",
                     type="warning",
                 )
                 print_information(
-                    "Press enter to continue with the current version", type="warning"
+                    state,
+                    "Press enter to continue with the current version",
+                    type="warning",
                 )
                 input()
             else:
                 # We are up to date
                 print_information(
+                    state,
                     "Scraper is up to date according to version number in remote repo.",
                     verbose_only=True,
                 )
@@ -903,11 +6515,182 @@ def check_update():
             raise Exception  # We couldn't get the file for some reason
     except Exception:
         # Update check failed
-        print_information("Update check failed, skipping...", type="warning")
+        print_information(state, "Update check failed, skipping...", type="warning")
         # Note: We don't want the scraper to fail because it couldn't check for a new version so we continue regardless
 
 
-def read_links_from_file(file):
+def parse_catalogue(value):
+    """Parses the value of `--discover` in the form of `department/year/semester`
+
+    Also accepts the link to the catalogue page, e.g. `https://video.ethz.ch/lectures/d-infk/2019/spring.html`
+
+    Returns:
+    The link to the catalogue page
+    """
+    path = value.strip().replace("www.", "").replace(CATALOGUE_PREFIX, "")
+    path = path.replace(".html", "").strip("/")
+    parts = path.split("/")
+    if (
+        len(parts) != 3
+        or not parts[0]
+        or not re.fullmatch(r"\d{4}", parts[1])
+        or parts[2] not in ("spring", "autumn")
+    ):
+        raise argparse.ArgumentTypeError(
+            f"expected the form department/year/semester (e.g. d-infk/2019/spring), got `{value}`"
+        )
+    return CATALOGUE_PREFIX + path + ".html"
+
+
+def load_catalogue_cache(state):
+    """Loads the cached catalogue pages from `directory_prefix`
+
+    The cache maps the link of each catalogue page to the relevant links found on it:
+    `{link: {"links": [...], "fetched": ..., "etag": ..., "last_modified": ...}}`
+    """
+    try:
+        with open(state.directory_prefix + CATALOGUE_CACHE_FILE, "r") as f:
+            cache = json.load(f)
+        if isinstance(cache, dict):
+            return cache
+    except FileNotFoundError:
+        pass
+    except json.decoder.JSONDecodeError:
+        print_information(
+            state, "Catalogue cache is corrupted, ignoring it", type="warning"
+        )
+    return dict()
+
+
+def save_catalogue_cache(state, cache):
+    """Writes the cached catalogue pages to `directory_prefix`, see `load_catalogue_cache()`"""
+    if not os.path.isdir(state.directory_prefix):
+        os.makedirs(state.directory_prefix)
+
+    cache_file = state.directory_prefix + CATALOGUE_CACHE_FILE
+    temporary_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_file, "w") as f:
+        json.dump(cache, f)
+    os.replace(temporary_file, cache_file)
+
+
+def fetch_catalogue_page(state, page_link, catalogue_link, entry):
+    """Gets the links to lectures and further pages from a catalogue page
+
+    Keyword arguments:
+    page_link      -- The link to the page
+    catalogue_link -- The link to the first page of the catalogue
+    entry          -- The cached result of an earlier visit, if any
+
+    Returns:
+    The new cache entry
+    """
+    if entry and time.time() - entry["fetched"] < CATALOGUE_CACHE_SECONDS:
+        return entry
+
+    # Only download the page again if it changed since the last visit
+    headers = {"User-Agent": USER_AGENT}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        with adaptive_request(
+            state, "metadata", page_link, headers=headers, timeout=30
+        ) as r:
+            if r.status_code == 304 and entry:
+                print_information(state, f"Unchanged: {page_link}", verbose_only=True)
+                links = entry["links"]
+            elif r.ok:
+                print_information(state, f"Fetched: {page_link}", verbose_only=True)
+                # Only keep links inside the catalogue
+                catalogue_path = urlparse(catalogue_link).path.replace(".html", "")
+                links = set()
+                for href in re.findall(r'href\s*=\s*["\']([^"\']+)', r.text):
+                    link = urljoin(page_link, html.unescape(href)).split("#")[0]
+                    if urlparse(link).path.startswith(catalogue_path):
+                        links.add(link)
+                links = sorted(links)
+            else:
+                print_information(
+                    state,
+                    f"Could not get catalogue page {page_link}: {r.status_code}",
+                    type="warning",
+                )
+                return entry
+            return {
+                "links": links,
+                "fetched": time.time(),
+                "etag": r.headers.get("etag") or (entry or dict()).get("etag"),
+                "last_modified": r.headers.get("last-modified")
+                or (entry or dict()).get("last_modified"),
+            }
+    except requests.exceptions.RequestException as e:
+        print_information(
+            state, f"Could not get catalogue page {page_link}: {e}", type="warning"
+        )
+        return entry
+
+
+def discover_lectures(state, catalogue_links):
+    """Finds all lectures listed in the given catalogues
+
+    All pages of the catalogues are fetched in parallel and cached, see `load_catalogue_cache()`
+
+    Keyword arguments:
+    catalogue_links -- Links to catalogue pages, see `parse_catalogue()`
+
+    Returns:
+    A sorted list of links to lectures
+    """
+    cache = load_catalogue_cache(state)
+    lectures = set()
+
+    # `(page link, catalogue link)` of all pages to visit next
+    pending = [(link, link) for link in dict.fromkeys(catalogue_links)]
+    seen = set()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=state.max_connections
+    ) as executor:
+        while pending:
+            seen.update(page_link for page_link, _ in pending)
+            entries = executor.map(
+                lambda page: fetch_catalogue_page(state, *page, cache.get(page[0])),
+                pending,
+            )
+
+            next_pending = list()
+            for (page_link, catalogue_link), entry in zip(pending, entries):
+                if not entry:
+                    continue
+                cache[page_link] = entry
+
+                catalogue_path = urlparse(catalogue_link).path
+                lecture_path = catalogue_path.replace(".html", "") + "/"
+                for link in entry["links"]:
+                    path = urlparse(link).path
+                    name = path[len(lecture_path) :]
+                    if path.startswith(lecture_path) and "/" not in name and name:
+                        # Link to a lecture
+                        parsed = urlparse(link)
+                        lectures.add(f"{parsed.scheme}://{parsed.netloc}{parsed.path}")
+                    elif (
+                        path == catalogue_path
+                        and link not in seen
+                        and len(seen) + len(next_pending)
+                        < CATALOGUE_MAX_PAGES * len(catalogue_links)
+                    ):
+                        # Another page of the catalogue
+                        seen.add(link)
+                        next_pending.append((link, catalogue_link))
+            pending = next_pending
+
+    save_catalogue_cache(state, cache)
+    return sorted(lectures)
+
+
+def read_links_from_file(state, file):
     """Reads the links from a text file
     Each link should be on a seperate line
     Lines starting with `#` will be ignored
@@ -931,66 +6714,173 @@ def read_links_from_file(file):
         # Add links from file to the list of links to look at
         links += file_links
     else:
-        print_information('No file with name "' + file + '" found', type="error")
+        print_information(state, 'No file with name "' + file + '" found', type="error")
     return links
 
 
-def apply_args(args):
+def apply_args(state, args):
     """Applies the provided command line arguments
     The following are handled here:
-     - bug
      - all
      - hide-progress-bar
      - quality
      - print-source
      - destination
      - history
+     - link-duplicates
+     - existing-quality
+     - rescan-library
+     - refresh-changed
+     - lecture-budget
+     - time-budget
+     - expected-speed
+     - export-plan
+     - export-format
+     - streams
+     - segment-workers
+     - post-process
+     - post-process-workers
+     - shard
+     - shard-by
+     - max-connections
+     - min-speed
+     - stall-timeout
+     - staging-dir
+     - preallocate
+     - drop-cache
+     - fsync
+     - quiet
+     - peer
+     - storage-budget
+     - clip
+     - limit-rate
+     - eviction-policy
+     - include-evicted
+     - match
+     - since
+     - lecturer
     """
 
-    global download_all
-    global download_latest
-    global video_quality
-    global print_src
-    global file_to_print_src_to
-    global directory_prefix
-    global history_file
-    global HIDE_PROGRESS_BAR
+    # Store the settings in the state
+    state.download_all = args.all
+    state.download_latest = args.latest
+    state.video_quality = args.quality
+    state.stream_selection = args.streams
+    state.segment_workers = max(1, args.segment_workers)
 
-    # Check if user wants to submit bug report and exit
-    if args.bug:
-        print_information("If you found a bug you can raise an issue here: ")
-        report_bug()
+    # Store the budgets for choosing the quality
+    state.lecture_budget = args.lecture_budget
+    state.time_budget = args.time_budget * 60 * 60
+    state.expected_speed = args.expected_speed
+
+    # Limit the number of connections per host
+    state.max_connections = max(1, args.max_connections)
+
+    # Store when to consider a download as stalled
+    state.min_speed = args.min_speed
+    state.stall_timeout = max(1, args.stall_timeout)
+
+    # Store which part of the recordings to download
+    state.clip = args.clip
+
+    # Store how fast all downloads together may be
+    state.rate_limit = args.limit_rate
+
+    # Store how much space the library may use
+    state.storage_budget = args.storage_budget
+    state.eviction_policy = args.eviction_policy
+    state.include_evicted = args.include_evicted
+
+    # Store which other scrapers to ask for recordings first
+    state.peers = [peer.rstrip("/") for peer in args.peer]
 
-    # Set global variable according to input
-    download_all = args.all
-    download_latest = args.latest
-    video_quality = args.quality
-    HIDE_PROGRESS_BAR = args.hide_progress_bar
+    # Store how to select episodes from the episode catalogue
+    state.episode_match = args.match
+    state.episode_since = args.since or ""
+    state.episode_lecturer = args.lecturer
+
+    # Store which part of the work this machine should do
+    state.shard = args.shard
+    state.shard_by = args.shard_by
+
+    # Read commands to run after each download
+    if args.post_process:
+        state.post_process_commands = read_post_process_file(state, args.post_process)
+        state.post_process_workers = max(1, args.post_process_workers)
+        print_information(
+            state,
+            f"Read {len(state.post_process_commands)} post-processing commands",
+            verbose_only=True,
+        )
+    state.quiet = args.quiet
+    state.hide_progress_bar = args.hide_progress_bar or state.quiet
 
     # Check for printing flag
     if hasattr(args, "print_src"):
-        print_src = True
+        state.print_src = True
         # Store where to print video source
         if args.print_src:
-            file_to_print_src_to = args.print_src
+            state.file_to_print_src_to = args.print_src
+
+    # Check whether the download plan should be exported instead
+    if args.export_plan:
+        state.export_plan_file = args.export_plan
+        state.export_format = args.export_format
+        print_information(
+            state,
+            f"Exporting download plan as {state.export_format} to: {state.export_plan_file}",
+            verbose_only=True,
+        )
 
     # Check for destination flag
     if args.destination:
-        directory_prefix = args.destination
+        state.directory_prefix = args.destination
         print_information(
-            "The user passed directory is: " + directory_prefix, verbose_only=True
+            state,
+            "The user passed directory is: " + state.directory_prefix,
+            verbose_only=True,
         )
-        if not directory_prefix.endswith(os.sep):
+        if not state.directory_prefix.endswith(os.sep):
             # Add trailing (back)slash as the user might have forgotten it
-            directory_prefix += os.sep
+            state.directory_prefix += os.sep
             print_information(
-                "Added missing slash: " + directory_prefix, verbose_only=True
+                state,
+                "Added missing slash: " + state.directory_prefix,
+                verbose_only=True,
             )
 
+    # Store how to write recordings to disk
+    state.preallocate = args.preallocate
+    state.drop_cache = args.drop_cache
+    state.fsync_policy, state.fsync_interval = args.fsync
+
+    # Store where to download to before moving the recordings to the destination
+    if args.staging_dir:
+        state.staging_dir = args.staging_dir
+        print_information(
+            state, "Staging directory: " + state.staging_dir, verbose_only=True
+        )
+
     # Store where to read/print history
     if args.history:
-        history_file = args.history
-        print_information("History file location: " + history_file, verbose_only=True)
+        state.history_file = args.history
+        print_information(
+            state, "History file location: " + state.history_file, verbose_only=True
+        )
+
+    # Store how to handle recordings that already exist in another lecture
+    if args.link_duplicates:
+        state.link_duplicates = args.link_duplicates
+        print_information(
+            state,
+            "Linking duplicate recordings using: " + state.link_duplicates,
+            verbose_only=True,
+        )
+
+    # Store when to treat a recording as already downloaded
+    state.existing_quality = args.existing_quality
+    state.rescan_library = args.rescan_library
+    state.refresh_changed = args.refresh_changed
 
 
 def setup_arg_parser():
@@ -1014,11 +6904,23 @@ def setup_arg_parser():
         action="store_true",
         help="Print link to GitHub issue page and open it in browser.",
     )
+    parser.add_argument(
+        "--clip",
+        metavar="START-END",
+        type=parse_clip,
+        help="Only download part of each recording, e.g. `10:00-20:00` or `1:05:00-` for everything after 1 hour and 5 minutes. Only the data within the clip is downloaded. The clip starts at the last key frame before START, so it might start a few seconds early. Recordings only available as HLS or DASH stream are downloaded completely.",
+    )
+    parser.add_argument(
+        "--control",
+        metavar="[HOST:]PORT",
+        type=parse_control_address,
+        help="Answer requests about the progress and to change it while the scraper runs, e.g. `--control 8081`, then see `http://localhost:8081/status`. Only listens on the local machine unless a host is given. See README.md for what it can do.",
+    )
     parser.add_argument(
         "-d",
         "--destination",
         help='Directory where to save the files to. By default this is the folder "'
-        + directory_prefix
+        + DEFAULT_DIRECTORY_PREFIX
         + '" of the current working directory.',
     )
     parser.add_argument(
@@ -1026,11 +6928,76 @@ def setup_arg_parser():
         action="store_true",
         help="If set no hints will be displayed if the scraper finished running",
     )
+    parser.add_argument(
+        "--discover",
+        metavar="CATALOGUE",
+        action="append",
+        type=parse_catalogue,
+        help="Download all lectures of a department in a semester, given as `department/year/semester`, e.g. `--discover d-infk/2019/spring`. Can be passed multiple times. Combine with `--all` to download all recordings without being asked.",
+    )
+    parser.add_argument(
+        "--discover-only",
+        action="store_true",
+        help="Only print the links of the lectures found with `--discover`, e.g. to create a file for `--file`.",
+    )
+    parser.add_argument(
+        "--drop-cache",
+        action="store_true",
+        help="Remove downloaded data from the operating system's file cache while writing, so large downloads don't push out data of other programs (Linux only).",
+    )
+    parser.add_argument(
+        "--event-log",
+        metavar="FILE",
+        help="Write a log of what the scraper does (lectures found, downloads started, finished, skipped or failed, retries, ...) to FILE, one JSON object per line. Use `-` for the terminal or `fd:N` for an open file descriptor.",
+    )
+    parser.add_argument(
+        "--eviction-policy",
+        default="oldest",
+        choices=["oldest", "least-accessed", "lowest-priority"],
+        help="Which recordings to delete first when the library exceeds `--storage-budget`: the `oldest` recordings (default), the `least-accessed` ones, or those of the lectures with the `lowest-priority` in the links file.",
+    )
+    parser.add_argument(
+        "--existing-quality",
+        metavar="POLICY",
+        default="exact",
+        choices=["exact", "any", "at-least", "upgrade"],
+        help="When to consider a recording as already downloaded. `exact` (default) only skips recordings that exist in the selected quality. `any` skips recordings that exist in any quality. `at-least` skips recordings that exist in the selected or a higher quality. `upgrade` works like `at-least` but deletes lower quality copies after downloading a better one. Keeps an index of downloaded recordings in the download directory.",
+    )
+    parser.add_argument(
+        "--execute-plan",
+        metavar="FILE",
+        help="Download the recordings listed in a plan file previously written with `--export-plan FILE` (in the `jsonl` format) without fetching any lecture metadata. If `--destination` is passed, the recordings are saved relative to that directory instead of the one they were planned for.",
+    )
+    parser.add_argument(
+        "--expected-speed",
+        metavar="SPEED",
+        type=parse_speed,
+        default=0,
+        help="Download speed in bytes per second (e.g. `5M`) used by `--time-budget`. If not given, the speed is measured before downloading.",
+    )
+    parser.add_argument(
+        "--export-format",
+        default="jsonl",
+        choices=["jsonl", "aria2c", "wget"],
+        help="Format of the file written by `--export-plan`: `jsonl` (default) writes one JSON object per recording, `aria2c` writes an input file for `aria2c -i`, and `wget` writes a shell script.",
+    )
+    parser.add_argument(
+        "--export-plan",
+        metavar="FILE",
+        help="Don't download the recordings but write the target file name, source link, size, and required headers of each recording to FILE. Useful for handing the downloads to tools like aria2c or wget.",
+    )
     parser.add_argument(
         "-f",
         "--file",
         help="A file with links to all the lectures you want to download. Each lecture link should be on a new line. See README.md for details.",
     )
+    parser.add_argument(
+        "--fsync",
+        metavar="POLICY",
+        type=parse_fsync_policy,
+        default=("none", 0),
+        help="When to force downloaded data onto the disk: `none` (default, leave it to the operating system), `close` (once a file is complete) or a number N to do so every N MiB.",
+    )
     parser.add_argument(
         "--hide-progress-bar",
         action="store_true",
@@ -1042,19 +7009,97 @@ def setup_arg_parser():
         metavar="FILE",
         help="A file to which the scraper saves the IDs of downloaded videos to. The scraper will skip downloads if the corresponding ID exists in the specified file.",
     )
+    parser.add_argument(
+        "--include-evicted",
+        action="store_true",
+        help="Download recordings again that were deleted to stay within `--storage-budget`.",
+    )
     parser.add_argument(
         "--latest",
         action="store_true",
         help="Only downloads the latest video from each passed lecture.",
     )
+    parser.add_argument(
+        "--lecture-budget",
+        metavar="SIZE",
+        type=parse_size,
+        default=0,
+        help="Maximum size of all recordings of a lecture, e.g. `20G`. Recordings are downloaded in a lower quality (but never higher than `--quality`) if necessary to stay within it.",
+    )
+    parser.add_argument(
+        "--lecturer",
+        metavar="NAME",
+        default="",
+        help="Only select episodes whose lecturer contains NAME. See `--match`.",
+    )
+    parser.add_argument(
+        "--limit-rate",
+        metavar="SPEED",
+        type=parse_speed,
+        default=0,
+        help="Maximum speed of all downloads together, e.g. `5M` for 5 MiB/s. Not limited by default.",
+    )
+    parser.add_argument(
+        "--link-duplicates",
+        metavar="MODE",
+        nargs="?",
+        const="hardlink",
+        choices=["hardlink", "symlink", "reflink"],
+        help="If a recording has already been downloaded for another lecture (e.g. a cross-listed series), link to the existing copy instead of downloading it again. MODE is one of `hardlink` (default), `symlink`, or `reflink`. Keeps an index of downloaded recordings in the download directory.",
+    )
+    parser.add_argument(
+        "--match",
+        metavar="WORDS",
+        default="",
+        help="Only select episodes whose title, lecture title or lecturer contain all WORDS, instead of asking which episodes to download. Without lecture links, all lectures the scraper has seen before are searched without getting their metadata again.",
+    )
+    parser.add_argument(
+        "--max-connections",
+        metavar="N",
+        type=int,
+        default=8,
+        help="Maximum number of connections per host for getting metadata and for downloading. The scraper starts with one connection and adds more as long as the throughput increases, and backs off if the server is overloaded. Default is 8, use 1 to download one recording at a time.",
+    )
+    parser.add_argument(
+        "--min-speed",
+        metavar="SPEED",
+        type=parse_speed,
+        default=16 * 1024,
+        help="Reconnect downloads that are slower than SPEED bytes per second (e.g. `50K` or `1M`) for `--stall-timeout` seconds, continuing where they stopped. Default is 16K, use 0 to never reconnect slow downloads.",
+    )
     parser.add_argument(
         "--parameter-file",
         metavar="FILE",
         help="Pass the name of the file to read parameters from. If the flag is not set parser will try to read parameters from `parameters.txt`",
     )
+    parser.add_argument(
+        "--peer",
+        metavar="URL",
+        action="append",
+        default=[],
+        help="Another scraper running `--serve-library`, e.g. `http://192.168.1.20:8080`. Recordings are downloaded from it if it has them, and from video.ethz.ch otherwise. Can be given several times.",
+    )
+    parser.add_argument(
+        "--post-process",
+        metavar="FILE",
+        help="A file with commands to run on each downloaded recording, e.g. to remux or extract the audio with ffmpeg. Each line has the form `<lecture> <quality> <command>`, see README.md for details. Commands run in the background while the remaining recordings are downloaded.",
+    )
+    parser.add_argument(
+        "--post-process-workers",
+        metavar="N",
+        type=int,
+        default=2,
+        help="Maximum number of post-processing commands running at the same time. Default is 2.",
+    )
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        help="Reserve the disk space for a recording before downloading it, which avoids fragmented files (Linux only).",
+    )
     parser.add_argument(
         "-p",
         "--print-source",
+        dest="print_src",
         metavar="FILE",
         nargs="?",
         default=argparse.SUPPRESS,
@@ -1066,12 +7111,94 @@ def setup_arg_parser():
         default="HD",
         help="Select a specific video resolution. Either specify a height directly like `1080p` or use the keywords `FullHD`, `2K`, and `4K`. The scraper will try to download the video closest to the specified resolution. Additionally you can also use `highest` and `lowest` to always download the highest or lowest quality respectively.",
     )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Only print errors. Implies `--hide-progress-bar`.",
+    )
+    parser.add_argument(
+        "--recover",
+        action="store_true",
+        help="Continue the downloads of earlier runs that were interrupted, e.g. by a crash or reboot, without getting the lectures again. Partially downloaded recordings are continued where they stopped.",
+    )
+    parser.add_argument(
+        "--refresh-changed",
+        action="store_true",
+        help="Check whether already downloaded recordings were changed or replaced on the server and download those again.",
+    )
+    parser.add_argument(
+        "--rescan-library",
+        action="store_true",
+        help="Rebuild the index of downloaded recordings used by `--existing-quality` and `--link-duplicates` by scanning the download directory.",
+    )
+    parser.add_argument(
+        "--serve-library",
+        metavar="[HOST:]PORT",
+        type=parse_address,
+        help="Make the downloaded recordings available to other scrapers using `--peer`. Without lecture links, the scraper only serves the library until it is stopped.",
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        type=parse_shard,
+        help="Split the work between N machines and only process part i of it (counting from 1), e.g. `--shard 2/4`. Lectures (or episodes, see `--shard-by`) are assigned based on a hash, so every machine gets the same assignment without any coordination.",
+    )
+    parser.add_argument(
+        "--shard-by",
+        default="lecture",
+        choices=["lecture", "episode"],
+        help="Whether `--shard` splits the work by `lecture` (default) or by `episode`. Splitting by episode spreads very large lectures across machines, but every machine fetches the metadata of all lectures.",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="DATE",
+        type=parse_since,
+        help="Only select episodes recorded on or after DATE, e.g. `2021-03-01`, or within the last days, e.g. `14d`. See `--match`.",
+    )
     parser.add_argument(
         "-sc",
         "--skip-connection-check",
         action="store_true",
         help="Skip checking whether there's a connection to video.ethz.ch or the internet in general.",
     )
+    parser.add_argument(
+        "--staging-dir",
+        metavar="DIRECTORY",
+        help="Download to a (fast, local) directory first and move the recordings to the destination in the background. Useful if the destination is a slow network drive.",
+    )
+    parser.add_argument(
+        "--stall-timeout",
+        metavar="SECONDS",
+        type=int,
+        default=60,
+        help="Time window in seconds for measuring the speed of downloads (see `--min-speed`). A connection that receives no data at all for this long is reconnected as well. Default is 60.",
+    )
+    parser.add_argument(
+        "--storage-budget",
+        metavar="SIZE",
+        type=parse_size,
+        default=0,
+        help="Maximum size of all recordings in the download directory, e.g. `500G`. After downloading, recordings are deleted according to `--eviction-policy` until the library fits. Recordings that would be deleted right away are not downloaded. Deleted recordings are not downloaded again.",
+    )
+    parser.add_argument(
+        "--streams",
+        metavar="STREAMS",
+        help="Which streams to download for recordings that have several, e.g. one showing the presenter and one showing the slides. Either `all` or a comma separated list of stream numbers and/or the names `presenter` and `presentation`. By default only the first stream is downloaded. Streams of the same recording are downloaded at the same time, additional streams are saved with the stream name appended to the file name.",
+    )
+    parser.add_argument(
+        "--time-budget",
+        metavar="HOURS",
+        type=float,
+        default=0,
+        help="Lower the quality of recordings (but never higher than `--quality`) so that all downloads finish within the given number of hours, see also `--expected-speed`.",
+    )
+    parser.add_argument(
+        "--segment-workers",
+        metavar="N",
+        type=int,
+        default=8,
+        help="Number of segments downloaded in parallel for recordings that are only available as HLS or DASH stream (e.g. audio only recordings). Default is 8.",
+    )
     parser.add_argument(
         "-su",
         "--skip-update-check",
@@ -1090,9 +7217,10 @@ def setup_arg_parser():
     return parser
 
 
-def print_usage():
+def print_usage(state):
     """Prints basic usage of parser and gives examples"""
     print_information(
+        state,
         """You haven't added any lecture links! To download a lecture video you need to pass a link to the lecture, e.g.:"
     "python3 vo-scraper.py https://video.ethz.ch/lectures/d-infk/2019/spring/252-0028-00L.html"
 
@@ -1100,7 +7228,7 @@ You can also pass optional arguments. For example, the following command downloa
     "python3 vo-scraper.py --quality low --all https://video.ethz.ch/lectures/d-infk/2019/spring/252-0028-00L.html"
 
 To see all possible arguments run "python3 vo-scraper.py --help"
-    """
+    """,
     )
 
 
@@ -1126,26 +7254,36 @@ def remove_illegal_characters(str):
 # ===============================================================
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Runs the scraper with the given command line arguments
+
+    Keyword arguments:
+    argv -- List of command line arguments, `sys.argv[1:]` if not provided
+    """
+    state = ScraperState()
+
+    if argv is None:
+        argv = sys.argv[1:]
+    argv = list(argv)
+
     # Setup parser
     parser = setup_arg_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Enable verbose for debugging
-    verbose = args.verbose
-    print_information("Verbose enabled", verbose_only=True)
+    state.verbose = args.verbose
+    print_information(state, "Verbose enabled", verbose_only=True)
 
     # Check for version flag
     if args.version:
-        print_information(PROGRAM_VERSION)
+        print(PROGRAM_VERSION)
         sys.exit()
 
     # If a parameter file was passed, use that instead of default
-    if args.parameter_file:
-        PARAMETER_FILE = args.parameter_file
+    parameter_file = args.parameter_file or PARAMETER_FILE
     # Read parameters if file exists
-    if os.path.isfile(PARAMETER_FILE):
-        with open(PARAMETER_FILE) as f:
+    if os.path.isfile(parameter_file):
+        with open(parameter_file) as f:
             # Read file and remove trailing whitespaces and newlines
             parameters = [x.strip() for x in f.readlines()]
             # Remove comments i.e. lines starting with `#`
@@ -1155,65 +7293,149 @@ if __name__ == "__main__":
                 words for segments in parameters for words in segments.split()
             ]
             # Add parameters list
-            sys.argv += parameters
+            argv += parameters
             # Parse args again as we might have added some
-            args = parser.parse_args()
+            args = parser.parse_args(argv)
     else:
         # Print when no parameter file was found
         # If no `--parameter-file` was passsed, this only prints when verbosity is turned on
         print_information(
-            "No parameter file found at location: " + PARAMETER_FILE,
+            state,
+            "No parameter file found at location: " + parameter_file,
             verbose_only=not bool(args.parameter_file),
             type="warning",
         )
 
+    # Check if user wants to submit bug report and exit
+    if args.bug:
+        print_information(state, "If you found a bug you can raise an issue here: ")
+        report_bug(state)
+
     # Apply commands from input
-    apply_args(args)
+    apply_args(state, args)
+
+    # Open the event log as early as possible
+    if args.event_log:
+        open_event_log(state, args.event_log)
+        # Events are buffered, make sure they are written even if the scraper exits early
+        atexit.register(close_event_log, state)
+
+    # Serve the library while the scraper runs
+    if args.serve_library:
+        start_library_server(state, args.serve_library)
+
+    # Allow checking and changing the progress from outside
+    if args.control:
+        start_control_server(state, args.control)
 
     # Collect lecture links
     links = list()
     if args.file:
-        links += read_links_from_file(args.file)
+        links += read_links_from_file(state, args.file)
 
     # Append links passed through the command line:
     links += args.lecture_link
 
-    # Extract username and password from "link"
+    # Add all lectures found in the catalogues
+    if args.discover:
+        discovered_links = discover_lectures(state, args.discover)
+        print_information(
+            state,
+            f"Discovered {len(discovered_links)} lectures in {len(args.discover)} catalogues",
+            # Keep the output clean so it can be redirected into a links file
+            verbose_only=args.discover_only,
+        )
+        if args.discover_only:
+            for link in discovered_links:
+                print(link)
+            sys.exit()
+        links += [link for link in discovered_links if link not in links]
+
+    # Extract username, password, priority and weight from "link"
     lecture_objects = list()
     lecture_objects += [
-        tuple((link.split(" ") + ["", ""])[:3]) for link in links
-    ]  # This gives us tuples of size 3, where user and pw can be empty
+        parse_lecture_line(state, link) for link in links
+    ]  # This gives us tuples of size 5, where user and pw can be empty
+
+    # Only keep the lectures belonging to this shard
+    if state.shard and state.shard_by == "lecture":
+        lecture_objects = [
+            lecture
+            for lecture in lecture_objects
+            if in_shard(state, normalize_lecture_link(lecture[0]))
+        ]
+        print_information(
+            state,
+            f"{len(lecture_objects)} of {len(links)} lectures belong to shard {state.shard[0]}/{state.shard[1]}",
+        )
+
+    # Without lecture links, the filters search all lectures in the episode catalogue
+    search_catalogue = episode_filters_set(state) and not links
 
     # Print basic usage and exit if no lecture links are passed
-    if not links:
-        print_usage()
+    if (
+        not links
+        and not args.execute_plan
+        and not args.recover
+        and not search_catalogue
+    ):
+        # Only serve the library
+        if state.library_server:
+            print_information(state, "Press Ctrl+C to stop serving the library")
+            try:
+                while True:
+                    time.sleep(60)
+            except KeyboardInterrupt:
+                sys.exit()
+        print_usage(state)
         sys.exit()
 
     # Connection check
-    if not args.skip_connection_check:
-        check_connection()
+    # Executing a plan doesn't need video.ethz.ch, so there is no need to check it
+    if not args.skip_connection_check and (links or search_catalogue):
+        check_connection(state)
     else:
-        print_information("Connection check skipped.", verbose_only=True)
+        print_information(state, "Connection check skipped.", verbose_only=True)
 
     # Update check
     if not args.skip_update_check:
-        check_update()
+        check_update(state)
     else:
-        print_information("Update check skipped.", verbose_only=True)
+        print_information(state, "Update check skipped.", verbose_only=True)
 
     # Print selected quality
-    if video_quality == "lowest" or video_quality == "highest":
-        quality_string = video_quality
-    else:
-        quality_string = str(resolution_from_input(video_quality)) + "p"
-    print_information(f"Selected quality for downloads: {quality_string}")
-    print_information("")
+    if links or search_catalogue:
+        if state.video_quality == "lowest" or state.video_quality == "highest":
+            quality_string = state.video_quality
+        else:
+            quality_string = str(resolution_from_input(state.video_quality)) + "p"
+        print_information(state, f"Selected quality for downloads: {quality_string}")
+        print_information(state, "")
+
+    # Add recordings of a previously saved plan
+    if args.execute_plan:
+        try:
+            plan_collection = read_download_plan(
+                state, args.execute_plan, rebase=bool(args.destination)
+            )
+        except ScraperError as e:
+            print_information(state, str(e), type="error")
+            sys.exit(1)
+        state.link_counter += len(plan_collection)
+        state.video_src_collection += plan_collection
+
+    # Add the recordings of interrupted runs
+    if args.recover:
+        recovered_collection = recover_interrupted_runs(state)
+        state.link_counter += len(recovered_collection)
+        state.video_src_collection += recovered_collection
 
     # Run scraper for every link provided to get video sources for each episode
-    for link, user, password in lecture_objects:
-        print_information("Currently selected: " + link, verbose_only=True)
+    for link, user, password, priority, weight in lecture_objects:
+        print_information(state, "Currently selected: " + link, verbose_only=True)
         if "video.ethz.ch" not in link:
             print_information(
+                state,
                 f"Looks like the provided link does not go to 'videos.ethz.ch' and has therefore been skipped. Make sure that it is correct: {link}",
                 type="warning",
             )
@@ -1221,32 +7443,69 @@ if __name__ == "__main__":
             # Give some useful information if the provided link goes to YouTube or Zoom
             if "youtube" in link or "youtu.be" in link:
                 print_information(
-                    "Note that if you want to download a lecture from YouTube, I recommend youtube-dl: https://github.com/ytdl-org/youtube-dl/"
+                    state,
+                    "Note that if you want to download a lecture from YouTube, I recommend youtube-dl: https://github.com/ytdl-org/youtube-dl/",
                 )
             if "zoom.us" in link:
                 print_information(
-                    "Note that if you want to download a lecture from Zoom, I recommend zoomdl: https://github.com/Battleman/zoomdl/"
+                    state,
+                    "Note that if you want to download a lecture from Zoom, I recommend zoomdl: https://github.com/Battleman/zoomdl/",
                 )
 
         else:
-            video_src_collection += vo_scrapper(link, video_quality, user, password)
-        print()
+            lecture_collection = vo_scrapper(
+                state, link, state.video_quality, user, password
+            )
+            # Remember the priority of the lecture for the download order
+            for file_name, _, _ in lecture_collection:
+                state.lecture_priorities[
+                    os.path.dirname(remove_illegal_characters(file_name))
+                ] = (priority, weight)
+            state.video_src_collection += lecture_collection
+        if not state.quiet:
+            print()
+
+    # Get the matching episodes of all lectures in the episode catalogue
+    if search_catalogue:
+        state.video_src_collection += scrape_episode_catalogue(state)
 
     # Print collected episodes
-    print_information(video_src_collection, verbose_only=True)
+    print_information(state, state.video_src_collection, verbose_only=True)
+
+    # Lower qualities to fit into the budgets
+    state.video_src_collection = apply_quality_budgets(
+        state, state.video_src_collection
+    )
 
     # Strip illegal characters:
-    video_src_collection = [
+    state.video_src_collection = [
         (remove_illegal_characters(file_name), video_src_link, episode_name)
-        for (file_name, video_src_link, episode_name) in video_src_collection
+        for (file_name, video_src_link, episode_name) in state.video_src_collection
     ]
 
-    # Download selected episodes
-    for file_name, video_src_link, episode_name in video_src_collection:
-        downloader(file_name, video_src_link, episode_name)
+    # Export the download plan instead of downloading
+    if state.export_plan_file:
+        write_download_plan(
+            state,
+            state.video_src_collection,
+            state.export_plan_file,
+            state.export_format,
+        )
+    else:
+        # Download selected episodes
+        download_recordings(state, state.video_src_collection)
+        write_printed_src_links(state)
+        finish_staging(state)
+        finish_post_processing(state)
+        enforce_storage_budget(state)
 
     # Display hints if applicable
-    if not args.disable_hints and HINT_LIST and video_src_collection:
+    if (
+        not args.disable_hints
+        and not state.quiet
+        and HINT_LIST
+        and state.video_src_collection
+    ):
         print()
         print("-" * shutil.get_terminal_size().columns)
         print("Hint:")
@@ -1255,5 +7514,41 @@ if __name__ == "__main__":
 
     # Print summary and exit
     print_information(
-        f"{link_counter} files found, {download_counter} downloaded and {skip_counter} skipped"
+        state,
+        f"{state.link_counter} files found, {state.download_counter} downloaded and {state.skip_counter} skipped",
+    )
+    if state.duplicate_counter:
+        print_information(
+            state, f"{state.duplicate_counter} duplicates linked to existing copies"
+        )
+    if state.changed_counter:
+        print_information(
+            state,
+            f"{state.changed_counter} recordings changed on the server and were downloaded again",
+        )
+    if state.stall_counter:
+        print_information(
+            state,
+            f"Reconnected {state.stall_counter} times after downloads stalled or broke off",
+        )
+    if state.peer_counter:
+        print_information(
+            state, f"{state.peer_counter} recordings downloaded from peers"
+        )
+    emit_event(
+        state,
+        "run_finished",
+        found=state.link_counter,
+        downloaded=state.download_counter,
+        skipped=state.skip_counter,
+        linked=state.duplicate_counter,
+        reconnected=state.stall_counter,
+        changed=state.changed_counter,
+        from_peers=state.peer_counter,
+        evicted=state.evict_counter,
     )
+    close_event_log(state)
+
+
+if __name__ == "__main__":
+    main()
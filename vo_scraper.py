@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Importable interface to the vo-scraper, for using it from other Python programs.
+
+Example:
+
+    from vo_scraper import Scraper
+
+    scraper = Scraper(quality="low", destination="recordings")
+    plan = scraper.resolve("https://video.ethz.ch/lectures/d-infk/2019/spring/252-0028-00L.html")
+    scraper.download(plan)
+    print(scraper.stats)
+
+Every `Scraper` keeps its settings, login cookies, caches and statistics in its own `ScraperState`, so
+nothing is shared between instances. Several scrapers can therefore run at the same time in different
+threads of the same process.
+
+A scraper never prompts or exits the process. Credentials of protected lectures are taken from `Config`
+and problems that would end the command line scraper raise `ScraperError` instead. Messages are printed
+to the `output` file of `Config`, stdout if not given.
+
+Check README.md and LICENSE before using this program.
+"""
+
+import importlib.util
+import os
+import sys
+import threading
+
+# The scraper itself is kept as a single script so it can be downloaded and run as is
+SCRAPER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vo-scraper.py")
+
+# Options of `Config` that have no command line flag
+LIBRARY_OPTIONS = ("user", "password", "credentials", "output")
+
+# Attributes of `ScraperState` reported by `Scraper.stats`
+STATS_COUNTERS = {
+    "found": "link_counter",
+    "downloaded": "download_counter",
+    "skipped": "skip_counter",
+    "linked": "duplicate_counter",
+    "reconnected": "stall_counter",
+    "changed": "changed_counter",
+    "from_peers": "peer_counter",
+    "evicted": "evict_counter",
+}
+
+
+def load_scraper_module():
+    """Imports `vo-scraper.py`, which can't be imported by name because of the dash"""
+    spec = importlib.util.spec_from_file_location("vo_scraper_functions", SCRAPER_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Only has functions and constants, all state is kept in the `ScraperState` of each `Scraper`
+scraper_module = load_scraper_module()
+
+# Raised by `Scraper` instead of prompting or exiting, `LoginError` is a subclass of `ScraperError`
+ScraperError = scraper_module.ScraperError
+LoginError = scraper_module.LoginError
+
+
+class Config:
+    """Settings of a scraper
+
+    Takes the same options as the command line, with dashes replaced by underscores, e.g.
+    `Config(quality="low", destination="recordings", existing_quality="at-least")`.
+    Flags that only make sense on the command line (like `--file` or `--bug`) have no effect.
+
+    Protected lectures use the `user` and `password` options, or `credentials`, a function
+    `(lecture_link, protection)` returning `(user, password)`. Without them, resolving a protected lecture
+    raises `ScraperError`. `output` is a file to print messages to instead of stdout.
+    """
+
+    def __init__(self, **options):
+        self.options = options
+
+    def apply(self, state):
+        """Applies the settings to the state of a scraper
+
+        Keyword arguments:
+        state -- A new `ScraperState`
+        """
+        # Start from the defaults of the command line
+        args = scraper_module.setup_arg_parser().parse_args([])
+        for name, value in self.options.items():
+            if name in LIBRARY_OPTIONS:
+                continue
+            if name != "print_src" and not hasattr(args, name):
+                raise TypeError(f"Unknown scraper option: {name}")
+            setattr(args, name, value)
+
+        state.verbose = args.verbose
+        state.output = self.options.get("output")
+        scraper_module.apply_args(state, args)
+
+        # Never prompt, there is nobody to answer
+        state.interactive = False
+        credentials = self.options.get("credentials")
+        if credentials is None and (
+            "user" in self.options or "password" in self.options
+        ):
+            user = self.options.get("user", "")
+            password = self.options.get("password", "")
+
+            def credentials(lecture_link, protection):
+                return (user, password)
+
+        state.credentials_callback = credentials
+
+        # There is nobody to pick the episodes, so download all of them by default
+        if not state.download_latest:
+            state.download_all = True
+
+
+class Scraper:
+    """A scraper with its own settings, login cookies, library index and statistics
+
+    All methods are thread-safe. Calls on the same scraper run one after another (except for `status()`,
+    `pause()` and `resume()`), different scrapers run independently of each other. `stats` only count
+    the last call.
+
+    Keyword arguments:
+    config  -- A `Config` object, if not given one is created from `options`
+    options -- Settings, see `Config`
+    """
+
+    def __init__(self, config=None, **options):
+        self._lock = threading.RLock()
+        self.config = config or Config(**options)
+        self.state = scraper_module.ScraperState()
+        self.config.apply(self.state)
+
+    def _reset(self):
+        """Starts the statistics of a new call and forgets what earlier calls collected"""
+        for counter in STATS_COUNTERS.values():
+            setattr(self.state, counter, 0)
+        self.state.changed_recordings.clear()
+        self.state.printed_src_links.clear()
+
+    def resolve(
+        self, lecture_link, user="", password="", episodes=None, priority=0, weight=1
+    ):
+        """Gets the recordings of a lecture without downloading them
+
+        Keyword arguments:
+        lecture_link -- The link to the lecture
+        user         -- Username, if the lecture requires a login
+        password     -- Password, if the lecture requires a login
+        episodes     -- Numbers of the episodes to get as shown by the scraper, all if not given
+        priority     -- Recordings of lectures with a higher priority are downloaded first
+        weight       -- Share of the downloads compared to other lectures with the same priority
+
+        Returns:
+        A list of `(file_name, video_src_link, episode_name)` tuples that can be passed to `download()`
+        """
+        with self._lock:
+            self._reset()
+            return self._resolve(
+                lecture_link, user, password, episodes, priority, weight
+            )
+
+    def _resolve(self, lecture_link, user, password, episodes, priority, weight):
+        """Same as `resolve()`, but keeps the statistics of the current call"""
+        state = self.state
+        collection = scraper_module.vo_scrapper(
+            state, lecture_link.strip(), state.video_quality, user, password, episodes
+        )
+        collection = scraper_module.apply_quality_budgets(state, collection)
+        collection = [
+            (scraper_module.remove_illegal_characters(file_name), video_src_link, name)
+            for file_name, video_src_link, name in collection
+        ]
+        for file_name, _, _ in collection:
+            state.lecture_priorities[os.path.dirname(file_name)] = (priority, weight)
+        return collection
+
+    def download(self, collection):
+        """Downloads recordings returned by `resolve()` or read from a plan file
+
+        Keyword arguments:
+        collection -- A list of `(file_name, video_src_link, episode_name)` tuples
+        """
+        with self._lock:
+            self._reset()
+            self._download(collection)
+
+    def _download(self, collection):
+        """Same as `download()`, but keeps the statistics of the current call"""
+        state = self.state
+        if not state.link_counter:
+            state.link_counter = len(collection)
+        scraper_module.download_recordings(state, collection)
+        scraper_module.write_printed_src_links(state)
+        scraper_module.finish_staging(state)
+        scraper_module.finish_post_processing(state)
+        scraper_module.enforce_storage_budget(state)
+
+    def run(self, lecture_links):
+        """Gets and downloads the recordings of several lectures
+
+        Keyword arguments:
+        lecture_links -- Links in the same format as in a links file, i.e. optionally followed by username,
+                         password, `priority=N` and `weight=N`
+
+        Returns:
+        The list of `(file_name, video_src_link, episode_name)` tuples that were processed
+        """
+        with self._lock:
+            self._reset()
+            state = self.state
+            collection = list()
+            for line in lecture_links:
+                link, user, password, priority, weight = (
+                    scraper_module.parse_lecture_line(state, line)
+                )
+                if state.shard_by == "lecture" and not scraper_module.in_shard(
+                    state, scraper_module.normalize_lecture_link(link)
+                ):
+                    continue
+                collection += self._resolve(
+                    link, user, password, None, priority, weight
+                )
+            self._download(collection)
+            return collection
+
+    def discover(self, catalogues):
+        """Finds all lectures of the given catalogues, e.g. `["d-infk/2019/spring"]`, see `--discover`
+
+        Returns:
+        A list of lecture links that can be passed to `resolve()` or `run()`
+        """
+        with self._lock:
+            return scraper_module.discover_lectures(
+                self.state,
+                [scraper_module.parse_catalogue(catalogue) for catalogue in catalogues],
+            )
+
+    def search(self):
+        """Gets the recordings of all lectures seen before that match the `match`, `since` and `lecturer` settings
+
+        The series metadata is taken from the local episode catalogue instead of being downloaded again.
+
+        Returns:
+        A list of `(file_name, video_src_link, episode_name)` tuples that can be passed to `download()`
+        """
+        with self._lock:
+            self._reset()
+            collection = scraper_module.apply_quality_budgets(
+                self.state, scraper_module.scrape_episode_catalogue(self.state)
+            )
+            return [
+                (
+                    scraper_module.remove_illegal_characters(file_name),
+                    video_src_link,
+                    name,
+                )
+                for file_name, video_src_link, name in collection
+            ]
+
+    def recover(self):
+        """Gets the recordings of interrupted runs in the destination, see `--recover`
+
+        Returns:
+        A list of `(file_name, video_src_link, episode_name)` tuples that can be passed to `download()`,
+        which continues partially downloaded recordings where they stopped
+        """
+        with self._lock:
+            self._reset()
+            return scraper_module.recover_interrupted_runs(self.state)
+
+    def export_plan(self, collection, plan_file, plan_format="jsonl"):
+        """Writes recordings returned by `resolve()` to a plan file, see `--export-plan`"""
+        with self._lock:
+            scraper_module.write_download_plan(
+                self.state, collection, plan_file, plan_format
+            )
+
+    def read_plan(self, plan_file):
+        """Reads a plan file written by `export_plan()` and returns its recordings
+
+        Raises `ScraperError` if the plan file doesn't exist.
+        """
+        with self._lock:
+            return scraper_module.read_download_plan(self.state, plan_file)
+
+    def status(self):
+        """Progress of the downloads, see `GET /status` of `--control`
+
+        Unlike the other methods this can be called while `download()` or `run()` are running.
+        """
+        return scraper_module.get_status(self.state)
+
+    def pause(self):
+        """Pauses all downloads, can be called while `download()` or `run()` are running"""
+        scraper_module.pause_downloads(self.state)
+
+    def resume(self):
+        """Resumes downloads paused with `pause()`"""
+        scraper_module.resume_downloads(self.state)
+
+    @property
+    def stats(self):
+        """Statistics of the last call of `resolve()`, `search()`, `recover()`, `download()` or `run()`"""
+        with self._lock:
+            return {
+                name: getattr(self.state, counter)
+                for name, counter in STATS_COUNTERS.items()
+            }